@@ -0,0 +1,46 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+from typing import Any, Hashable, Optional
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries expire after a time to live (in seconds)"""
+
+    def __init__(self, maxsize: int = 128, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Optional[Any]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.entries)
@@ -0,0 +1,230 @@
+import json
+
+import ckan.plugins.toolkit as toolkit
+import ckan.logic as logic
+
+from ckan.lib.redis import connect_to_redis
+from ckan.types import Context
+
+from ngsildclient import Entity
+
+from .cache import TTLCache
+from .mapping import MappingProfile, get_profile
+from .model import NgsildEntity
+from .ngsild_ckan_converter import EntityView, NgsildCkanConverter
+from .packages import content_hash
+from .utils import is_broker_failure
+
+from typing import Dict, List, Optional, Tuple, Union
+
+import logging
+
+log = logging.getLogger(__name__)
+
+CATALOGUE_CACHE_SIZE_CONFIG_OPTION = 'ckanext.harvest_ngsild.catalogue_cache_size'
+CATALOGUE_CACHE_TTL_CONFIG_OPTION = 'ckanext.harvest_ngsild.catalogue_cache_ttl'
+
+DEFAULT_CATALOGUE_CACHE_SIZE = 128
+DEFAULT_CATALOGUE_CACHE_TTL = 300
+
+REDIS_CATALOGUE_PREFIX = "ckanext-harvest_ngsild:catalogue:"
+REDIS_CATALOGUE_INDEX_PREFIX = "ckanext-harvest_ngsild:catalogue_index:"
+INDEX_MARKER_FIELD = ""
+
+_catalogues: Optional[TTLCache] = None
+
+
+class CatalogueIndex:
+    """Reverse index from dataset id to the id of the catalogue that contains it.
+
+    The index of each broker (and mapping profile) is kept in Redis, shared
+    by all the processes: a hash from dataset id to catalogue id, and a set
+    with the datasets of each catalogue. It is built on first use with a paged
+    query of the catalogues, rebuilt once it expires and kept up to date from
+    Catalogue notifications in between.
+    """
+
+    def __init__(self, converter: NgsildCkanConverter):
+        self.converter = converter
+        self.key = f"{REDIS_CATALOGUE_INDEX_PREFIX}{converter.broker.url}:{converter.profile.name}"
+
+    def _catalogue_key(self, catalog_id: str) -> str:
+        return f"{self.key}:{catalog_id}"
+
+    def build(self):
+        index = self.converter.build_catalog_index()
+        catalogues: Dict[str, List[str]] = {}
+        for dataset_id, catalog_id in index.items():
+            catalogues.setdefault(catalog_id, []).append(dataset_id)
+
+        ttl = max(_cache_ttl(), 1)
+        pipe = connect_to_redis().pipeline()
+        pipe.delete(self.key)
+        # The marker field keeps the index of a broker without datasets
+        pipe.hset(self.key, mapping={INDEX_MARKER_FIELD: 1} | index)
+        pipe.expire(self.key, ttl)
+        for catalog_id, dataset_ids in catalogues.items():
+            pipe.delete(self._catalogue_key(catalog_id))
+            pipe.sadd(self._catalogue_key(catalog_id), *dataset_ids)
+            pipe.expire(self._catalogue_key(catalog_id), ttl)
+        pipe.execute()
+
+    def get(self, dataset_id: str, default: Optional[str] = None) -> Optional[str]:
+        redis = connect_to_redis()
+        if not redis.exists(self.key):
+            self.build()
+        catalog_id = redis.hget(self.key, dataset_id)
+        if catalog_id is None:
+            return default
+        return catalog_id.decode("utf-8") if isinstance(catalog_id, bytes) else catalog_id
+
+    def update(self, catalog_id: str, dataset_ids: List[str]):
+        redis = connect_to_redis()
+        ttl = redis.ttl(self.key)
+        if ttl is None or ttl <= 0:
+            # Not built yet (or expired): the next lookup builds it from the broker
+            return
+        previous = {
+            id.decode("utf-8") if isinstance(id, bytes) else id
+            for id in redis.smembers(self._catalogue_key(catalog_id))
+        }
+        removed = previous - set(dataset_ids)
+
+        pipe = redis.pipeline()
+        if removed:
+            pipe.hdel(self.key, *removed)
+        pipe.delete(self._catalogue_key(catalog_id))
+        if dataset_ids:
+            pipe.hset(self.key, mapping={dataset_id: catalog_id for dataset_id in dataset_ids})
+            pipe.sadd(self._catalogue_key(catalog_id), *dataset_ids)
+            pipe.expire(self._catalogue_key(catalog_id), ttl)
+        pipe.execute()
+
+
+def _cache_ttl() -> int:
+    return toolkit.asint(toolkit.config.get(CATALOGUE_CACHE_TTL_CONFIG_OPTION, DEFAULT_CATALOGUE_CACHE_TTL))
+
+
+def _new_cache() -> TTLCache:
+    return TTLCache(
+        maxsize=toolkit.asint(
+            toolkit.config.get(CATALOGUE_CACHE_SIZE_CONFIG_OPTION, DEFAULT_CATALOGUE_CACHE_SIZE)
+        ),
+        ttl=_cache_ttl(),
+    )
+
+
+def _get_cache() -> TTLCache:
+    # Created on first use, once the CKAN configuration has been loaded
+    global _catalogues
+    if _catalogues is None:
+        _catalogues = _new_cache()
+    return _catalogues
+
+
+def get_catalog_index(converter: NgsildCkanConverter) -> CatalogueIndex:
+    """Return the dataset to catalogue reverse index of the broker, used by the converter from now on"""
+    converter.catalog_index = CatalogueIndex(converter)
+    return converter.catalog_index
+
+
+def is_catalogue(entity: Union[Entity, EntityView], profile: Optional[MappingProfile] = None) -> bool:
+    profile = profile or get_profile()
+    return profile.is_type("catalogue", EntityView.of(entity, profile.context).type)
+
+
+def _cache_key(converter: NgsildCkanConverter, catalog_id: str) -> tuple:
+    # The converted organization depends on the mapping profile of the converter
+    return (converter.broker.url, converter.profile.name, catalog_id)
+
+
+def _shared_key(key: tuple) -> str:
+    return REDIS_CATALOGUE_PREFIX + ":".join(key)
+
+
+def _get_shared(key: tuple) -> Optional[Tuple[EntityView, dict]]:
+    data = connect_to_redis().get(_shared_key(key))
+    if data is None:
+        return None
+    data = json.loads(data)
+    return EntityView.from_dict(data["catalogue"]), data["organization"]
+
+
+def _set_shared(key: tuple, cached: Tuple[EntityView, dict]):
+    catalog, organization = cached
+    connect_to_redis().set(
+        _shared_key(key),
+        json.dumps({"catalogue": catalog.to_dict(), "organization": organization}, default=str),
+        ex=max(_cache_ttl(), 1),
+    )
+
+
+def get_catalogue(converter: NgsildCkanConverter, catalog_id: str) -> Tuple[Optional[EntityView], dict, bool]:
+    """Return the Catalogue entity, its converted organization and whether it was just retrieved.
+
+    The catalogue is looked up in the cache of the process, then in the cache
+    shared by all the processes in Redis (background workers fork a new
+    process per job, so their process cache is always empty) and only then
+    retrieved from the broker. Broker failures are raised, as opposed to a
+    catalogue that cannot be retrieved (i.e. not found).
+    """
+    key = _cache_key(converter, catalog_id)
+    cached = _get_cache().get(key)
+    if cached is None:
+        cached = _get_shared(key)
+        if cached is not None:
+            _get_cache().set(key, cached)
+    if cached is not None:
+        return cached + (False,)
+
+    try:
+        catalog = converter._get_ngsild_entity(catalog_id)
+    except Exception as e:
+        # A failing broker is not a missing catalogue: the error reaches the circuit breaker
+        if is_broker_failure(e):
+            raise
+        log.error("Error retrieving catalogue %s from broker: %s", catalog_id, e)
+        return None, {}, False
+
+    return update_catalogue(converter, catalog) + (True,)
+
+
+def update_catalogue(converter: NgsildCkanConverter, catalog: Union[Entity, EntityView]) -> Tuple[EntityView, dict]:
+    """Store a Catalogue entity (i.e. received in a notification) in the caches"""
+    catalog = EntityView.of(catalog, converter.ctx)
+    cached = (catalog, converter.organization_from_catalog(catalog))
+    key = _cache_key(converter, catalog.id)
+    _get_cache().set(key, cached)
+    _set_shared(key, cached)
+
+    CatalogueIndex(converter).update(catalog.id, converter.get_dataset_ids(catalog))
+
+    return cached
+
+
+def invalidate_catalogue(converter: NgsildCkanConverter, catalog_id: str):
+    key = _cache_key(converter, catalog_id)
+    _get_cache().invalidate(key)
+    connect_to_redis().delete(_shared_key(key))
+
+
+def patch_organization(context: Context, organization: dict, profile: MappingProfile) -> bool:
+    """Patch the organization only if it changed since the last time it was written.
+
+    The organization must be converted from a notified or just retrieved
+    catalogue: a cached one can be older than the one last written. It is
+    indexed with the catalogue type of the profile it was converted with.
+    """
+    organization_hash = content_hash(organization)
+    index = NgsildEntity.get(organization["id"])
+    if index is not None and index.content_hash == organization_hash:
+        return False
+
+    logic.action.patch.organization_patch(context, organization)
+    NgsildEntity.upsert(
+        organization["id"],
+        profile.type_of("catalogue"),
+        organization_id=organization["id"],
+        content_hash=organization_hash,
+    )
+    return True
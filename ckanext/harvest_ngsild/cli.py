@@ -0,0 +1,135 @@
+import time
+
+import click
+
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+
+from .clients import get_client, get_converter
+from .deletions import PURGE_CHUNK_SIZE, purge_organization
+from .lanes import all_lanes, is_lanes_mode
+from .indexing import flush_dirty
+from .mapping import MappingProfileError, get_profile
+from .notifications import enqueue_due_jobs
+from .reconcile import DEFAULT_RECONCILE_BATCH_SIZE, reconcile_organization
+
+
+@click.group("harvest-ngsild", short_help="NGSI-LD harvesting commands")
+def harvest_ngsild():
+    pass
+
+
+@harvest_ngsild.command("flush-index")
+def flush_index():
+    """Index the packages written by notifications that are still waiting to be indexed.
+
+    Run it periodically (i.e. from cron) when deferred indexing is enabled, so
+    that packages are indexed even if no more notifications arrive.
+    """
+    count = flush_dirty(force=True)
+    click.secho(f"{count} packages indexed", fg="green")
+
+
+@harvest_ngsild.command("scheduler")
+@click.option("--interval", type=float, default=1, show_default=True, help="Seconds between two checks")
+@click.option("--once", is_flag=True, help="Enqueue the due jobs and exit")
+def scheduler(interval, once):
+    """Enqueue the delayed notification jobs once they are due.
+
+    Notifications delayed by the debounce window or by a busy lane wait in
+    Redis, as the CKAN worker runs no scheduler. Incoming notifications and
+    finished jobs enqueue the due ones too; keep this command running (or run
+    it with --once from cron) so they are enqueued when no notifications arrive.
+    """
+    while True:
+        count = enqueue_due_jobs()
+        if once:
+            click.secho(f"{count} jobs enqueued", fg="green")
+            return
+        time.sleep(interval)
+
+
+@harvest_ngsild.command("reconcile")
+@click.argument("organizations", nargs=-1, required=True)
+@click.option("--hostname", required=True, help="Context Broker hostname")
+@click.option("--port", required=True, help="Context Broker port")
+@click.option("--insecure", is_flag=True, help="Connect to the broker over HTTP")
+@click.option("--profile", default=None, help="Mapping profile of the subscription")
+@click.option("--batch-size", type=int, default=DEFAULT_RECONCILE_BATCH_SIZE, show_default=True,
+              help="Datasets compared and written per batch")
+@click.option("--no-delete", is_flag=True, help="Keep the packages of datasets no longer in the catalogue")
+@click.option("--dry-run", is_flag=True, help="Only report the changes")
+def reconcile(organizations, hostname, port, insecure, profile, batch_size, no_delete, dry_run):
+    """Fully synchronize organizations with their Catalogues in the Context Broker.
+
+    Catches up with the changes whose notifications were lost (i.e. while CKAN
+    was down). Run it periodically (i.e. from cron) for every subscribed
+    organization. ORGANIZATIONS are the names used in the subscriptions.
+    """
+    try:
+        get_profile(profile)
+    except MappingProfileError as e:
+        raise click.BadParameter(str(e), param_hint="--profile")
+
+    site_user = toolkit.get_action("get_site_user")({"ignore_auth": True}, {})
+    context = {
+        "model": model,
+        "session": model.Session,
+        "user": site_user["name"],
+        "auth_user_obj": model.User.get(site_user["name"]),
+    }
+    converter = get_converter(get_client(hostname, port, secure=not insecure), profile)
+
+    failed = False
+    for organization in organizations:
+        organization_id = "urn:ngsi-ld:Catalogue:" + organization
+        try:
+            counts = reconcile_organization(
+                context, converter, organization_id,
+                batch_size=batch_size, delete=not no_delete, dry_run=dry_run,
+            )
+        except Exception as e:
+            model.Session.rollback()
+            click.secho(f"{organization}: reconciliation failed: {e}", fg="red", err=True)
+            failed = True
+            continue
+        summary = ", ".join(f"{count} {result}" for result, count in counts.items())
+        click.secho(f"{organization}: {summary}{' (dry run)' if dry_run else ''}", fg="green")
+
+    if failed:
+        raise click.exceptions.Exit(1)
+
+
+@harvest_ngsild.command("purge-organization")
+@click.argument("organization")
+@click.option("--chunk-size", type=int, default=PURGE_CHUNK_SIZE, show_default=True,
+              help="Packages purged per database transaction")
+@click.confirmation_option(prompt="The organization and all its packages will be purged. Continue?")
+def purge_organization_command(organization, chunk_size):
+    """Purge an organization (name or id) and all its packages, i.e. a subscribed Catalogue."""
+    try:
+        count = purge_organization(organization, chunk_size)
+    except toolkit.ObjectNotFound:
+        raise click.BadParameter(f"Organization {organization} not found", param_hint="ORGANIZATION")
+    click.secho(f"Organization {organization} purged with {count} packages", fg="green")
+
+
+@harvest_ngsild.command("lanes")
+def lanes():
+    """List the broker lanes, their queues and their state.
+
+    In lanes mode, start a worker for each queue: ckan jobs worker <queue>
+    """
+    if not is_lanes_mode():
+        click.secho("Broker lanes are disabled, notifications share the notifications queue", fg="yellow")
+    for lane in all_lanes():
+        stats = lane.stats()
+        circuit = "open" if stats["circuit_open"] else "closed"
+        click.echo(
+            f"{lane.broker}\tqueue={lane.queue}\tbacklog={stats['backlog']}\t"
+            f"in_flight={stats['in_flight']}\tcircuit={circuit}\tfailures={stats['failures']}"
+        )
+
+
+def get_commands():
+    return [harvest_ngsild]
@@ -0,0 +1,159 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+from typing import Optional, Tuple
+
+import ckan.plugins.toolkit as toolkit
+
+from requests.adapters import HTTPAdapter
+
+from ngsildclient import Client
+
+from .ngsild_ckan_converter import (
+    NgsildCkanConverter,
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_MAX_WORKERS,
+)
+from .catalogues import get_catalog_index
+from .mapping import get_profile
+from .throttling import get_rate_limiter
+
+import logging
+
+log = logging.getLogger(__name__)
+
+BATCH_SIZE_CONFIG_OPTION = 'ckanext.harvest_ngsild.batch_size'
+MAX_WORKERS_CONFIG_OPTION = 'ckanext.harvest_ngsild.max_workers'
+RATE_LIMIT_CONFIG_OPTION = 'ckanext.harvest_ngsild.rate_limit'
+# Number of keep-alive connections kept per broker
+POOL_MAXSIZE_CONFIG_OPTION = 'ckanext.harvest_ngsild.pool_maxsize'
+# Seconds a broker client can be unused before its connections are closed
+CLIENT_IDLE_TIMEOUT_CONFIG_OPTION = 'ckanext.harvest_ngsild.client_idle_timeout'
+MAX_CLIENTS_CONFIG_OPTION = 'ckanext.harvest_ngsild.max_clients'
+
+DEFAULT_POOL_MAXSIZE = 10
+DEFAULT_CLIENT_IDLE_TIMEOUT = 300
+DEFAULT_MAX_CLIENTS = 32
+
+
+class _TrackingAdapter(HTTPAdapter):
+    """Connection pool of a broker client, tracking the requests sent through it"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.last_used = time.monotonic()
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def send(self, *args, **kwargs):
+        with self._lock:
+            self.in_flight += 1
+        try:
+            return super().send(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self.last_used = time.monotonic()
+
+
+class ClientRegistry:
+    """Process-wide registry of broker clients.
+
+    Clients are reused across requests, so their keep-alive HTTP sessions
+    (and TLS connections) are shared instead of being created for every
+    notification, subscription or unsubscription. Clients unused for longer
+    than the idle timeout, or the least recently used ones beyond the
+    maximum number of clients, are closed. A client is used until its last
+    request is answered, and is never closed while a request is in flight.
+    """
+
+    def __init__(self):
+        self.clients = OrderedDict()
+        self.adapters = {}
+        self.last_used = {}
+        self.lock = threading.Lock()
+
+    def get(self, hostname: str, port, secure: bool = True, custom_auth = None) -> Client:
+        key = (hostname, str(port), secure, custom_auth)
+        now = time.monotonic()
+
+        with self.lock:
+            self._evict(now, keep=key)
+            client = self.clients.get(key)
+            if client is None:
+                client, self.adapters[key] = self._create(hostname, port, secure, custom_auth)
+                self.clients[key] = client
+            self.clients.move_to_end(key)
+            self.last_used[key] = now
+            return client
+
+    def _create(self, hostname: str, port, secure: bool, custom_auth) -> Tuple[Client, _TrackingAdapter]:
+        log.debug("Creating client for broker %s:%s", hostname, port)
+        kwargs = {"custom_auth": custom_auth} if custom_auth else {}
+        client = Client(hostname = hostname, port = port, secure = secure, **kwargs)
+
+        pool_maxsize = toolkit.asint(
+            toolkit.config.get(POOL_MAXSIZE_CONFIG_OPTION, DEFAULT_POOL_MAXSIZE)
+        )
+        adapter = _TrackingAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        client.session.mount("https://", adapter)
+        client.session.mount("http://", adapter)
+        return client, adapter
+
+    def _evict(self, now: float, keep=None):
+        idle_timeout = toolkit.asint(
+            toolkit.config.get(CLIENT_IDLE_TIMEOUT_CONFIG_OPTION, DEFAULT_CLIENT_IDLE_TIMEOUT)
+        )
+        max_clients = toolkit.asint(
+            toolkit.config.get(MAX_CLIENTS_CONFIG_OPTION, DEFAULT_MAX_CLIENTS)
+        )
+        # Room for a new client is only needed if the requested one is not registered yet
+        room = 0 if keep in self.clients else 1
+        for key in list(self.clients):
+            adapter = self.adapters[key]
+            if key == keep or adapter.in_flight:
+                continue
+            idle = now - max(self.last_used[key], adapter.last_used)
+            if idle > idle_timeout or len(self.clients) + room > max_clients:
+                self._close(key)
+
+    def _close(self, key):
+        client = self.clients.pop(key)
+        self.adapters.pop(key, None)
+        self.last_used.pop(key, None)
+        log.debug("Closing client for broker %s:%s", key[0], key[1])
+        try:
+            client.session.close()
+        except Exception as e:
+            log.warning("Error closing client for broker %s:%s: %s", key[0], key[1], e)
+
+
+_registry = ClientRegistry()
+
+
+def get_client(hostname: str, port, secure: bool = True, custom_auth = None) -> Client:
+    return _registry.get(hostname, port, secure, custom_auth)
+
+
+def get_converter(broker: Client, profile: Optional[str] = None) -> NgsildCkanConverter:
+    batch_size = toolkit.asint(
+        toolkit.config.get(BATCH_SIZE_CONFIG_OPTION, DEFAULT_BATCH_SIZE)
+    )
+    max_workers = toolkit.asint(
+        toolkit.config.get(MAX_WORKERS_CONFIG_OPTION, DEFAULT_MAX_WORKERS)
+    )
+    # Maximum number of requests per second sent to each broker (0 means unlimited)
+    rate_limit = float(toolkit.config.get(RATE_LIMIT_CONFIG_OPTION, 0))
+    converter = NgsildCkanConverter(
+        broker,
+        batch_size=batch_size,
+        max_workers=max_workers,
+        rate_limiter=get_rate_limiter(broker.url, rate_limit) if rate_limit > 0 else None,
+        # Mapping profile selected by the subscription (the default one if None)
+        profile=get_profile(profile),
+    )
+    # The dataset to catalogue index is shared by all the converters of the broker
+    get_catalog_index(converter)
+    return converter
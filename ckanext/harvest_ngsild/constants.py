@@ -5,4 +5,9 @@ SDMDCAT = Namespace("https://smartdatamodels.org/dataModel.DCAT-AP/")
 NGSILD = Namespace("https://uri.etsi.org/ngsi-ld/")
 
 DEFAULT_NGSILD_CONTEXT = "https://uri.etsi.org/ngsi-ld/v1/ngsi-ld-core-context-v1.7.jsonld"
-SUBSCRIPTION_ID_PATTERN = "urn:ngsi-ld:Subscription:CKAN:"
\ No newline at end of file
+SDM_DCAT_AP_CONTEXT = "https://raw.githubusercontent.com/smart-data-models/dataModel.DCAT-AP/master/context.jsonld"
+SUBSCRIPTION_ID_PATTERN = "urn:ngsi-ld:Subscription:CKAN:"
+NGSILD_ENTITIES_ENDPOINT = "ngsi-ld/v1/entities"
+JSONLD_CONTEXT_REL = "http://www.w3.org/ns/json-ld#context"
+# Resource fields stored by CKAN as dates (isodate validator)
+RESOURCE_DATE_KEYS = ("created", "last_modified", "cache_last_updated")
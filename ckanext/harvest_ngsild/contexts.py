@@ -0,0 +1,126 @@
+import json
+import os
+
+from functools import lru_cache
+
+from .constants import DEFAULT_NGSILD_CONTEXT, SDM_DCAT_AP_CONTEXT
+
+from typing import Dict, List, Union
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# Subsets of the terms of the published JSON-LD contexts, shipped with the
+# extension. They are not the published documents, so they are keyed by their
+# own URNs and stand in for the published contexts: contexts are never fetched
+# (notifications are processed without any network I/O besides the broker)
+CONTEXTS_DIR = os.path.join(os.path.dirname(__file__), "contexts")
+CORE_CONTEXT_SUBSET = "urn:ckanext-harvest-ngsild:context:ngsi-ld-core-v1.7"
+SDM_DCAT_AP_CONTEXT_SUBSET = "urn:ckanext-harvest-ngsild:context:sdm-dcat-ap"
+LOCAL_CONTEXTS = {
+    CORE_CONTEXT_SUBSET: "ngsi-ld-core-v1.7-subset.jsonld",
+    SDM_DCAT_AP_CONTEXT_SUBSET: "sdm-dcat-ap-subset.jsonld",
+}
+CONTEXT_SUBSETS = {
+    DEFAULT_NGSILD_CONTEXT: CORE_CONTEXT_SUBSET,
+    SDM_DCAT_AP_CONTEXT: SDM_DCAT_AP_CONTEXT_SUBSET,
+}
+
+Context = Union[str, dict, list, None]
+
+
+@lru_cache(maxsize=None)
+def _load_local_context(urn: str) -> Union[dict, list, str, None]:
+    with open(os.path.join(CONTEXTS_DIR, LOCAL_CONTEXTS[urn]), encoding="utf-8") as f:
+        return json.load(f).get("@context")
+
+
+def _load_context(url: str) -> Union[dict, list, str, None]:
+    urn = CONTEXT_SUBSETS.get(url, url)
+    if urn not in LOCAL_CONTEXTS:
+        return None
+    return _load_local_context(urn)
+
+
+def context_key(ctx: Context) -> str:
+    # Hashable representation of a context (URL, inline object or list of both)
+    if ctx is None:
+        return DEFAULT_NGSILD_CONTEXT
+    if isinstance(ctx, str):
+        return ctx
+    return json.dumps(ctx, sort_keys=True)
+
+
+def _merge(terms: dict, ctx, seen: set, missing: list):
+    if ctx is None:
+        return
+    if isinstance(ctx, list):
+        for c in ctx:
+            _merge(terms, c, seen, missing)
+    elif isinstance(ctx, str):
+        if ctx not in seen:
+            seen.add(ctx)
+            loaded = _load_context(ctx)
+            if loaded is None:
+                missing.append(ctx)
+            _merge(terms, loaded, seen, missing)
+    elif isinstance(ctx, dict):
+        terms.update(ctx)
+
+
+def _parse_key(key: str) -> Context:
+    return json.loads(key) if key[:1] in ("[", "{") else key
+
+
+@lru_cache(maxsize=256)
+def _terms(key: str) -> Dict[str, Union[str, dict]]:
+    terms = {}
+    missing = []
+    _merge(terms, _parse_key(key), set(), missing)
+    if missing:
+        # Remote contexts are not fetched: their terms are left as they are
+        log.warning("JSON-LD contexts %s are not shipped with the extension, ignoring them", ", ".join(missing))
+    # The core context is always applied last, its terms cannot be overridden
+    _merge(terms, DEFAULT_NGSILD_CONTEXT, set(), [])
+    return terms
+
+
+def _term_id(definition) -> str:
+    return definition.get("@id") if isinstance(definition, dict) else definition
+
+
+def _resolve(term: str, terms: dict) -> str:
+    if term in terms:
+        iri = _term_id(terms[term])
+        # Term defined as a compact IRI (prefix:suffix) or as another term
+        return term if iri is None or iri == term else _resolve(iri, terms)
+
+    prefix, sep, suffix = term.partition(":")
+    if sep:
+        if suffix.startswith("//") or prefix not in terms:
+            # Absolute IRI (i.e. https://... or urn:...)
+            return term
+        return _resolve(prefix, terms) + suffix
+
+    vocab = terms.get("@vocab")
+    return vocab + term if vocab else term
+
+
+@lru_cache(maxsize=65536)
+def _expand(term: str, key: str) -> str:
+    if not term or term.startswith("@"):
+        return term
+    return _resolve(term, _terms(key))
+
+
+def missing_contexts(ctx: Context) -> List[str]:
+    """Remote contexts referenced by ctx that are not shipped with the extension"""
+    missing = []
+    _merge({}, ctx, set(), missing)
+    return missing
+
+
+def expand(term: str, ctx: Context = None) -> str:
+    """Expand an attribute name or entity type into its IRI, using only the shipped contexts"""
+    return _expand(term, context_key(ctx))
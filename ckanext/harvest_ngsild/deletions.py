@@ -0,0 +1,220 @@
+import sqlalchemy as sa
+
+import ckan.plugins.toolkit as toolkit
+import ckan.logic as logic
+import ckan.model as model
+
+from ckan.types import Context
+
+from . import metrics
+from .constants import SDMDCAT
+from .indexing import unindex_organization, unindex_packages, unmark_dirty
+from .model import NgsildBootstrap, NgsildEntity
+
+from typing import Iterable, List
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# What happens to the packages of the datasets deleted from the broker (or from their catalogue):
+# "delete": packages are soft-deleted (state=deleted) and can be restored from CKAN
+# "purge": packages are removed from the database
+# "none": packages are kept
+DELETION_MODE_CONFIG_OPTION = 'ckanext.harvest_ngsild.deletion_mode'
+
+DELETION_MODE_DELETE = "delete"
+DELETION_MODE_PURGE = "purge"
+DELETION_MODE_NONE = "none"
+DELETION_MODES = (DELETION_MODE_DELETE, DELETION_MODE_PURGE, DELETION_MODE_NONE)
+
+DEFAULT_DELETION_MODE = DELETION_MODE_DELETE
+
+# Notification trigger of deleted entities (NGSI-LD 1.6+)
+ENTITY_DELETED_TRIGGER = "entityDeleted"
+# Notification triggers requested by the subscriptions: the NGSI-LD defaults and the deleted entities
+NOTIFICATION_TRIGGERS = ["entityCreated", "attributeCreated", "attributeUpdated", ENTITY_DELETED_TRIGGER]
+
+# Number of packages purged in a single database transaction
+PURGE_CHUNK_SIZE = 1000
+
+
+def get_deletion_mode() -> str:
+    mode = toolkit.config.get(DELETION_MODE_CONFIG_OPTION, DEFAULT_DELETION_MODE)
+    if mode not in DELETION_MODES:
+        log.warning("Unexpected %s '%s', using '%s'", DELETION_MODE_CONFIG_OPTION, mode, DEFAULT_DELETION_MODE)
+        return DEFAULT_DELETION_MODE
+    return mode
+
+
+def is_deleted(entity: dict) -> bool:
+    # Deleted entities are notified with their id, type and deletedAt system attribute.
+    # The notifications endpoint marks the entities of entityDeleted notifications the same way
+    return "deletedAt" in entity
+
+
+def removed_datasets(organization_id: str, dataset_ids: Iterable[str]) -> List[str]:
+    """Datasets written for the organization that are no longer listed in its catalogue.
+
+    A single notification never removes the whole catalogue: if the dataset
+    list is empty, or none of the written datasets is in it, nothing is
+    removed (a full reconciliation still deletes them).
+    """
+    dataset_ids = set(dataset_ids)
+    written = [id for id, _, _ in NgsildEntity.iter_organization(organization_id, str(SDMDCAT["Dataset"]))]
+    removed = [id for id in written if id not in dataset_ids]
+    if removed and (not dataset_ids or len(removed) == len(written)):
+        log.warning("Catalogue %s no longer lists any of its %d datasets, not deleting them", organization_id, len(written))
+        return []
+    return removed
+
+
+def delete_datasets(context: Context, organization_id: str, dataset_ids: List[str], mode: str = None) -> List[str]:
+    """Soft-delete or purge the packages of deleted datasets, as a single batch.
+
+    Only the packages of the organization are deleted, in a single database
+    transaction. They leave the search index as a batch, with a single Solr
+    commit. Returns the ids of the datasets whose packages were deleted (or
+    no longer existed).
+    """
+    mode = mode or get_deletion_mode()
+    if mode == DELETION_MODE_NONE or not dataset_ids:
+        return []
+
+    index = {
+        id: e for id, e in NgsildEntity.get_many(dataset_ids).items()
+        if e.organization_id == organization_id
+    }
+    names = {e.package_name: id for id, e in index.items() if e.package_name}
+    packages = (
+        model.Session.query(model.Package.id, model.Package.name)
+        .filter(model.Package.name.in_(list(names)))
+        .filter(model.Package.owner_org == organization_id)
+        .all()
+    ) if names else []
+    # Datasets whose package is already gone only leave the entity index
+    existing = {name for _, name in packages}
+    deleted = [id for id, e in index.items() if e.package_name not in existing]
+
+    purge = mode == DELETION_MODE_PURGE
+    package_ids = []
+    try:
+        with metrics.stage("package_purge" if purge else "package_delete"):
+            (purge_packages if purge else soft_delete_packages)([id for id, _ in packages])
+            model.repo.commit()
+        package_ids = [id for id, _ in packages]
+        deleted += [names[name] for _, name in packages]
+    except Exception:
+        model.Session.rollback()
+        raise
+    finally:
+        unmark_dirty(package_ids)
+        unindex_packages(package_ids)
+        NgsildEntity.delete_many(deleted)
+
+    log.info("%d packages of organization %s %s", len(package_ids), organization_id, "purged" if purge else "deleted")
+    return deleted
+
+
+def soft_delete_packages(package_ids: List[str]):
+    """Soft-delete packages with a few bulk SQL updates, in the current transaction.
+
+    Changes the same rows as package_delete (the package state, its group
+    memberships and its collaborators), without loading the packages nor
+    sending one domain object notification per package. The search index is
+    not updated.
+    """
+    if not package_ids:
+        return
+    session = model.Session
+    session.execute(
+        model.package_table.update()
+        .where(model.package_table.c.id.in_(package_ids))
+        .values(state=model.State.DELETED)
+    )
+    session.execute(
+        model.member_table.update()
+        .where(sa.and_(
+            model.member_table.c.table_id.in_(package_ids),
+            model.member_table.c.state == model.State.ACTIVE,
+        ))
+        .values(state=model.State.DELETED)
+    )
+    session.execute(model.package_member_table.delete().where(model.package_member_table.c.package_id.in_(package_ids)))
+
+
+def purge_packages(package_ids: List[str]):
+    """Purge packages with a few bulk SQL deletes, in the current transaction.
+
+    Removes the same rows as dataset_purge (memberships, relationships and
+    the package with its resources, extras and tags), without loading the
+    packages nor sending one domain object notification per package. The
+    search index is not updated.
+    """
+    if not package_ids:
+        return
+    session = model.Session
+    resource_ids = sa.select(model.resource_table.c.id).where(model.resource_table.c.package_id.in_(package_ids))
+    session.execute(model.resource_view_table.delete().where(model.resource_view_table.c.resource_id.in_(resource_ids)))
+    for table in (model.resource_table, model.package_extra_table, model.package_tag_table, model.package_member_table):
+        session.execute(table.delete().where(table.c.package_id.in_(package_ids)))
+    session.execute(
+        model.member_table.delete().where(sa.and_(
+            model.member_table.c.table_name == "package",
+            model.member_table.c.table_id.in_(package_ids),
+        ))
+    )
+    session.execute(
+        model.package_relationship_table.delete().where(sa.or_(
+            model.package_relationship_table.c.subject_package_id.in_(package_ids),
+            model.package_relationship_table.c.object_package_id.in_(package_ids),
+        ))
+    )
+    # Followers of the packages are deleted by the database (ON DELETE CASCADE)
+    session.execute(model.package_table.delete().where(model.package_table.c.id.in_(package_ids)))
+
+
+def purge_organization(organization_id: str, chunk_size: int = PURGE_CHUNK_SIZE) -> int:
+    """Purge an organization and all its packages.
+
+    Packages are purged in chunked transactions, and removed from the search
+    index with a single query once all of them are gone. Returns the number
+    of purged packages.
+    """
+    organization = model.Group.get(organization_id)
+    if organization is None or not organization.is_organization:
+        raise logic.NotFound("Organization was not found")
+
+    purged = 0
+    try:
+        with metrics.stage("organization_purge", organization=organization.id):
+            while True:
+                # Purged packages leave the query, so the next chunk is always the first one
+                package_ids = [
+                    id for id, in model.Session.query(model.Package.id)
+                    .filter(model.Package.owner_org == organization.id)
+                    .limit(chunk_size)
+                ]
+                if not package_ids:
+                    break
+                purge_packages(package_ids)
+                model.repo.commit()
+                unmark_dirty(package_ids)
+                purged += len(package_ids)
+                log.debug("Organization %s: %d packages purged", organization.id, purged)
+    except Exception:
+        model.Session.rollback()
+        raise
+    finally:
+        # Even after an error, the purged packages must leave the search index
+        if purged:
+            unindex_organization(organization.id)
+
+    NgsildEntity.delete_organization(organization.id, commit=False)
+    model.Session.query(NgsildBootstrap).filter(NgsildBootstrap.organization_id == organization.id).delete(synchronize_session=False)
+    model.repo.commit()
+
+    # purge actions can only be done by ckan_admin
+    logic.action.delete.organization_purge({"model": model, "user": "ckan_admin"}, {"id": organization.id})
+    log.info("Organization %s purged with %d packages", organization.id, purged)
+    return purged
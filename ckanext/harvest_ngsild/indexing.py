@@ -0,0 +1,204 @@
+import threading
+import time
+import uuid
+
+from contextlib import contextmanager
+
+import ckan.plugins.toolkit as toolkit
+import ckan.lib.search as search
+import ckan.model as model
+
+from ckan.lib.redis import connect_to_redis
+from ckan.lib.search.common import make_connection
+from redis.exceptions import ResponseError
+
+from . import metrics
+
+from typing import Iterable, Iterator, List, Set
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# Packages written by notifications processed in the background are indexed in batches
+DEFERRED_INDEXING_CONFIG_OPTION = 'ckanext.harvest_ngsild.deferred_indexing'
+INDEX_BATCH_SIZE_CONFIG_OPTION = 'ckanext.harvest_ngsild.index_batch_size'
+# Maximum number of seconds a written package waits to be indexed
+INDEX_FLUSH_INTERVAL_CONFIG_OPTION = 'ckanext.harvest_ngsild.index_flush_interval'
+
+DEFAULT_INDEX_BATCH_SIZE = 100
+DEFAULT_INDEX_FLUSH_INTERVAL = 30
+
+# Maximum number of ids in a single Solr delete query (below the default maxBooleanClauses)
+DELETE_QUERY_CHUNK_SIZE = 500
+
+REDIS_DIRTY_KEY = "ckanext-harvest_ngsild:dirty_packages"
+REDIS_DIRTY_SINCE_KEY = "ckanext-harvest_ngsild:dirty_packages_since"
+# Flag in the info of a database session whose packages are not indexed on commit
+SUSPENDED_INDEXING_KEY = "ckanext-harvest_ngsild:suspended_indexing"
+
+_lock = threading.Lock()
+
+
+def _guard_synchronous_search():
+    # CKAN indexes every package written into the database when the session is
+    # committed (synchronous_search plugin), and has no setting to turn it off.
+    # Its notifications are skipped for the sessions where indexing is suspended
+    with _lock:
+        plugin = search.SynchronousSearchPlugin
+        if getattr(plugin.notify, "guarded", False):
+            return
+        notify = plugin.notify
+
+        def guarded_notify(self, entity, operation):
+            if model.Session.info.get(SUSPENDED_INDEXING_KEY):
+                return
+            return notify(self, entity, operation)
+
+        guarded_notify.guarded = True
+        plugin.notify = guarded_notify
+
+
+@contextmanager
+def suspended_indexing():
+    """Suspend the search indexing of the packages written in the block.
+
+    Only the database session of the current thread is affected, so other
+    requests keep indexing their packages. The packages written in the block
+    are not indexed at all: they must be indexed afterwards (i.e. with
+    index_packages or mark_dirty).
+    """
+    _guard_synchronous_search()
+    info = model.Session.info
+    suspended = info.get(SUSPENDED_INDEXING_KEY, False)
+    info[SUSPENDED_INDEXING_KEY] = True
+    try:
+        yield
+    finally:
+        model.Session.info[SUSPENDED_INDEXING_KEY] = suspended
+
+
+@contextmanager
+def deferred_indexing() -> Iterator[Set[str]]:
+    """Index the written packages in a single batch (and a single Solr commit) on exit.
+
+    Yields a set where the ids of the written packages must be added. They
+    are not indexed as they are committed in the block (see suspended_indexing).
+    """
+    package_ids = set()
+    try:
+        with suspended_indexing():
+            yield package_ids
+    finally:
+        index_packages(package_ids)
+
+
+def enqueue_indexing(package_ids: Iterable[str]):
+    """Index the packages in a batch from a background job, i.e. from a web request"""
+    package_ids = list(package_ids)
+    if package_ids:
+        toolkit.enqueue_job(index_packages, [package_ids], title=f"Index {len(package_ids)} NGSI-LD packages")
+
+
+def is_deferred_mode() -> bool:
+    return toolkit.asbool(toolkit.config.get(DEFERRED_INDEXING_CONFIG_OPTION, False))
+
+
+def mark_dirty(package_ids: Iterable[str]):
+    """Queue packages written by notifications to be indexed in the next batch"""
+    package_ids = list(package_ids)
+    if not package_ids:
+        return
+    redis = connect_to_redis()
+    pipe = redis.pipeline()
+    pipe.sadd(REDIS_DIRTY_KEY, *package_ids)
+    pipe.set(REDIS_DIRTY_SINCE_KEY, time.time(), nx=True)
+    pipe.execute()
+
+
+def unmark_dirty(package_ids: Iterable[str]):
+    """Remove deleted packages from the queue, they can no longer be indexed"""
+    package_ids = list(package_ids)
+    if package_ids:
+        connect_to_redis().srem(REDIS_DIRTY_KEY, *package_ids)
+
+
+def flush_dirty(force: bool = False) -> int:
+    """Index the queued packages once there are enough of them or the oldest one waited too long.
+
+    Repeated updates of the same package are coalesced in a single indexing.
+    Returns the number of indexed packages.
+    """
+    redis = connect_to_redis()
+    count = redis.scard(REDIS_DIRTY_KEY)
+    if not count:
+        return 0
+
+    batch_size = toolkit.asint(toolkit.config.get(INDEX_BATCH_SIZE_CONFIG_OPTION, DEFAULT_INDEX_BATCH_SIZE))
+    interval = toolkit.asint(toolkit.config.get(INDEX_FLUSH_INTERVAL_CONFIG_OPTION, DEFAULT_INDEX_FLUSH_INTERVAL))
+    since = float(redis.get(REDIS_DIRTY_SINCE_KEY) or 0)
+    if not force and count < batch_size and time.time() - since < interval:
+        return 0
+
+    # Take the current batch atomically, new dirty packages go to a new batch
+    flushing_key = f"{REDIS_DIRTY_KEY}:{uuid.uuid4()}"
+    try:
+        redis.rename(REDIS_DIRTY_KEY, flushing_key)
+    except ResponseError:
+        # Already taken by another worker
+        return 0
+    redis.delete(REDIS_DIRTY_SINCE_KEY)
+
+    package_ids = [
+        id.decode("utf-8") if isinstance(id, bytes) else id
+        for id in redis.smembers(flushing_key)
+    ]
+    try:
+        index_packages(package_ids)
+    except Exception:
+        # Keep them for the next batch
+        mark_dirty(package_ids)
+        raise
+    finally:
+        redis.delete(flushing_key)
+
+    return len(package_ids)
+
+
+def index_packages(package_ids: Iterable[str]):
+    package_ids = list(package_ids)
+    if not package_ids:
+        return
+    log.debug("Indexing %d packages", len(package_ids))
+    with metrics.stage("indexing"):
+        search.rebuild(package_ids=package_ids, defer_commit=True)
+        search.commit()
+
+
+def _quote(value: str) -> str:
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def unindex_organization(organization_id: str):
+    """Remove all the packages of an organization from the search index with a single query"""
+    site_id = toolkit.config.get("ckan.site_id")
+    with metrics.stage("unindexing"):
+        make_connection().delete(
+            q=f"+site_id:{_quote(site_id)} +entity_type:package +owner_org:{_quote(organization_id)}",
+            commit=False,
+        )
+        search.commit()
+
+
+def unindex_packages(package_ids: List[str]):
+    """Remove packages from the search index with delete-by-id queries and a single Solr commit"""
+    if not package_ids:
+        return
+    log.debug("Removing %d packages from the search index", len(package_ids))
+    site_id = toolkit.config.get("ckan.site_id")
+    conn = make_connection()
+    with metrics.stage("unindexing"):
+        for i in range(0, len(package_ids), DELETE_QUERY_CHUNK_SIZE):
+            ids = " OR ".join(_quote(id) for id in package_ids[i:i + DELETE_QUERY_CHUNK_SIZE])
+            conn.delete(q=f"+site_id:{_quote(site_id)} +entity_type:package +id:({ids})", commit=False)
+        search.commit()
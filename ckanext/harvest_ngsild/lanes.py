@@ -0,0 +1,194 @@
+import re
+import time
+import uuid
+
+from contextlib import contextmanager
+
+import ckan.plugins.toolkit as toolkit
+import ckan.lib.jobs as jobs
+
+from ckan.lib.redis import connect_to_redis
+
+from . import metrics
+from .utils import is_broker_failure
+
+from typing import Dict, Iterator, List
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# Notifications of each broker are queued in their own jobs queue ("ngsild-<hostname>-<port>"),
+# so a slow broker only delays its own notifications. Every lane needs a worker:
+# `ckan jobs worker ngsild-<hostname>-<port>` (see `ckan harvest-ngsild lanes`)
+BROKER_LANES_CONFIG_OPTION = 'ckanext.harvest_ngsild.broker_lanes'
+# Maximum number of notifications of the same broker processed at the same time, across processes
+LANE_CONCURRENCY_CONFIG_OPTION = 'ckanext.harvest_ngsild.lane_concurrency'
+# Consecutive broker failures that open the circuit of a lane, and seconds it stays open
+CIRCUIT_BREAKER_THRESHOLD_CONFIG_OPTION = 'ckanext.harvest_ngsild.circuit_breaker_threshold'
+CIRCUIT_BREAKER_RESET_CONFIG_OPTION = 'ckanext.harvest_ngsild.circuit_breaker_reset'
+
+DEFAULT_LANE_CONCURRENCY = 0
+DEFAULT_CIRCUIT_BREAKER_THRESHOLD = 5
+DEFAULT_CIRCUIT_BREAKER_RESET = 60
+
+# Seconds a lane slot is held at most (i.e. by a worker that crashed while processing)
+SLOT_LEASE = 600
+# Seconds before a job rejected because its lane was full is enqueued again
+BUSY_RETRY_DELAY = 1
+
+QUEUE_PREFIX = "ngsild-"
+REDIS_LANE_PREFIX = "ckanext-harvest_ngsild:lane:"
+REDIS_LANES_KEY = REDIS_LANE_PREFIX + "all"
+
+# Take a slot if there are less holders than the limit, after dropping the expired ones
+_ACQUIRE_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', tonumber(ARGV[1]) - tonumber(ARGV[3]))
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call('ZADD', KEYS[1], ARGV[1], ARGV[4])
+    return 1
+end
+return 0
+"""
+
+
+class LaneBusy(Exception):
+    pass
+
+
+class CircuitOpen(Exception):
+
+    def __init__(self, broker: str, retry_after: float):
+        super().__init__(f"Circuit of broker {broker} open, retry in {retry_after:.0f} seconds")
+        self.retry_after = retry_after
+
+
+def is_lanes_mode() -> bool:
+    return toolkit.asbool(toolkit.config.get(BROKER_LANES_CONFIG_OPTION, False))
+
+
+class Lane:
+    """Processing lane of the notifications of a broker.
+
+    Its concurrency limit and circuit breaker are kept in Redis, so they hold
+    for all the web and worker processes.
+    """
+
+    def __init__(self, hostname: str, port):
+        self.broker = f"{hostname}:{port}"
+        self.key = REDIS_LANE_PREFIX + self.broker
+
+    @property
+    def queue(self) -> str:
+        return QUEUE_PREFIX + re.sub(r"[^A-Za-z0-9_.-]", "-", self.broker)
+
+    def register(self):
+        connect_to_redis().sadd(REDIS_LANES_KEY, self.broker)
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        limit = toolkit.asint(toolkit.config.get(LANE_CONCURRENCY_CONFIG_OPTION, DEFAULT_LANE_CONCURRENCY))
+        if limit <= 0:
+            yield
+            return
+
+        redis = connect_to_redis()
+        token = str(uuid.uuid4())
+        if not redis.eval(_ACQUIRE_SCRIPT, 1, self.key + ":slots", time.time(), limit, SLOT_LEASE, token):
+            raise LaneBusy(f"Lane of broker {self.broker} is busy")
+        try:
+            yield
+        finally:
+            redis.zrem(self.key + ":slots", token)
+
+    def retry_after(self) -> float:
+        open_until = float(connect_to_redis().get(self.key + ":open_until") or 0)
+        return max(open_until - time.time(), 0)
+
+    def is_open(self) -> bool:
+        return self.retry_after() > 0
+
+    def allow(self) -> bool:
+        """Whether a notification can be processed, taking the single trial of a half-open circuit"""
+        redis = connect_to_redis()
+        open_until = float(redis.get(self.key + ":open_until") or 0)
+        if not open_until:
+            return True
+        if time.time() < open_until:
+            return False
+        # Half-open: a single notification is let through to check the broker again
+        reset = toolkit.asint(toolkit.config.get(CIRCUIT_BREAKER_RESET_CONFIG_OPTION, DEFAULT_CIRCUIT_BREAKER_RESET))
+        return bool(redis.set(self.key + ":probe", 1, nx=True, ex=max(reset, 1)))
+
+    def record_success(self):
+        connect_to_redis().delete(self.key + ":failures", self.key + ":open_until", self.key + ":probe")
+
+    def record_failure(self):
+        threshold = toolkit.asint(
+            toolkit.config.get(CIRCUIT_BREAKER_THRESHOLD_CONFIG_OPTION, DEFAULT_CIRCUIT_BREAKER_THRESHOLD)
+        )
+        if threshold <= 0:
+            return
+        redis = connect_to_redis()
+        failures = redis.incr(self.key + ":failures")
+        if failures >= threshold:
+            reset = toolkit.asint(toolkit.config.get(CIRCUIT_BREAKER_RESET_CONFIG_OPTION, DEFAULT_CIRCUIT_BREAKER_RESET))
+            log.warning("Broker %s failed %d times in a row, opening its circuit for %d seconds", self.broker, failures, reset)
+            pipe = redis.pipeline()
+            pipe.set(self.key + ":open_until", time.time() + reset)
+            pipe.delete(self.key + ":probe")
+            pipe.execute()
+
+    @contextmanager
+    def guard(self) -> Iterator[None]:
+        """Process a notification in the lane.
+
+        Raises LaneBusy if the lane is full and CircuitOpen if the broker is
+        failing. Broker failures in the block count towards opening the circuit.
+        """
+        with self.slot():
+            if not self.allow():
+                raise CircuitOpen(self.broker, self.retry_after())
+            try:
+                yield
+            except Exception as e:
+                if is_broker_failure(e):
+                    self.record_failure()
+                raise
+            self.record_success()
+
+    def stats(self) -> Dict[str, float]:
+        redis = connect_to_redis()
+        redis.zremrangebyscore(self.key + ":slots", "-inf", time.time() - SLOT_LEASE)
+        return {
+            "backlog": len(jobs.get_queue(self.queue)) if is_lanes_mode() else 0,
+            "in_flight": redis.zcard(self.key + ":slots"),
+            "circuit_open": 1 if self.is_open() else 0,
+            "failures": int(redis.get(self.key + ":failures") or 0),
+        }
+
+
+def get_lane(hostname: str, port) -> Lane:
+    return Lane(hostname, port)
+
+
+def all_lanes() -> List[Lane]:
+    lanes = []
+    for broker in sorted(connect_to_redis().smembers(REDIS_LANES_KEY)):
+        broker = broker.decode("utf-8") if isinstance(broker, bytes) else broker
+        hostname, _, port = broker.rpartition(":")
+        lanes.append(Lane(hostname, port))
+    return lanes
+
+
+def lane_stats() -> Dict[str, Dict[str, float]]:
+    return {lane.broker: lane.stats() for lane in all_lanes()}
+
+
+def lane_gauges() -> Dict[str, float]:
+    # Per-lane figures exposed by the metrics endpoint (lane_backlog, lane_in_flight, ...)
+    return {
+        metrics.sample("lane_" + name, broker=broker): value
+        for broker, stats in lane_stats().items()
+        for name, value in stats.items()
+    }
@@ -0,0 +1,201 @@
+import json
+import os
+
+from .constants import DEFAULT_NGSILD_CONTEXT
+from .contexts import expand, missing_contexts
+
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# Directory of the mapping profiles shipped with the extension
+PROFILES_DIR = os.path.join(os.path.dirname(__file__), "profiles")
+DEFAULT_PROFILE = "dcat-ap-sdm"
+
+ENTITY_KINDS = ("catalogue", "dataset", "distribution")
+# Attributes linking the entities (and the ones not mapped one-to-one)
+LINK_ATTRIBUTES = ("dataset", "distribution", "publisher", "keyword")
+MAPPINGS = ("organization", "package", "resource")
+
+
+class MappingProfileError(ValueError):
+    pass
+
+
+class MappingPlan(NamedTuple):
+    # (target group or None, target key, candidate source attributes, list separator)
+    entries: Tuple[Tuple[Optional[str], str, Tuple[str, ...], str], ...]
+    # Target groups (i.e. "extras") converted into lists of {"key", "value"} dicts
+    groups: Tuple[str, ...]
+
+
+def compile_mapping(mapping: dict, expand_term: Optional[Callable[[str], str]] = None) -> MappingPlan:
+    # Parse a CKAN <- NGSI-LD mapping ({"<group>:<key>" or "<key>": source or [sources]})
+    # once, so that the conversion of every entity just walks a flat plan.
+    # Source attribute names are expanded into IRIs, as the attributes of the entities
+    entries = []
+    groups = []
+    for target, sources in mapping.items():
+        group, _, key = target.rpartition(":")
+        if group and group not in groups:
+            groups.append(group)
+        sources = tuple(sources) if isinstance(sources, list) else (sources,)
+        if expand_term:
+            sources = tuple(expand_term(source) for source in sources)
+        # Arrays are converted into a long string by separating the items by commas.
+        # Exceptions: "notes" and "descriptions" fields, these will separate the items with two line breaks (markdown)
+        #             to make them easy to read in the CKAN web interface.
+        separator = "\n\n" if key in ("notes", "description") else ","
+        entries.append((group or None, key, sources, separator))
+    return MappingPlan(tuple(entries), tuple(groups))
+
+
+class MappingProfile(NamedTuple):
+    """Compiled NGSI-LD data model to CKAN mapping"""
+
+    name: str
+    description: str
+    # JSON-LD context used to retrieve the entities, so attribute names match the mappings
+    context: str
+    # Accepted entity types of each kind, the first one is used in broker queries
+    types: Dict[str, Tuple[str, ...]]
+    attributes: Dict[str, str]
+    organization: MappingPlan
+    package: MappingPlan
+    resource: MappingPlan
+
+    def type_of(self, kind: str) -> str:
+        return self.types[kind][0]
+
+    def is_type(self, kind: str, type: str) -> bool:
+        return type in self.types[kind]
+
+
+def _validate_mapping(name: str, section: str, mapping) -> dict:
+    if not isinstance(mapping, dict):
+        raise MappingProfileError(f"Profile {name}: '{section}' must be an object")
+    for target, sources in mapping.items():
+        if not target or target.count(":") > 1:
+            raise MappingProfileError(f"Profile {name}: invalid target '{target}' in '{section}', expecting '<key>' or '<group>:<key>'")
+        if isinstance(sources, list):
+            if not all(isinstance(s, str) for s in sources):
+                raise MappingProfileError(f"Profile {name}: sources of '{section}.{target}' must be strings")
+        elif not isinstance(sources, str):
+            raise MappingProfileError(f"Profile {name}: source of '{section}.{target}' must be a string or a list of strings")
+    return mapping
+
+
+def parse_profile(data: dict, source: str = "<string>") -> MappingProfile:
+    """Validate a mapping profile definition and compile its mappings"""
+    if not isinstance(data, dict):
+        raise MappingProfileError(f"Mapping profile {source} must be a JSON object")
+
+    name = data.get("name")
+    if not name or not isinstance(name, str):
+        raise MappingProfileError(f"Mapping profile {source} has no name")
+
+    types = data.get("types", {})
+    missing = [k for k in ENTITY_KINDS if not types.get(k)]
+    if missing:
+        raise MappingProfileError(f"Profile {name}: missing entity types for {', '.join(missing)}")
+    # Types and attribute names are compared in their expanded form, resolved
+    # with the context of the profile
+    context = data.get("context", DEFAULT_NGSILD_CONTEXT)
+    missing = missing_contexts(context)
+    if missing:
+        raise MappingProfileError(f"Profile {name}: JSON-LD contexts {', '.join(missing)} are not shipped with the extension")
+
+    def expand_term(term: str) -> str:
+        return expand(term, context)
+
+    types = {
+        k: tuple(expand_term(t) for t in (types[k] if isinstance(types[k], list) else [types[k]]))
+        for k in ENTITY_KINDS
+    }
+
+    attributes = data.get("attributes", {})
+    missing = [a for a in LINK_ATTRIBUTES if not isinstance(attributes.get(a), str)]
+    if missing:
+        raise MappingProfileError(f"Profile {name}: missing attributes {', '.join(missing)}")
+
+    mappings = {
+        section: compile_mapping(_validate_mapping(name, section, data.get(section)), expand_term)
+        for section in MAPPINGS
+    }
+
+    return MappingProfile(
+        name=name,
+        description=data.get("description", ""),
+        context=context,
+        types=types,
+        attributes={a: expand_term(attributes[a]) for a in LINK_ATTRIBUTES},
+        **mappings,
+    )
+
+
+def load_profile(path: str) -> MappingProfile:
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        raise MappingProfileError(f"Error reading mapping profile {path}: {e}")
+    return parse_profile(data, path)
+
+
+class ProfileRegistry:
+    """Mapping profiles available to the subscriptions, parsed once at plugin load"""
+
+    def __init__(self):
+        self.profiles: Dict[str, MappingProfile] = {}
+        self.default = DEFAULT_PROFILE
+
+    def load(self, paths: Iterable[str] = (), default: Optional[str] = None):
+        builtin = sorted(
+            os.path.join(PROFILES_DIR, f)
+            for f in os.listdir(PROFILES_DIR)
+            if f.endswith(".json")
+        )
+        profiles = {}
+        # Custom profiles override the built-in ones with the same name
+        for path in builtin + list(paths):
+            profile = load_profile(path)
+            profiles[profile.name] = profile
+            log.debug("Mapping profile %s loaded from %s", profile.name, path)
+
+        default = default or DEFAULT_PROFILE
+        if default not in profiles:
+            raise MappingProfileError(f"Default mapping profile {default} not found")
+
+        self.profiles = profiles
+        self.default = default
+
+    def get(self, name: Optional[str] = None) -> MappingProfile:
+        if not self.profiles:
+            self.load()
+        name = name or self.default
+        try:
+            return self.profiles[name]
+        except KeyError:
+            raise MappingProfileError(f"Unknown mapping profile {name}")
+
+    def names(self) -> List[str]:
+        if not self.profiles:
+            self.load()
+        return sorted(self.profiles)
+
+
+_registry = ProfileRegistry()
+
+
+def load_profiles(paths: Iterable[str] = (), default: Optional[str] = None):
+    _registry.load(paths, default)
+
+
+def get_profile(name: Optional[str] = None) -> MappingProfile:
+    return _registry.get(name)
+
+
+def profile_names() -> List[str]:
+    return _registry.names()
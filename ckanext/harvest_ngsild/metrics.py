@@ -0,0 +1,196 @@
+import re
+import threading
+import time
+
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+from ckan.lib.redis import connect_to_redis
+
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# Metrics are aggregated in each process and added up in Redis, so the web
+# and the background worker processes are exposed together
+REDIS_METRICS_KEY = "ckanext-harvest_ngsild:metrics"
+# Maximum seconds the metrics of a process are kept before being flushed to Redis
+FLUSH_INTERVAL = 5
+
+PREFIX = "ckanext_harvest_ngsild_"
+
+COUNTER = "counter"
+HISTOGRAM = "histogram"
+
+# Latency buckets (in seconds)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+METRICS = {
+    "notifications_received_total": (COUNTER, "Entities received in notifications"),
+    "notifications_collapsed_total": (COUNTER, "Pending notifications of an entity replaced by a newer one in its debounce window"),
+    "entities_total": (COUNTER, "Notified entities by result (created, updated, recreated, unchanged, deleted, ignored, failed)"),
+    "notification_duration_seconds": (HISTOGRAM, "Time to process a notification"),
+    "stage_duration_seconds": (HISTOGRAM, "Time spent in each stage of the ingestion pipeline"),
+    "broker_request_duration_seconds": (HISTOGRAM, "Time of the requests sent to the Context Brokers"),
+    "lane_wait_seconds": (HISTOGRAM, "Time notifications wait in the queue of their broker lane"),
+    "lane_rejected_total": (COUNTER, "Notifications rejected by their broker lane by reason (busy, circuit_open)"),
+}
+
+
+def _labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in sorted(labels.items())
+    )
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if value == int(value) else repr(value)
+
+
+_LE = re.compile(r',?le="([^"]*)"')
+_SUFFIXES = ("_bucket", "_sum", "_count")
+
+
+def _sort_key(sample: str) -> tuple:
+    # Samples of the same label set together, and histogram buckets in increasing order
+    name, _, labels = sample.partition("{")
+    le = _LE.search(labels)
+    suffix = next((i for i, s in enumerate(_SUFFIXES) if name.endswith(s)), -1)
+    return (
+        _LE.sub("", labels).rstrip("}"),
+        suffix,
+        float("inf") if le is None or le.group(1) == "+Inf" else float(le.group(1)),
+    )
+
+
+class MetricsRegistry:
+    """Counters and latency histograms buffered in the process and flushed to Redis"""
+
+    def __init__(self):
+        self.values: Dict[str, float] = {}
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _add(self, updates: List[Tuple[str, float]]):
+        with self.lock:
+            for sample, value in updates:
+                self.values[sample] = self.values.get(sample, 0) + value
+            due = time.monotonic() - self.last_flush > FLUSH_INTERVAL
+        if due:
+            self.flush()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        self._add([(name + _labels(labels), value)])
+
+    def observe(self, name: str, seconds: float, **labels):
+        # Cumulative buckets, as in the text exposition format. Every bucket is
+        # written, so the buckets below the observed values are exposed as 0
+        updates = [
+            (name + "_bucket" + _labels(dict(labels, le=_format_value(le))), 1 if seconds <= le else 0)
+            for le in BUCKETS
+        ]
+        updates += [
+            (name + "_bucket" + _labels(dict(labels, le="+Inf")), 1),
+            (name + "_sum" + _labels(labels), seconds),
+            (name + "_count" + _labels(labels), 1),
+        ]
+        self._add(updates)
+
+    def flush(self):
+        with self.lock:
+            values, self.values = self.values, {}
+            self.last_flush = time.monotonic()
+        if not values:
+            return
+        try:
+            pipe = connect_to_redis().pipeline()
+            for sample, value in values.items():
+                pipe.hincrbyfloat(REDIS_METRICS_KEY, sample, value)
+            pipe.execute()
+        except Exception as e:
+            # Metrics must never break the ingestion
+            log.warning("Error flushing %d metric samples: %s", len(values), e)
+
+    def samples(self) -> Dict[str, float]:
+        self.flush()
+        return {
+            k.decode("utf-8") if isinstance(k, bytes) else k: float(v)
+            for k, v in connect_to_redis().hgetall(REDIS_METRICS_KEY).items()
+        }
+
+
+_registry = MetricsRegistry()
+
+
+def inc(name: str, value: float = 1, **labels):
+    _registry.inc(name, value, **labels)
+
+
+def observe(name: str, seconds: float, **labels):
+    _registry.observe(name, seconds, **labels)
+
+
+@contextmanager
+def timer(name: str, **labels) -> Iterator[None]:
+    """Observe the time spent in the block, even if it raises"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _registry.observe(name, time.perf_counter() - start, **labels)
+
+
+def stage(stage: str, **labels):
+    return timer("stage_duration_seconds", stage=stage, **labels)
+
+
+def flush():
+    _registry.flush()
+
+
+def broker_label(url: str) -> str:
+    """Value of the broker label, "<hostname>:<port>" as in the lanes, from the URL of a broker"""
+    return urlsplit(url).netloc or url
+
+
+def sample(name: str, **labels) -> str:
+    """Name of a sample with labels, i.e. for the gauges passed to render()"""
+    return name + _labels(labels)
+
+
+def render(extra: Optional[Dict[str, float]] = None) -> str:
+    """Metrics in the Prometheus text exposition format.
+
+    `extra` adds gauges computed at scrape time (i.e. the lane gauges),
+    whose sample names can carry labels (see sample()).
+    """
+    samples = _registry.samples()
+    lines = []
+    for name, (metric_type, description) in METRICS.items():
+        metric_samples = sorted(
+            (
+                (k, v) for k, v in samples.items()
+                if k.partition("{")[0] in (name,) + tuple(name + s for s in _SUFFIXES)
+            ),
+            key=lambda sample: _sort_key(sample[0]),
+        )
+        if not metric_samples:
+            continue
+        lines.append(f"# HELP {PREFIX}{name} {description}")
+        lines.append(f"# TYPE {PREFIX}{name} {metric_type}")
+        lines.extend(f"{PREFIX}{k} {_format_value(v)}" for k, v in metric_samples)
+
+    gauges: Dict[str, List[Tuple[str, float]]] = {}
+    for k, v in sorted((extra or {}).items()):
+        gauges.setdefault(k.partition("{")[0], []).append((k, v))
+    for name, gauge_samples in gauges.items():
+        lines.append(f"# TYPE {PREFIX}{name} gauge")
+        lines.extend(f"{PREFIX}{k} {_format_value(v)}" for k, v in gauge_samples)
+
+    return "\n".join(lines) + "\n"
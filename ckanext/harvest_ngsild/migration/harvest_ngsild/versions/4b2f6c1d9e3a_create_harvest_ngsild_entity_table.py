@@ -0,0 +1,33 @@
+"""Create harvest_ngsild_entity table
+
+Revision ID: 4b2f6c1d9e3a
+Revises:
+Create Date: 2026-10-17 10:12:31.402911
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "4b2f6c1d9e3a"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "harvest_ngsild_entity",
+        sa.Column("id", sa.UnicodeText, primary_key=True),
+        sa.Column("type", sa.UnicodeText, nullable=False),
+        sa.Column("organization_id", sa.UnicodeText, index=True),
+        sa.Column("package_name", sa.UnicodeText),
+        sa.Column("modified_at", sa.UnicodeText),
+        sa.Column("content_hash", sa.UnicodeText),
+        sa.Column("updated", sa.DateTime, nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table("harvest_ngsild_entity")
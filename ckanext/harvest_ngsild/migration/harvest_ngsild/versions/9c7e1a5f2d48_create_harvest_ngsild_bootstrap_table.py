@@ -0,0 +1,33 @@
+"""Create harvest_ngsild_bootstrap table
+
+Revision ID: 9c7e1a5f2d48
+Revises: 4b2f6c1d9e3a
+Create Date: 2026-10-17 12:40:08.115273
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "9c7e1a5f2d48"
+down_revision = "4b2f6c1d9e3a"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "harvest_ngsild_bootstrap",
+        sa.Column("organization_id", sa.UnicodeText, primary_key=True),
+        sa.Column("status", sa.UnicodeText, nullable=False),
+        sa.Column("total", sa.Integer, nullable=False, server_default="0"),
+        sa.Column("processed", sa.Integer, nullable=False, server_default="0"),
+        sa.Column("error", sa.UnicodeText),
+        sa.Column("started", sa.DateTime, nullable=False),
+        sa.Column("finished", sa.DateTime),
+    )
+
+
+def downgrade():
+    op.drop_table("harvest_ngsild_bootstrap")
@@ -0,0 +1,166 @@
+import datetime
+
+from sqlalchemy import Column, types
+
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+# Maximum number of ids in a single IN clause
+QUERY_CHUNK_SIZE = 1000
+
+
+class NgsildEntity(toolkit.BaseModel):
+    """Index of the NGSI-LD entities written into CKAN.
+
+    Keeps the modifiedAt and the hash of the converted package of every
+    entity, so that unchanged entities are detected before any CKAN action.
+    Entities notified without system attributes are versioned by a hash of
+    the notified payload instead of their modifiedAt.
+    The table is created with `ckan db upgrade -p harvest_ngsild`.
+    """
+
+    __tablename__ = "harvest_ngsild_entity"
+
+    id = Column(types.UnicodeText, primary_key=True)
+    type = Column(types.UnicodeText, nullable=False)
+    organization_id = Column(types.UnicodeText, index=True)
+    package_name = Column(types.UnicodeText)
+    modified_at = Column(types.UnicodeText)
+    content_hash = Column(types.UnicodeText)
+    updated = Column(types.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    @classmethod
+    def get(cls, id: str) -> Optional["NgsildEntity"]:
+        return model.Session.query(cls).get(id)
+
+    @classmethod
+    def get_many(cls, ids: List[str]) -> Dict[str, "NgsildEntity"]:
+        if not ids:
+            return {}
+        return {
+            e.id: e
+            for e in model.Session.query(cls).filter(cls.id.in_(ids))
+        }
+
+    @classmethod
+    def existing_ids(cls, ids: List[str], organization_id: str) -> Set[str]:
+        existing = set()
+        for i in range(0, len(ids), QUERY_CHUNK_SIZE):
+            existing.update(
+                id for id, in model.Session.query(cls.id)
+                .filter(cls.organization_id == organization_id)
+                .filter(cls.id.in_(ids[i:i + QUERY_CHUNK_SIZE]))
+            )
+        return existing
+
+    @classmethod
+    def iter_organization(cls, organization_id: str, type: str, chunk_size: int = QUERY_CHUNK_SIZE) -> Iterator[Tuple[str, Optional[str], Optional[str]]]:
+        """(id, modified_at, package_name) of the entities of an organization, sorted by id.
+
+        Rows are read in chunks with keyset pagination, so the whole index of
+        the organization is never loaded at once. Ids are compared bytewise
+        ("C" collation), as Python sorts them.
+        """
+        last = None
+        while True:
+            query = (
+                model.Session.query(cls.id, cls.modified_at, cls.package_name)
+                .filter(cls.organization_id == organization_id)
+                .filter(cls.type == type)
+            )
+            if last is not None:
+                query = query.filter(cls.id.collate("C") > last)
+            rows = query.order_by(cls.id.collate("C")).limit(chunk_size).all()
+            yield from rows
+            if len(rows) < chunk_size:
+                return
+            last = rows[-1][0]
+
+    @classmethod
+    def delete_many(cls, ids: List[str], commit: bool = True):
+        for i in range(0, len(ids), QUERY_CHUNK_SIZE):
+            model.Session.query(cls).filter(cls.id.in_(ids[i:i + QUERY_CHUNK_SIZE])).delete(synchronize_session=False)
+        if commit:
+            model.Session.commit()
+
+    @classmethod
+    def delete_organization(cls, organization_id: str, commit: bool = True):
+        model.Session.query(cls).filter(cls.organization_id == organization_id).delete(synchronize_session=False)
+        if commit:
+            model.Session.commit()
+
+    @classmethod
+    def is_unchanged(cls, id: str, modified_at: Optional[str]) -> bool:
+        if not modified_at:
+            return False
+        entity = cls.get(id)
+        return entity is not None and entity.modified_at == modified_at
+
+    @classmethod
+    def upsert(cls, id: str, type: str, commit: bool = True, **kwargs) -> "NgsildEntity":
+        entity = cls.get(id) or cls(id=id)
+        entity.type = type
+        for key, value in kwargs.items():
+            setattr(entity, key, value)
+        entity.updated = datetime.datetime.utcnow()
+        model.Session.add(entity)
+        if commit:
+            model.Session.commit()
+        return entity
+
+
+class NgsildBootstrap(toolkit.BaseModel):
+    """Checkpoint of the initial synchronization of an organization.
+
+    The datasets already processed are the ones recorded in the entity
+    index for the organization, so an interrupted bootstrap can be resumed.
+    """
+
+    __tablename__ = "harvest_ngsild_bootstrap"
+
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    organization_id = Column(types.UnicodeText, primary_key=True)
+    status = Column(types.UnicodeText, nullable=False)
+    total = Column(types.Integer, nullable=False, default=0)
+    processed = Column(types.Integer, nullable=False, default=0)
+    error = Column(types.UnicodeText)
+    started = Column(types.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    finished = Column(types.DateTime)
+
+    @classmethod
+    def get(cls, organization_id: str) -> Optional["NgsildBootstrap"]:
+        return model.Session.query(cls).get(organization_id)
+
+    @classmethod
+    def start(cls, organization_id: str, total: int, processed: int = 0) -> "NgsildBootstrap":
+        bootstrap = cls.get(organization_id) or cls(organization_id=organization_id)
+        bootstrap.status = cls.RUNNING
+        bootstrap.total = total
+        bootstrap.processed = processed
+        bootstrap.error = None
+        bootstrap.started = datetime.datetime.utcnow()
+        bootstrap.finished = None
+        model.Session.add(bootstrap)
+        model.Session.commit()
+        return bootstrap
+
+    def checkpoint(self, processed: int):
+        self.processed = processed
+        model.Session.add(self)
+        model.Session.commit()
+
+    def finish(self, error: Optional[str] = None):
+        self.status = self.FAILED if error else self.DONE
+        self.error = error
+        self.finished = datetime.datetime.utcnow()
+        model.Session.add(self)
+        model.Session.commit()
+
+    @property
+    def is_unfinished(self) -> bool:
+        return self.status != self.DONE
@@ -1,15 +1,97 @@
 import re
 
+from concurrent.futures import ThreadPoolExecutor
+
 from ngsildclient import Client, Entity
+from requests.exceptions import HTTPError
+
+from .constants import (
+    DEFAULT_NGSILD_CONTEXT,
+    JSONLD_CONTEXT_REL,
+    NGSILD_ENTITIES_ENDPOINT,
+    RESOURCE_DATE_KEYS,
+)
 
-from .constants import DEFAULT_NGSILD_CONTEXT, SDM, SDMDCAT, DCTERMS, NGSILD
+from . import metrics
+from .contexts import Context, expand
+from .mapping import MappingPlan, MappingProfile, compile_mapping, get_profile
+from .throttling import RateLimiter
+from .utils import is_broker_failure
 
-from typing import Dict, List, Tuple
+from typing import Dict, Iterator, List, Mapping, Optional, Tuple, Union
 
 import logging
 
 log = logging.getLogger(__name__)
 
+# Maximum number of entity ids requested in a single broker query
+DEFAULT_BATCH_SIZE = 100
+# Number of concurrent requests sent to the broker (1 means serial retrieval)
+DEFAULT_MAX_WORKERS = 1
+
+# Status codes of brokers rejecting id list queries (bad request or not implemented)
+UNSUPPORTED_QUERY_STATUS_CODES = (400, 501)
+
+# Keys of the normalized entity that are not attributes
+NON_ATTRIBUTE_KEYS = ("id", "type", "@context")
+
+
+class EntityView:
+    """Attribute values of an NGSI-LD entity, normalized once.
+
+    Entity.to_ngsi_dict() deep-copies the whole entity, so it is called a
+    single time per entity and every mapping step reads the resulting values.
+    Attribute names and the entity type are expanded into IRIs with the
+    context of the entity, so they match the (expanded) mapping profiles
+    whatever the context the broker used to compact them.
+    """
+
+    __slots__ = ("id", "type", "attrs", "ctx", "modified_at")
+
+    def __init__(self, entity: Entity, ctx: Context = None):
+        d = entity.to_ngsi_dict()
+        self.ctx = d.get("@context") or ctx or DEFAULT_NGSILD_CONTEXT
+        self.id = entity.id
+        self.type = expand(entity.type, self.ctx)
+        # System attribute, only present if requested to the broker (options=sysAttrs)
+        self.modified_at = d.get("modifiedAt")
+        self.attrs = {
+            expand(k, self.ctx): v.value
+            for k, v in d.items()
+            if k not in NON_ATTRIBUTE_KEYS and isinstance(v, Mapping)
+        }
+
+    @classmethod
+    def of(cls, entity: Union[Entity, "EntityView"], ctx: Context = None) -> "EntityView":
+        return entity if isinstance(entity, cls) else cls(entity, ctx)
+
+    def to_dict(self) -> dict:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "EntityView":
+        # Restore a view serialized with to_dict (i.e. cached in Redis)
+        view = cls.__new__(cls)
+        for k in cls.__slots__:
+            setattr(view, k, d.get(k))
+        return view
+
+    def __contains__(self, attr: str) -> bool:
+        return attr in self.attrs
+
+    def __repr__(self) -> str:
+        return f"EntityView(id={self.id!r}, type={self.type!r})"
+
+    def get(self, attr: str, default=None):
+        return self.attrs.get(attr, default)
+
+    def list(self, attr: str) -> list:
+        # Attribute value can be a single item or an array (2+ items)
+        if attr not in self.attrs:
+            return []
+        value = self.attrs[attr]
+        return value if isinstance(value, list) else [value]
+
 
 class NgsildCkanConverter:
 
@@ -17,16 +99,123 @@ class NgsildCkanConverter:
 
     ctx = DEFAULT_NGSILD_CONTEXT
 
-    def __init__(self, broker: Client, ctx = DEFAULT_NGSILD_CONTEXT):
+    def __init__(
+        self,
+        broker: Client,
+        ctx = None,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        rate_limiter: Optional[RateLimiter] = None,
+        catalog_index: Optional[Mapping[str, str]] = None,
+        profile: Optional[MappingProfile] = None,
+    ):
         self.broker = broker
-        self.ctx = ctx
+        # Mapping profile of the data model, and the context its attribute names are compacted with
+        self.profile = profile or get_profile()
+        self.ctx = ctx or self.profile.context
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.rate_limiter = rate_limiter
+        self.catalog_index = catalog_index
 
 
-    def _get_ngsild_entity(self, id: str) -> Entity:
-        return self.broker.get(id, ctx=self.ctx)
+    def _throttle(self):
+        if self.rate_limiter:
+            self.rate_limiter.acquire()
+
+
+    def _map(self, func, items: list) -> list:
+        # Broker requests are I/O bound, so they are run in a bounded thread pool
+        if self.max_workers <= 1 or len(items) <= 1:
+            return [func(item) for item in items]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(items))) as executor:
+            return list(executor.map(func, items))
+
+
+    def _get_ngsild_entity(self, id: str) -> EntityView:
+        self._throttle()
+        with metrics.timer("broker_request_duration_seconds", broker=metrics.broker_label(self.broker.url)):
+            entity = self.broker.get(id, ctx=self.ctx)
+        return EntityView(entity, self.ctx)
+
+
+    def _query_headers(self) -> dict:
+        return {
+            "Accept": "application/json",
+            "Link": f'<{self.ctx}>; rel="{JSONLD_CONTEXT_REL}"; type="application/ld+json"',
+        }
+
+
+    def _query_ngsild_entities(self, ids: List[str], type: str = None, sys_attrs: bool = False) -> Dict[str, EntityView]:
+        # Retrieve a batch of entities in a single id list query (id=<id1>,<id2>,...),
+        # following the broker pagination in case it does not return all of them at once
+        url = f"{self.broker.url}/{NGSILD_ENTITIES_ENDPOINT}"
+        headers = self._query_headers()
+        params = {"id": ",".join(ids), "limit": len(ids), "offset": 0}
+        if type:
+            params["type"] = type
+        if sys_attrs:
+            params["options"] = "sysAttrs"
+
+        entities = {}
+        while True:
+            self._throttle()
+            with metrics.timer("broker_request_duration_seconds", broker=metrics.broker_label(self.broker.url)):
+                r = self.broker.session.get(url, headers=headers, params=params)
+            r.raise_for_status()
+            page = r.json()
+            for e in page:
+                entity = EntityView(Entity(e), self.ctx)
+                entities[entity.id] = entity
+            if len(page) < params["limit"] or len(entities) >= len(ids):
+                break
+            params["offset"] += len(page)
+
+        return entities
+
+
+    def _get_ngsild_entities(self, ids: List[str], type: str = None, sys_attrs: bool = False) -> Dict[str, EntityView]:
+        # Group the ids into batches so that thousands of entities are retrieved in a few
+        # broker queries instead of one GET per entity
+        ids = list(dict.fromkeys(ids))
+        batches = [ids[i:i + self.batch_size] for i in range(0, len(ids), self.batch_size)]
+
+        entities = {}
+        for batch_entities in self._map(lambda batch: self._get_ngsild_entities_batch(batch, type, sys_attrs), batches):
+            entities |= batch_entities
+
+        missing = len(ids) - len(entities)
+        if missing:
+            log.error("%d entities could not be retrieved from broker", missing)
+
+        return entities
+
+
+    def _get_ngsild_entities_batch(self, ids: List[str], type: str = None, sys_attrs: bool = False) -> Dict[str, EntityView]:
+        try:
+            return self._query_ngsild_entities(ids, type, sys_attrs)
+        except HTTPError as e:
+            # Brokers not supporting id list queries: fall back to one GET per entity.
+            # Any other error (i.e. the broker is down) is not retried entity by entity
+            if e.response is None or e.response.status_code not in UNSUPPORTED_QUERY_STATUS_CODES:
+                raise
+            log.warning("Broker rejected the query of a batch of %d entities (%s), retrieving them one by one", len(ids), e)
+
+        # The batch already runs in a worker of the pool, so its entities are retrieved
+        # serially (the rate limiter still caps the requests of all the batches)
+        entities = {}
+        for id in ids:
+            # A failing entity is logged and skipped, it does not affect the rest of the batch.
+            # A failing broker fails the batch, so the error reaches the circuit breaker
+            try:
+                entities[id] = self._get_ngsild_entity(id)
+            except Exception as e:
+                if is_broker_failure(e):
+                    raise
+                log.error("Error retrieving entity %s from broker: %s", id, e)
+        return entities
 
 
-    # TODO: Modify to use yield for each package
     def make_ckan_organization(self, catalog_id: str) -> Tuple[dict, List[dict]]:
         try:
             catalog = self._get_ngsild_entity(catalog_id)
@@ -35,160 +224,189 @@ class NgsildCkanConverter:
 
         # Update organization
         org_dict = self.organization_from_catalog(catalog)
-            
-        catalog = catalog.to_ngsi_dict()
-        if str(SDMDCAT["dataset"]) not in catalog:
-            return org_dict, []
-        
-        datasets = (
-            catalog[str(SDMDCAT["dataset"])].value
-            if isinstance(catalog[str(SDMDCAT["dataset"])].value, list)
-            else [catalog[str(SDMDCAT["dataset"])].value]
-        )
-    
-        packages = []        
-        for dataset_id in datasets:
-            try:
-                p, _ = self.make_ckan_package(dataset_id)
-                packages.append(p)
-            except Exception as e:
-                log.error("Error retrieving package %s from broker", e)
-                continue
 
-        return org_dict, packages
+        return org_dict, list(self.iter_ckan_packages(self.get_dataset_ids(catalog)))
+
+
+    def get_dataset_ids(self, catalog: Union[Entity, EntityView]) -> List[str]:
+        return EntityView.of(catalog, self.ctx).list(self.profile.attributes["dataset"])
     
 
+    def iter_ngsild_entities(self, type: str) -> Iterator[EntityView]:
+        # Page through all the entities of a type, one page (batch_size entities) at a time
+        url = f"{self.broker.url}/{NGSILD_ENTITIES_ENDPOINT}"
+        headers = self._query_headers()
+        params = {"type": type, "limit": self.batch_size, "offset": 0}
+
+        while True:
+            self._throttle()
+            with metrics.timer("broker_request_duration_seconds", broker=metrics.broker_label(self.broker.url)):
+                r = self.broker.session.get(url, headers=headers, params=params)
+            r.raise_for_status()
+            page = r.json()
+            for e in page:
+                yield EntityView(Entity(e), self.ctx)
+            if len(page) < params["limit"]:
+                return
+            params["offset"] += len(page)
+
+
+    def build_catalog_index(self) -> Dict[str, str]:
+        # Reverse index from dataset id to the id of the catalogue that contains it
+        index = {}
+        for catalog in self.iter_ngsild_entities(self.profile.type_of("catalogue")):
+            for dataset_id in self.get_dataset_ids(catalog):
+                index[dataset_id] = catalog.id
+        return index
+
+
     def get_catalog_from_dataset(self, dataset_id: str) -> dict:
-        # Get all catalogs from broker
-        # TODO: Modify ngsiclient library to include attrs in query for filtering
-        catalogs = self.broker.query(type=str(SDMDCAT["Catalogue"]))
-
-        # Iterate to find the catalog that contains the dataset
-        for catalog in catalogs:
-            catalog = catalog.to_ngsi_dict()
-            if str(SDMDCAT["dataset"]) not in catalog:
+        # Converters of get_converter share the index of the broker (catalogues.get_catalog_index),
+        # others build their own once (a paged query of the catalogues) and reuse it
+        if self.catalog_index is None:
+            self.catalog_index = self.build_catalog_index()
+
+        catalog_id = self.catalog_index.get(dataset_id)
+        if catalog_id is None:
+            return {}
+
+        return self._get_ngsild_entity(catalog_id).attrs
+
+
+    def make_ckan_packages(self, dataset_ids: List[str]) -> List[dict]:
+        return list(self.iter_ckan_packages(dataset_ids))
+
+
+    def iter_ckan_packages(self, dataset_ids: List[str]) -> Iterator[dict]:
+        # Packages are yielded as soon as each chunk of datasets is converted, so that
+        # only one chunk of entities is kept in memory at a time (one batch per worker)
+        chunk_size = self.batch_size * max(self.max_workers, 1)
+        for i in range(0, len(dataset_ids), chunk_size):
+            yield from self._make_ckan_packages_chunk(dataset_ids[i:i + chunk_size])
+
+
+    def _make_ckan_packages_chunk(self, dataset_ids: List[str]) -> List[dict]:
+        # Retrieve all the datasets and their distributions in batches and build
+        # the packages from the in-memory entity map
+        datasets = self._get_ngsild_entities(dataset_ids, type=self.profile.type_of("dataset"))
+
+        for dataset_id in dataset_ids:
+            if dataset_id not in datasets:
+                log.error("Error retrieving package %s from broker", dataset_id)
+
+        return self.packages_from_datasets([datasets[id] for id in dataset_ids if id in datasets])
+
+
+    def packages_from_datasets(self, datasets: List[EntityView]) -> List[dict]:
+        # Retrieve the distributions of already retrieved datasets in batches
+        distribution_ids = [
+            distribution_id
+            for dataset in datasets
+            for distribution_id in dataset.list(self.profile.attributes["distribution"])
+        ]
+        distributions = self._get_ngsild_entities(distribution_ids, type=self.profile.type_of("distribution"))
+
+        packages = []
+        for dataset in datasets:
+            try:
+                p, _ = self.package_from_entities(dataset, distributions)
+                packages.append(p)
+            except Exception as e:
+                log.error("Error converting package %s: %s", dataset.id, e)
                 continue
-            
-            if dataset_id in catalog[str(SDMDCAT["dataset"])].value:
-                return catalog
 
-        return {}
+        return packages
 
 
     def make_ckan_package(self, dataset_id: str) -> Tuple[dict, List[dict]]:
         dataset = self._get_ngsild_entity(dataset_id)
 
-        package = self.package_from_dataset(dataset)
+        return self.make_ckan_package_from_entity(dataset)
+
 
+    def make_ckan_package_from_entity(self, dataset: Union[Entity, EntityView]) -> Tuple[dict, List[dict]]:
+        # The dataset has been already received (i.e. in a notification), so only
+        # its distributions are retrieved from the broker
         # Using the current injector, the dataset is always created with distributions
-        dataset = dataset.to_ngsi_dict()
-        if str(SDMDCAT["distribution"]) not in dataset:
-            return package, []
-
-        distributions = (
-            dataset[str(SDMDCAT["distribution"])].value
-            if isinstance(dataset[str(SDMDCAT["distribution"])].value, list)
-            else [dataset[str(SDMDCAT["distribution"])].value]
+        dataset = EntityView.of(dataset, self.ctx)
+        distributions = self._get_ngsild_entities(
+            dataset.list(self.profile.attributes["distribution"]),
+            type=self.profile.type_of("distribution"),
         )
 
-        for distribution_id in distributions:
+        return self.package_from_entities(dataset, distributions)
+
+
+    def package_from_entities(self, dataset: Union[Entity, EntityView], distributions: Dict[str, EntityView]) -> Tuple[dict, List[dict]]:
+        dataset = EntityView.of(dataset, self.ctx)
+        package = self.package_from_dataset(dataset)
+
+        for distribution_id in dataset.list(self.profile.attributes["distribution"]):
+            if distribution_id not in distributions:
+                # Skip distribution
+                log.error("Error retrieving distribution %s from broker", distribution_id)
+                continue
             try:
-                resource = self.make_ckan_resource(distribution_id)
+                resource = self.resource_from_distribution(distributions[distribution_id])
                 package["resources"].append(resource)
             except Exception as e:
                 # Skip distribution
-                log.error("Error retrieving distribution %s from broker", e)
+                log.error("Error converting distribution %s: %s", distribution_id, e)
 
         return package, package["resources"]
 
 
-    def make_ckan_resource(self, distribution_id: str) -> dict:
-        distribution = self._get_ngsild_entity(distribution_id)
-
-        resource = self.resource_from_distribution(distribution)
-
-        return resource
-
-
     @staticmethod
-    def ckan_format_value(key, value):
-        # Convert an array into a long string by separating the items by commas.
-        # Exceptions: "notes" and "descriptions" fields, these will separate the items with two line breaks (markdown) 
-        #             to make them easy to read in the CKAN web interface.
-        # TODO: remove the "if key not in ["notes", "description"]" condition --> is not really a necessary format for creating the ckan object.
-        #       ISSUE: cannot be done after this conversion because the array will no longer exist (long string separated with commas) 
-        if isinstance(value, list):
-            value = (
-                ",".join(value)
-                if key not in ["notes", "description"]
-                else "\n\n".join(value)
-            )
-        return value
-
-
-    @staticmethod
-    def ngsild_to_ckan(ngsild: Entity, mapping: dict) -> dict:
-        out_dict = {}
+    def ngsild_to_ckan(ngsild: Union[Entity, EntityView], mapping: Union[dict, MappingPlan]) -> dict:
+        ngsild = EntityView.of(ngsild)
+        plan = (
+            mapping
+            if isinstance(mapping, MappingPlan)
+            else compile_mapping(mapping, lambda term: expand(term, ngsild.ctx))
+        )
+        # Every field of the mapping is set, to None if its attribute is missing,
+        # so that the values of attributes removed from the entity are cleared
+        out_dict = {key: None for group, key, _, _ in plan.entries if not group}
+        groups = {group: [] for group in plan.groups}
 
-        d = ngsild.to_ngsi_dict()
+        d = ngsild.attrs
         # Moved below because none of the data models have a "name" attribute
         # Adapt data format
         # if "name" in d:
         #     d["name"].value = NgsildCkanConverter.to_ckan_valid_name(d["name"])
 
         # Do the actual mapping if data
-        keys_list = set()  # as a set
-        for key, value in mapping.items():
-            keys = key.split(":")
-            if len(keys) > 1:
-                dd = out_dict.setdefault(keys[0], {})
-                key = keys[1]
-                keys_list.add(keys[0])
-            else:
-                dd = out_dict
-                key = keys[0]
-
-            if isinstance(value, list):
-                for v in value:
-                    if v in d:
-                        # dd[key] = d[v].value   
-                        dd[key] = NgsildCkanConverter.ckan_format_value(key, d[v].value)
-                        break
-            else:
-                if value in d:
-                    dd[key] = NgsildCkanConverter.ckan_format_value(key, d[value].value)
-                    # dd[key] = d[value].value
-        
+        for group, key, sources, separator in plan.entries:
+            for source in sources:
+                if source in d:
+                    value = d[source]
+                    if isinstance(value, list):
+                        value = separator.join(value)
+                    if group:
+                        groups[group].append({"key": key, "value": value})
+                    else:
+                        out_dict[key] = value
+                    break
+
         # Adapt data format
-        if "name" in out_dict:
+        if out_dict.get("name"):
             out_dict["name"] = NgsildCkanConverter.to_ckan_valid_name(out_dict["name"])
-        
-        for key in keys_list:
-            out_dict[key] = [
-                {"key": k, "value": v} for k, v in out_dict[key].items()
-            ]
+
+        out_dict |= groups
         return out_dict
 
 
-    @staticmethod
-    def organization_from_catalog(catalog: Entity) -> dict:
+    def organization_from_catalog(self, catalog: Union[Entity, EntityView]) -> dict:
         org_dict = {}
-
-        # ngsi-ld-core-context-v1.7.jsonld is stored in the context broker --> if not, uncomment DCTERMS["title"], DCTERMS["description"],
-        organization_to_catalog_mapping = {
-            # "name": "name",
-            "name": "title", # DCTERMS["title"],
-            "title": "title", # DCTERMS["title"],
-            "description": "description", # DCTERMS["description"],
-            # "image_url" :
-            # "state" :
-            # "approval_status" :
-            "extras:url": str(SDMDCAT["homepage"]), #"homepage",
-        }
-
         org_dict["id"] = catalog.id
 
-        org_dict |= NgsildCkanConverter.ngsild_to_ckan(catalog, organization_to_catalog_mapping)
+        # Missing attributes are left out: organizations are not cleared by
+        # them, and their name and title must never be None
+        org_dict |= {
+            key: value
+            for key, value in self.ngsild_to_ckan(EntityView.of(catalog, self.ctx), self.profile.organization).items()
+            if value is not None
+        }
 
         org_dict["state"] = "active"
 
@@ -202,100 +420,45 @@ class NgsildCkanConverter:
         return True
 
 
-    @staticmethod
-    def package_from_dataset(dataset: Entity) -> dict:
+    def package_from_dataset(self, dataset: Union[Entity, EntityView]) -> dict:
         pkg_dict = {}
-        # Use NgsiDict as it provides same name to access values/objects
-        d = dataset.to_ngsi_dict()
-
-        # ngsi-ld-core-context-v1.7.jsonld is stored in the context broker --> if not, uncomment DCTERMS["title"], DCTERMS["description"]
-        package_to_dataset_mapping = {
-            # "name": "name",
-            "name": "title", # DCTERMS["title"],
-            "title": "title", # DCTERMS["title"],
-            "author": str(SDMDCAT["creator"]), # "creator",
-            "maintainer": str(SDM["dataProvider"]), # "dataProvider",
-            "license_id": str(SDMDCAT["license"]), # "license",
-            "notes": ["description", "datasetDescription"], # [DCTERMS["description"], "datasetDescription"],
-            "url": str(SDMDCAT["landingPage"]), # "landingPage",
-            "version": str(SDMDCAT["versionInfo"]), # "version",
-            "metadata_created": str(SDM["dateCreated"]), # "dateCreated",
-            "metadata_modified": str(SDM["dateModified"]), # "dateModified",
-            "extras:issued": ["releaseDate", str(SDM["dateCreated"])], # ["releaseDate", "dateCreated"],
-            "extras:modified": ["updateDate", str(SDM["dateModified"])], # ["updateDate", "dateModified"],
-            "extras:theme": str(SDMDCAT["theme"]), # "theme",
-            "extras:language": str(SDMDCAT["language"]), # "language",
-            "extras:version_notes": str(SDMDCAT["versionNotes"]), # "versionNotes",
-            "extras:has_version": str(SDMDCAT["hasVersion"]), # "hasVersion",
-            "extras:temporal_start": str(SDMDCAT["temporal"]), # "temporal",
-            # "extras:temporal_end": "temporal",
-            "extras:temporal_resolution": str(SDMDCAT["temporalResolution"]), # "temporalResolution",
-            "extras:documentation": "documentation",
-            "extras:contact_name": str(SDM["contactPoint"]), # "contactPoint",
-            "extras:access_rights": str(SDMDCAT["accessRights"]), # "accessRights",
-            "extras:spatial": str(SDMDCAT["spatial"]), # "spatial",
-        }
-        
+        # The entity is normalized once and shared by every mapping step
+        dataset = EntityView.of(dataset, self.ctx)
+
         pkg_dict["id"] = dataset.id
 
-        pkg_dict |= NgsildCkanConverter.ngsild_to_ckan(dataset, package_to_dataset_mapping)
+        pkg_dict |= self.ngsild_to_ckan(dataset, self.profile.package)
 
         pkg_dict["name"] = pkg_dict["name"].replace(":", "_")
         pkg_dict["private"] = False
         pkg_dict["state"] = "active"
         # TO BE CHANGED
-        pkg_dict["owner_org"] = d.get(str(SDMDCAT["publisher"])).value
-
-        if d.get(str(SDMDCAT["keyword"])):
-            # d["keyword"] can be a string (1 keyword) or an array (2+ keywords)
-            pkg_dict["tags"] = (
-                [
-                    {
-                        "name": x,
-                        # Currently using free tags (don't belong to a vocabulary)
-                    }
-                    for x in d[str(SDMDCAT["keyword"])].value
-                ]
-                if isinstance(d[str(SDMDCAT["keyword"])].value, list)
-                else [{"name": d[str(SDMDCAT["keyword"])].value}]
-                )
+        pkg_dict["owner_org"] = dataset.attrs[self.profile.attributes["publisher"]]
+
+        # "keyword" can be a string (1 keyword) or an array (2+ keywords).
+        # Without keywords the tags are still set, so that removed keywords are cleared
+        pkg_dict["tags"] = [
+            {
+                "name": x,
+                # Currently using free tags (don't belong to a vocabulary)
+            }
+            for x in dataset.list(self.profile.attributes["keyword"])
+            if x
+        ]
 
         pkg_dict["resources"] = []
 
         return pkg_dict
 
 
-    @staticmethod
-    def resource_from_distribution(distribution: Entity) -> dict:
+    def resource_from_distribution(self, distribution: Union[Entity, EntityView]) -> dict:
         rsc_dict = {}
-
-        # I think it is not required to put the package_id if the resource is included in the package creation
-
-        # ngsi-ld-core-context-v1.7.jsonld is stored in the context broker --> if not, uncomment DCTERMS["title"], DCTERMS["description"], NGSILD["format"]
-        resource_to_distribution_mapping = {
-            "package_id": "dataset",
-            "url": str(SDMDCAT["accessUrl"]), # "accessUrl",
-            "description": "description", # DCTERMS["description"],
-            "format":  "format", # NGSILD["format"], 
-            "hash": "hash",
-            "license": str(SDMDCAT["license"]), # "license",
-            "rights": str(SDMDCAT["rights"]), # "rights",
-            "name": "title", # DCTERMS["title"],
-            "resource_type": [],
-            "mimetype": str(SDMDCAT["mediaType"]), # "mediaType",
-            "mimetype_inner": [],
-            "cache_url": str(SDMDCAT["accessUrl"]), # "accessUrl",  # from dataset
-            "access_url": str(SDMDCAT["accessUrl"]), # "accessUrl",
-            "download_url": [str(SDMDCAT["downloadURL"]), str(SDMDCAT["accessUrl"])], # ["downloadUrl", "accessUrl"],
-            "size": str(SDMDCAT["byteSize"]), # "byteSize",
-            "created": ["releaseDate", str(SDM["dateCreated"])], # ["releaseDate", "dateCreated"],
-            "last_modified": ["modificationDate", str(SDM["dateModified"])], # ["modificationDate", "dateModified"],
-            "cache_last_updated": ["modificationDate", str(SDM["dateModified"])], # ["modificationDate", "dateModified"],
-            # "upload":
-        }
-
         rsc_dict["id"] = NgsildCkanConverter.to_ckan_valid_id(distribution.id)
-        rsc_dict |= NgsildCkanConverter.ngsild_to_ckan(distribution, resource_to_distribution_mapping)
+        rsc_dict |= self.ngsild_to_ckan(EntityView.of(distribution, self.ctx), self.profile.resource)
+
+        for key in RESOURCE_DATE_KEYS:
+            if rsc_dict.get(key):
+                rsc_dict[key] = NgsildCkanConverter.to_ckan_date(rsc_dict[key])
 
         return rsc_dict
     
@@ -310,6 +473,12 @@ class NgsildCkanConverter:
         return re.sub(pattern, "_", id).lower()
 
 
+    @staticmethod
+    def to_ckan_date(value) -> str:
+        # NGSI-LD dates are in UTC ("Z"), and isodate() rejects any UTC offset
+        return str(value).removesuffix("Z")
+
+
     @staticmethod
     def to_ckan_valid_name(name: str) -> str:
         # To be a valid ckan name, it cannot contain blank spaces, so we replace them with _
@@ -0,0 +1,367 @@
+import datetime
+import hashlib
+import json
+import time
+import uuid
+
+from contextlib import nullcontext
+
+import ckan.plugins.toolkit as toolkit
+import ckan.logic as logic
+
+from ckan.lib.redis import connect_to_redis
+
+from ngsildclient import Entity
+from rq import get_current_job
+
+from . import metrics
+from .catalogues import get_catalogue, invalidate_catalogue, is_catalogue, patch_organization, update_catalogue
+from .clients import get_client, get_converter
+from .deletions import delete_datasets, is_deleted, removed_datasets
+from .indexing import flush_dirty, is_deferred_mode, mark_dirty, suspended_indexing
+from .lanes import BUSY_RETRY_DELAY, CircuitOpen, LaneBusy, get_lane, is_lanes_mode
+from .model import NgsildEntity
+from .ngsild_ckan_converter import EntityView
+from .packages import UNCHANGED, sync_package
+from .utils import to_ckan_valid_name
+
+from typing import List, Optional, Tuple
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# "sync": notifications are processed inside the HTTP request (201 Created)
+# "async": notifications are queued and processed by a background worker (202 Accepted)
+NOTIFICATIONS_MODE_CONFIG_OPTION = 'ckanext.harvest_ngsild.notifications_mode'
+NOTIFICATIONS_QUEUE_CONFIG_OPTION = 'ckanext.harvest_ngsild.notifications_queue'
+# Maximum time (in seconds) a queued (entity id, modifiedAt) pair is remembered to discard duplicates.
+# Pairs are forgotten once their job finishes, the TTL only bounds the keys of jobs that never ran
+NOTIFICATIONS_DEDUPLICATION_TTL_CONFIG_OPTION = 'ckanext.harvest_ngsild.notifications_deduplication_ttl'
+
+# Time (in seconds) notifications of the same entity are merged before processing its latest state
+NOTIFICATIONS_DEBOUNCE_WINDOW_CONFIG_OPTION = 'ckanext.harvest_ngsild.notifications_debounce_window'
+
+DEFAULT_NOTIFICATIONS_MODE = "sync"
+DEFAULT_NOTIFICATIONS_DEDUPLICATION_TTL = 86400
+
+REDIS_KEY_PREFIX = "ckanext-harvest_ngsild:notification:"
+# Delayed jobs by due time. The CKAN worker runs no RQ scheduler, so they wait
+# in this sorted set until enqueue_due_jobs moves them into their queue
+REDIS_SCHEDULED_KEY = REDIS_KEY_PREFIX + "scheduled"
+
+# Maximum number of due jobs moved into their queues at once
+SCHEDULED_BATCH_SIZE = 1000
+
+# Take the due jobs atomically, so each of them is enqueued by a single process
+_POP_DUE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+if #due > 0 then
+    redis.call('ZREM', KEYS[1], unpack(due))
+end
+return due
+"""
+
+
+def is_async_mode() -> bool:
+    return toolkit.config.get(NOTIFICATIONS_MODE_CONFIG_OPTION, DEFAULT_NOTIFICATIONS_MODE) == "async"
+
+
+def _queue(hostname: str, port) -> Optional[str]:
+    # Each broker has its own queue in lanes mode
+    if is_lanes_mode():
+        return get_lane(hostname, port).queue
+    return toolkit.config.get(NOTIFICATIONS_QUEUE_CONFIG_OPTION, None)
+
+
+def entity_version(entity: dict) -> str:
+    # The state of a notified entity is identified by its modifiedAt. If the broker
+    # does not include system attributes, a hash of the whole payload is used instead
+    return entity.get("modifiedAt") or hashlib.sha1(
+        json.dumps(entity, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def _deduplication_key(hostname: str, port, entity: dict) -> str:
+    return f"{REDIS_KEY_PREFIX}{hostname}:{port}:{entity.get('id')}:{entity_version(entity)}"
+
+
+def enqueue_notification(user: str, organization: str, hostname: str, port, entities: List[dict], profile: Optional[str] = None) -> List[str]:
+    """Queue the notified entities to be processed by a background worker.
+
+    Entities already queued with the same id and modifiedAt are discarded
+    while their job is pending, so broker retries of the same notification
+    are idempotent. Returns the ids of the queued entities.
+    """
+    redis = connect_to_redis()
+    ttl = toolkit.asint(
+        toolkit.config.get(NOTIFICATIONS_DEDUPLICATION_TTL_CONFIG_OPTION, DEFAULT_NOTIFICATIONS_DEDUPLICATION_TTL)
+    )
+
+    pending, keys = [], []
+    for e in entities:
+        key = _deduplication_key(hostname, port, e)
+        if redis.set(key, 1, nx=True, ex=ttl):
+            pending.append(e)
+            keys.append(key)
+        else:
+            log.debug("Discarding duplicated notification for entity %s", e.get("id"))
+
+    window = float(toolkit.config.get(NOTIFICATIONS_DEBOUNCE_WINDOW_CONFIG_OPTION, 0))
+    if window > 0:
+        for e, key in zip(pending, keys):
+            _debounce_entity(redis, window, user, organization, hostname, port, e, key, profile)
+    elif pending:
+        toolkit.enqueue_job(
+            notification_job,
+            [user, organization, hostname, port, pending, keys, profile],
+            title=f"NGSI-LD notification from {hostname}:{port} for {organization}",
+            queue=_queue(hostname, port),
+        )
+
+    # Incoming notifications also move the delayed jobs that are due into their queues
+    enqueue_due_jobs()
+
+    return [e["id"] for e in pending]
+
+
+def _pending_keys(organization: str, hostname: str, port, entity_id: str) -> Tuple[str, str]:
+    key = f"{REDIS_KEY_PREFIX}pending:{hostname}:{port}:{organization}:{entity_id}"
+    return key, key + ":scheduled"
+
+
+def _debounce_entity(redis, window: float, user: str, organization: str, hostname: str, port, entity: dict, key: str, profile: Optional[str] = None):
+    # Only the latest state of the entity is kept while the window is open,
+    # and a single job is scheduled per entity and window
+    pending_key, scheduled_key = _pending_keys(organization, hostname, port, entity["id"])
+
+    previous = redis.getset(pending_key, json.dumps({"user": user, "entity": entity, "key": key, "profile": profile}))
+    if previous is not None:
+        metrics.inc("notifications_collapsed_total", broker=f"{hostname}:{port}", organization=organization)
+        log.debug("Collapsing pending notification for entity %s", entity["id"])
+        # The collapsed state is never processed, so it is no longer a duplicate
+        previous_key = json.loads(previous)["key"]
+        if previous_key != key:
+            redis.delete(previous_key)
+
+    now = time.time()
+    if redis.set(scheduled_key, now, nx=True):
+        schedule_job(
+            debounced_notification_job,
+            [organization, hostname, port, entity["id"]],
+            now + window,
+            title=f"NGSI-LD notification from {hostname}:{port} for {organization} ({entity['id']})",
+            queue=_queue(hostname, port),
+        )
+
+
+def schedule_job(func, args: list, not_before: float, title: str, queue: Optional[str] = None):
+    """Enqueue a notification job once not_before is reached, without blocking any worker"""
+    job = json.dumps({"id": str(uuid.uuid4()), "func": func.__name__, "args": args, "title": title, "queue": queue})
+    connect_to_redis().zadd(REDIS_SCHEDULED_KEY, {job: not_before})
+
+
+def enqueue_due_jobs() -> int:
+    """Move the delayed jobs that are due into their queues. Returns the number of enqueued jobs."""
+    funcs = {f.__name__: f for f in (notification_job, debounced_notification_job)}
+    count = 0
+    while True:
+        due = connect_to_redis().eval(_POP_DUE_SCRIPT, 1, REDIS_SCHEDULED_KEY, time.time(), SCHEDULED_BATCH_SIZE)
+        for job in due:
+            job = json.loads(job)
+            toolkit.enqueue_job(funcs[job["func"]], job["args"], title=job["title"], queue=job["queue"])
+        count += len(due)
+        if len(due) < SCHEDULED_BATCH_SIZE:
+            return count
+
+
+def debounced_notification_job(organization: str, hostname: str, port, entity_id: str):
+    """Background job processing the latest pending state of an entity once its debounce window closes"""
+    redis = connect_to_redis()
+    pending_key, scheduled_key = _pending_keys(organization, hostname, port, entity_id)
+
+    # Notifications arriving from now on schedule a new job
+    redis.delete(scheduled_key)
+    pipe = redis.pipeline()
+    pipe.get(pending_key)
+    pipe.delete(pending_key)
+    pending, _ = pipe.execute()
+    if pending is None:
+        return
+    pending = json.loads(pending)
+
+    notification_job(
+        pending["user"], organization, hostname, port, [pending["entity"]], [pending["key"]], pending.get("profile")
+    )
+
+
+def notification_job(user: str, organization: str, hostname: str, port, entities: List[dict], keys: List[str], profile: Optional[str] = None):
+    """Background job processing a queued notification in the lane of its broker"""
+    title = f"NGSI-LD notification from {hostname}:{port} for {organization}"
+    lane = get_lane(hostname, port)
+    job = get_current_job()
+    if job is not None and job.enqueued_at is not None:
+        metrics.observe("lane_wait_seconds", (datetime.datetime.utcnow() - job.enqueued_at).total_seconds(), broker=lane.broker)
+
+    release = True
+    try:
+        with lane.guard():
+            process_notification(user, organization, hostname, port, entities, defer_indexing=is_deferred_mode(), profile=profile)
+    except LaneBusy:
+        # The requeued job keeps the entities
+        release = False
+        # Retried later, the worker takes other notifications meanwhile
+        metrics.inc("lane_rejected_total", broker=lane.broker, reason="busy")
+        schedule_job(
+            notification_job,
+            [user, organization, hostname, port, entities, keys, profile],
+            time.time() + BUSY_RETRY_DELAY,
+            title=title,
+            queue=_queue(hostname, port),
+        )
+        metrics.flush()
+    except CircuitOpen as e:
+        # The broker was already answered: the notification is retried once the circuit half-opens
+        release = False
+        metrics.inc("lane_rejected_total", broker=lane.broker, reason="circuit_open")
+        schedule_job(
+            notification_job,
+            [user, organization, hostname, port, entities, keys, profile],
+            time.time() + max(e.retry_after, BUSY_RETRY_DELAY),
+            title=title,
+            queue=_queue(hostname, port),
+        )
+        metrics.flush()
+    finally:
+        # Deduplication only holds while the job is pending: once processed (or
+        # failed), a later notification of the same state is processed again,
+        # i.e. an entity going back to a previous state or a retry after an error
+        if release and keys:
+            connect_to_redis().delete(*keys)
+        enqueue_due_jobs()
+
+
+def process_notification(user: str, organization: str, hostname: str, port, entities: List[dict], defer_indexing: bool = False, profile: Optional[str] = None) -> bool:
+    """Convert the notified entities and write them into CKAN.
+
+    The entities are converted with the mapping `profile` of the subscription.
+    With `defer_indexing`, the written packages are not indexed right away
+    but queued to be indexed in batches. Returns False if the organization
+    catalogue is not found in the broker.
+    """
+    context = {
+        "model": logic.model,
+        "session": logic.model.Session,
+        "user": user,  # Want to set who is doing this
+    }
+
+    labels = {"broker": f"{hostname}:{port}", "organization": organization}
+    try:
+        with metrics.timer("notification_duration_seconds", **labels):
+            return _process_notification(context, organization, hostname, port, entities, defer_indexing, profile, labels)
+    finally:
+        metrics.flush()
+
+
+def _process_notification(context, organization: str, hostname: str, port, entities: List[dict], defer_indexing: bool, profile: Optional[str], labels: dict) -> bool:
+    # Although we can get the source IP address from request.remote_addr, the
+    # domain name could not be the same as the one used to subscribe
+    broker = get_client(hostname, port, secure = True) #, custom_auth = auth_token)
+    converter = get_converter(broker, profile)
+
+    # Workaround for patch uninitialized organization (the organization/catalogue entity was not described before, in the ngsi-ld/subscribe request moment)
+    org_id = "urn:ngsi-ld:Catalogue:" + organization
+
+    # Deleted entities only carry their id and type, they are handled apart
+    deleted = [e for e in entities if is_deleted(e)]
+    entities = [e for e in entities if not is_deleted(e)]
+
+    # Every notified entity is normalized once and shared by all the steps below
+    # (attribute names are expanded with the context of the notification, resolved locally)
+    views = [EntityView(Entity(e), e.get("@context") or converter.ctx) for e in entities]
+
+    # Datasets deleted from the broker, or removed from the dataset list of the catalogue
+    deleted_views = [EntityView(Entity(e), e.get("@context") or converter.ctx) for e in deleted]
+    deleted_ids = [e.id for e in deleted_views if converter.profile.is_type("dataset", e.type)]
+
+    # A notified catalogue replaces the cached one (and its datasets in the reverse index)
+    organization_obj = None
+    with metrics.stage("catalogue", **labels):
+        for entity in deleted_views:
+            if is_catalogue(entity, converter.profile):
+                invalidate_catalogue(converter, entity.id)
+        for entity in views:
+            if is_catalogue(entity, converter.profile):
+                _, notified_organization = update_catalogue(converter, entity)
+                if entity.id == org_id:
+                    organization_obj = notified_organization
+                    # A catalogue notified without its dataset list does not remove them
+                    if converter.profile.attributes["dataset"] in entity:
+                        deleted_ids += removed_datasets(org_id, converter.get_dataset_ids(entity))
+
+        # Only a notified or just retrieved catalogue is written into the organization,
+        # a cached one can be older than the organization written by another process
+        fresh = organization_obj is not None
+        if not fresh:
+            _, organization_obj, fresh = get_catalogue(converter, org_id)
+
+    if not organization_obj:
+        return False
+
+    if fresh:
+        with metrics.stage("organization_patch", **labels):
+            patch_organization(context, organization_obj, converter.profile)
+
+    # Deletions of the notification are applied as a single batch (one index update)
+    if deleted_ids:
+        with metrics.stage("package_deletion", **labels):
+            deleted_ids = delete_datasets(context, org_id, list(dict.fromkeys(deleted_ids)))
+        metrics.inc("entities_total", len(deleted_ids), result="deleted", **labels)
+
+    organization = to_ckan_valid_name(organization)
+    package_ids = []
+    try:
+        with suspended_indexing() if defer_indexing else nullcontext():
+            for e, entity in zip(entities, views):
+                log.debug("Entity: %s", entity)
+                if is_catalogue(entity, converter.profile):
+                    continue
+                if not converter.profile.is_type("dataset", entity.type):
+                    log.debug("Ignoring entity of type: %s", entity.type)
+                    metrics.inc("entities_total", result="ignored", **labels)
+                    continue
+                # Same entity state already written into CKAN (i.e. resent after resubscription).
+                # Subscriptions do not request system attributes, so without modifiedAt
+                # the state is compared by the hash of the notified payload
+                version = entity_version(e)
+                if NgsildEntity.is_unchanged(entity.id, version):
+                    log.debug("Entity %s not modified since %s, skipping", entity.id, version)
+                    metrics.inc("entities_total", result=UNCHANGED, **labels)
+                    continue
+                try:
+                    # The notification carries the whole dataset, no need to retrieve it again
+                    with metrics.stage("package_convert", **labels):
+                        package, _ = converter.make_ckan_package_from_entity(entity)
+                    if not converter.package_has_resources(package):
+                        metrics.inc("entities_total", result="ignored", **labels)
+                        continue
+                    package["owner_org"] = organization
+
+                    # Only the fields that changed are patched, if any
+                    with metrics.stage("package_write", **labels):
+                        package_response, result = sync_package(context, package, org_id, version)
+                except Exception:
+                    metrics.inc("entities_total", result="failed", **labels)
+                    raise
+                metrics.inc("entities_total", result=result, **labels)
+                if package_response:
+                    package_ids.append(package_response["id"])
+    finally:
+        # Packages written before an error must be indexed too
+        if defer_indexing:
+            mark_dirty(package_ids)
+
+    if defer_indexing:
+        flush_dirty()
+
+    return True
@@ -0,0 +1,287 @@
+import hashlib
+import json
+
+import ckan.logic as logic
+import ckan.model as model
+
+from ckan.lib.helpers import date_str_to_datetime
+from ckan.logic.validators import clean_format
+from ckan.types import Context
+
+from . import metrics
+from .constants import RESOURCE_DATE_KEYS, SDMDCAT
+from .indexing import unindex_packages
+from .model import NgsildEntity
+
+from typing import Dict, List, Optional, Tuple
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# Fields set by CKAN itself or that do not round-trip through package_show
+IGNORED_PACKAGE_KEYS = {"id", "owner_org", "metadata_created", "metadata_modified", "resources"}
+IGNORED_RESOURCE_KEYS = {"id", "package_id"}
+
+CREATED = "created"
+UPDATED = "updated"
+RECREATED = "recreated"
+UNCHANGED = "unchanged"
+
+
+def _normalize_date(value) -> str:
+    # NGSI-LD dates are in UTC ("Z"), CKAN stores naive datetimes
+    try:
+        return date_str_to_datetime(str(value).removesuffix("Z")).isoformat()
+    except (TypeError, ValueError):
+        return str(value)
+
+
+def _normalize_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return str(value)
+
+
+def _normalize_value(key: str, value):
+    # CKAN returns every value as a string, and extras and tags as lists of
+    # dicts. Values changed by the validators of CKAN are normalized the same way
+    if value is None or value == "":
+        return ""
+    if key == "extras":
+        return sorted((e["key"], str(e["value"])) for e in value)
+    if key == "tags":
+        return sorted(t["name"] for t in value)
+    if key in RESOURCE_DATE_KEYS:
+        return _normalize_date(value)
+    if key == "format":
+        return clean_format(str(value))
+    if key == "size":
+        return _normalize_int(value)
+    return str(value)
+
+
+def _normalize(d: dict, keys, ignored: set) -> dict:
+    return {
+        k: _normalize_value(k, d.get(k))
+        for k in keys
+        if k not in ignored
+    }
+
+
+def content_hash(d: dict) -> str:
+    return hashlib.sha256(
+        json.dumps(d, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def _cleared(value):
+    # Attributes missing in the entity are converted to None, and cleared with
+    # an empty string (None is dropped by the validators of some fields)
+    return "" if value is None else value
+
+
+def _package_changes(package: dict, stored: dict) -> dict:
+    # The converted package has every field managed by the mapping profile,
+    # so a field whose attribute was removed from the entity is cleared too
+    new = _normalize(package, package.keys(), IGNORED_PACKAGE_KEYS)
+    old = _normalize(stored, package.keys(), IGNORED_PACKAGE_KEYS)
+    return {k: _cleared(package[k]) for k in new if new[k] != old[k]}
+
+
+def _resources_changed(package: dict, stored: dict) -> bool:
+    stored_resources = {r["id"]: r for r in stored.get("resources", [])}
+    if set(stored_resources) != {r["id"] for r in package["resources"]}:
+        return True
+    return any(
+        _normalize(r, r.keys(), IGNORED_RESOURCE_KEYS)
+        != _normalize(stored_resources[r["id"]], r.keys(), IGNORED_RESOURCE_KEYS)
+        for r in package["resources"]
+    )
+
+
+def _patched_resources(package: dict, stored: dict) -> List[dict]:
+    # Full list of resources of the package: the converted fields replace the
+    # stored ones, fields set by CKAN (i.e. created, url_type) are kept
+    stored_resources = {r["id"]: r for r in stored.get("resources", [])}
+    return [
+        stored_resources.get(r["id"], {}) | {k: _cleared(v) for k, v in r.items()}
+        for r in package["resources"]
+    ]
+
+
+def _comparable(package: dict, reference: dict) -> dict:
+    # Projection of a package over the fields of the converted (reference) package
+    resources = {r["id"]: r for r in package.get("resources", [])}
+    return _normalize(package, reference.keys(), IGNORED_PACKAGE_KEYS) | {
+        "resources": {
+            r["id"]: _normalize(resources.get(r["id"], {}), r.keys(), IGNORED_RESOURCE_KEYS)
+            for r in reference["resources"]
+        }
+    }
+
+
+def package_is_unchanged(package: dict, stored: dict) -> bool:
+    # Compare the content hash of the converted package with the stored one
+    if {r["id"] for r in stored.get("resources", [])} != {r["id"] for r in package["resources"]}:
+        return False
+
+    return content_hash(_comparable(package, package)) == content_hash(_comparable(stored, package))
+
+
+def update_package(context: Context, package: dict, stored: dict) -> str:
+    """Patch only the package fields that differ from the stored package.
+
+    Changes of the resources are sent in the same patch, with the whole list
+    of resources: new ones are created and the ones no longer referenced by
+    the dataset are removed. A package is updated with a single package_patch.
+    """
+    if package_is_unchanged(package, stored):
+        log.debug("Package %s unchanged", stored["name"])
+        return UNCHANGED
+
+    changes = _package_changes(package, stored)
+    if _resources_changed(package, stored):
+        changes["resources"] = _patched_resources(package, stored)
+    if changes:
+        changes["id"] = stored["id"]
+        # Contexts of direct action calls lack the keys filled in by get_action
+        context.setdefault("session", model.Session)
+        context.setdefault("auth_user_obj", None)
+        logic.action.patch.package_patch(context, changes)
+
+    return UPDATED
+
+
+def upsert_package(context: Context, package: dict) -> Tuple[dict, str]:
+    """Create the package or update the existing one with the latest changes.
+
+    Returns the package and whether it was created, updated, recreated or left unchanged.
+    """
+    package.pop("id", None) # 'The input field id was not expected' --> this happends when dataset["resources"] is empty
+
+    try:
+        stored = logic.action.get.package_show(dict(context), {"id": package["name"]})
+    except logic.NotFound:
+        package_response = logic.action.create.package_create(context, package)
+        log.debug("Package created: %s", package_response)
+        return package_response, CREATED
+
+    try:
+        result = update_package(context, package, stored)
+        log.debug("Package %s %s", stored["name"], result)
+        return stored, result
+    except logic.ValidationError as e:
+        # i.e. resource ids already used by another package --> we have to recreate the package
+        # in order to include the lastest changes or additions
+        log.warning("Error updating package %s (%s), recreating it", stored["name"], e)
+
+    # Delete dataset
+    user = context["user"]
+    context["user"] = "ckan_admin" # Only sysadmin can purge organizations/datasets/distributions
+    with metrics.stage("package_purge"):
+        logic.action.delete.dataset_purge(context, {"id": stored["id"]})
+    # The purged package must leave the search index even if indexing is suspended
+    # (deferred mode), otherwise its document stays next to the recreated one
+    unindex_packages([stored["id"]])
+
+    # Recreate dataset
+    context["user"] = user
+    package_response = logic.action.create.package_create(context, package)
+    log.debug("Package recreated: %s", package_response)
+    return package_response, RECREATED
+
+
+def package_content_hash(package: dict) -> str:
+    # Hash of the converted package (including its resources), independent of
+    # the way the owner organization is referenced
+    return content_hash({k: v for k, v in package.items() if k != "owner_org"})
+
+
+def sync_package(context: Context, package: dict, organization_id: str, modified_at: Optional[str] = None) -> Tuple[Optional[dict], str]:
+    """Write the converted package into CKAN unless the entity index shows it has not changed.
+
+    `package` must still contain the NGSI-LD dataset id. Returns the written
+    package (None if skipped) and the result of the write.
+    """
+    dataset_id = package["id"]
+    package_hash = package_content_hash(package)
+
+    index = NgsildEntity.get(dataset_id)
+    if index is not None and index.content_hash == package_hash:
+        log.debug("Package %s unchanged since last update, skipping", package["name"])
+        if modified_at and index.modified_at != modified_at:
+            NgsildEntity.upsert(dataset_id, index.type, modified_at=modified_at)
+        return None, UNCHANGED
+
+    package_response, result = upsert_package(context, package)
+
+    NgsildEntity.upsert(
+        dataset_id,
+        str(SDMDCAT["Dataset"]),
+        organization_id=organization_id,
+        package_name=package["name"],
+        modified_at=modified_at,
+        content_hash=package_hash,
+    )
+    return package_response, result
+
+
+def write_packages(context: Context, packages: List[dict], organization_id: str, modified_at: Optional[Dict[str, str]] = None) -> List[str]:
+    """Write a chunk of converted packages into CKAN in a single transaction.
+
+    New packages are created with deferred commits and committed together,
+    along with their entity index records. Packages that already exist are
+    synchronized one by one. `modified_at` maps the dataset ids to their
+    modifiedAt, if known. Returns the ids of the written CKAN packages.
+    """
+    if not packages:
+        return []
+    modified_at = modified_at or {}
+
+    existing = {
+        name for name, in model.Session.query(model.Package.name)
+        .filter(model.Package.name.in_([p["name"] for p in packages]))
+    }
+
+    package_ids = []
+    failed = False
+    try:
+        for package in packages:
+            if package["name"] in existing:
+                continue
+            data_dict = dict(package)
+            dataset_id = data_dict.pop("id") # only sysadmin can set package_id
+            package_response = logic.action.create.package_create(
+                dict(context, defer_commit=True), data_dict
+            )
+            package_ids.append(package_response["id"])
+            NgsildEntity.upsert(
+                dataset_id,
+                str(SDMDCAT["Dataset"]),
+                commit=False,
+                organization_id=organization_id,
+                package_name=package["name"],
+                modified_at=modified_at.get(dataset_id),
+                content_hash=package_content_hash(package),
+            )
+        model.repo.commit()
+    except Exception as e:
+        # Write them one by one so that a single failing package does not discard the whole chunk
+        log.warning("Error writing %d packages in a single transaction (%s), writing them one by one", len(packages), e)
+        model.Session.rollback()
+        package_ids = []
+        failed = True
+
+    for package in packages:
+        if failed or package["name"] in existing:
+            try:
+                package_response, _ = sync_package(context, package, organization_id, modified_at.get(package["id"]))
+            except Exception as e:
+                log.error("Error writing package %s: %s", package["name"], e)
+                continue
+            if package_response:
+                package_ids.append(package_response["id"])
+
+    return package_ids
@@ -1,3 +1,5 @@
+import math
+
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 
@@ -15,19 +17,22 @@ import ckan.logic as logic
 # from ckan.logic import auth_disallow_anonymous_access
 import ckan.authz as authz
 
-from ngsildclient import Client, Entity, SubscriptionBuilder
+from ngsildclient import Client, SubscriptionBuilder
+
+from . import cli, metrics
+from .clients import get_client, get_converter
+from .deletions import ENTITY_DELETED_TRIGGER, NOTIFICATION_TRIGGERS
+from .lanes import CircuitOpen, LaneBusy, get_lane, lane_gauges
+from .notifications import enqueue_notification, is_async_mode, process_notification
+from .model import NgsildBootstrap, NgsildEntity
+from .indexing import enqueue_indexing, suspended_indexing
+from .packages import sync_package, write_packages
 
-from .ngsild_ckan_converter import NgsildCkanConverter
+from .mapping import DEFAULT_PROFILE, MappingProfileError, get_profile, load_profiles, profile_names
 
-from .utils import (
-    organization_from_catalog,
-    package_from_dataset,
-    resource_from_distribution,
-    to_ckan_valid_name,
-    to_ckan_valid_id
-)
+from .utils import to_ckan_valid_name
 
-from .constants import DEFAULT_NGSILD_CONTEXT, SUBSCRIPTION_ID_PATTERN, SDMDCAT
+from .constants import DEFAULT_NGSILD_CONTEXT, SUBSCRIPTION_ID_PATTERN
 
 import logging
 
@@ -37,26 +42,34 @@ BLUEPRINT_NAME = "harvest_ngsild"
 BLUEPRINT_NGSILD_NOTIFICATION_ACTION_NAME = "ngsi-ld-notifications"
 BLUEPRINT_NGSILD_SUBSCRIBE_ACTION_NAME = "ngsi-ld-subscribe"
 BLUEPRINT_NGSILD_UNSUBSCRIBE_ACTION_NAME = "ngsi-ld-unsubscribe"
+BLUEPRINT_NGSILD_METRICS_ACTION_NAME = "ngsi-ld-metrics"
 
 NOTIFICATIONS_ENDPOINT_CONFIG_OPTION= 'ckanext.harvest_ngsild.notifications_endpoint'
 
+# Custom mapping profiles (JSON files, space separated) and the profile used when a subscription does not select one
+MAPPING_PROFILES_CONFIG_OPTION = 'ckanext.harvest_ngsild.mapping_profiles'
+DEFAULT_MAPPING_PROFILE_CONFIG_OPTION = 'ckanext.harvest_ngsild.default_mapping_profile'
+
+# Number of packages written in a single transaction while initializing an organization
+BULK_SIZE_CONFIG_OPTION = 'ckanext.harvest_ngsild.bulk_size'
+DEFAULT_BULK_SIZE = 100
+
+# Number of datasets between progress messages while initializing an organization
+PROGRESS_LOG_INTERVAL = 100
+
+# Number of packages per page when listing the packages of an organization
+SEARCH_PAGE_SIZE = 1000
+
+BOOTSTRAP_RESUME = "resume"
+BOOTSTRAP_FRESH = "fresh"
+
+
 def ngsild_notifications_action():
     """Handle request to NSGI-LD notifications server route"""
 
     # Check current user is authorized to perform this action
     log.debug("Current user: %s", current_user)
 
-    context = {
-        "model": logic.model,
-        # "ignore_auth": True,
-        # "limits": {'packages': 2},
-        # "for_view": True,
-        # "__auth_audit" = [],
-        "session": logic.model.Session,
-        "user": current_user.name,  # Want to set who is doing this
-        "auth_user_obj": current_user,
-    }
-
     # Check notification format is the expected
     # - Content-type
     # - Client IP address (only the servers subscribed to)
@@ -86,62 +99,59 @@ def ngsild_notifications_action():
     # if not auth_token:
     #     auth_token = None
 
+    # Mapping profile selected when subscribing (subscriptions created before profiles use the default one)
+    profile: str = request.headers.get("X-CKAN-Mapping-Profile")
+    if profile and profile not in profile_names():
+        abort(400, "Unknown mapping profile in X-CKAN-Mapping-Profile header")
+
     body = request.get_json(force=True)
     entities = body.get("data", [])
+    if not isinstance(entities, list) or not all(isinstance(e, dict) and "id" in e for e in entities):
+        abort(400, "Unexpected notification format, expecting a list of entities in 'data'")
+
+    # JSON-LD notifications carry the context once, for all the entities
+    if body.get("@context"):
+        for e in entities:
+            e.setdefault("@context", body["@context"])
+
+    # Deletion notifications (NGSI-LD 1.6+) only carry the id and type of the deleted entities
+    if body.get("triggerReason") == ENTITY_DELETED_TRIGGER:
+        for e in entities:
+            e.setdefault("deletedAt", body.get("notifiedAt", ""))
+
+    metrics.inc("notifications_received_total", len(entities), broker=f"{hostname}:{port}", organization=organization)
+
+    # A failing broker gets 503 responses (and retries later) until its circuit closes
+    lane = get_lane(hostname, port)
+    lane.register()
+    if lane.is_open():
+        metrics.inc("lane_rejected_total", broker=lane.broker, reason="circuit_open")
+        metrics.flush()
+        return service_unavailable(f"Notifications from {lane.broker} are suspended", lane.retry_after())
+
+    if is_async_mode():
+        # Persist the notification in the jobs queue and return immediately
+        resp = jsonify(enqueue_notification(current_user.name, organization, hostname, port, entities, profile))
+        metrics.flush()
+        resp.status_code = 202
+        return resp
 
-    # Although we can get the source IP address from request.remote_addr, the
-    # domain name could not be the same as the one used to subscribe
-    broker = Client(hostname = hostname, port = port, secure = True) #, custom_auth = auth_token)
-    converter = NgsildCkanConverter(broker)
-    
-    # Workaround for patch uninitialized organization (the organization/catalogue entity was not described before, in the ngsi-ld/subscribe request moment)
-    org_id = "urn:ngsi-ld:Catalogue:" + organization
-    organization_obj, _ = converter.make_ckan_organization(org_id)
-    
-    if not organization_obj:
+    try:
+        with lane.guard():
+            found = process_notification(current_user.name, organization, hostname, port, entities, profile=profile)
+    except LaneBusy:
+        metrics.inc("lane_rejected_total", broker=lane.broker, reason="busy")
+        metrics.flush()
+        return service_unavailable(f"Too many notifications from {lane.broker} in progress", 1)
+    except CircuitOpen as e:
+        metrics.inc("lane_rejected_total", broker=lane.broker, reason="circuit_open")
+        metrics.flush()
+        return service_unavailable(str(e), e.retry_after)
+
+    if not found:
         resp = jsonify("")
         resp.status_code = 404
         return resp
-    
-    logic.action.patch.organization_patch(context, organization_obj)
-
-    organization = to_ckan_valid_name(organization)
-    for e in entities:
-        entity = Entity(e)
-        log.debug("Entity: %s", entity)
-        if (
-            entity.type != "Dataset"
-            and entity.type
-            != str(SDMDCAT["Dataset"])
-        ):
-            log.debug("Ignoring entity of type: %s", entity.type)
-            continue
-        # TODO: Change functions to support Entity
-        package, _ = converter.make_ckan_package(entity.id)
-        if converter.package_has_resources(package):
-            package["owner_org"] = organization
-            
-            package.pop("id", None) # 'The input field id was not expected' --> this happends when dataset["resources"] is empty
-            # In case of error or not valid permissions, abort with exception
-            try:
-                package_response = logic.action.create.package_create(context, package)
-                log.debug("Package created: %s", package_response)
-            except logic.ValidationError: # Resources uris already exists --> we have to recreate the package in order to include the lastest changes or additions
-                # Patch entire dataset -- https://docs.ckan.org/en/2.10/api/index.html?highlight=ogic+action+patch+package_patch#ckan.logic.action.patch.package_patch
-                                     # -- raises error trying to access the resources
-                # package["id"] = package_id
-                # package_response = logic.action.patch.package_patch(context, package)
-                # log.debug("Package updated: %s", package_response)
-
-                # Delete dataset
-                data_dict = {"id": package["name"]}
-                context['user'] = "ckan_admin" # Only sysadmin can purge organizations/datasets/distributions
-                logic.action.delete.dataset_purge(context, data_dict)
-                
-                # Recreate dataset
-                context["user"] = current_user.name
-                package_response = logic.action.create.package_create(context, package)
-                log.debug("Package updated: %s", package_response)
             
     resp = jsonify([e["id"] for e in entities])
     resp.status_code = 201
@@ -149,79 +159,125 @@ def ngsild_notifications_action():
     return resp
 
 
-# ckan.plugins.toolkit.auth_disallow_anonymous_access
-
-def purge_organization(organization_id: str) -> dict:
-    ctx = {"model": logic.model, "user": "ckan_admin"} # purge actions can only be done by ckan_admin
+def service_unavailable(message: str, retry_after: float):
+    resp = make_response(message, 503)
+    resp.headers["Retry-After"] = str(max(math.ceil(retry_after), 1))
+    return resp
 
-    try:
-        ckan_org = logic.action.get.organization_show(
-            ctx,
-            {
-                "id": organization_id,
-                "include_datasets": True,
-            },
-        )
 
-        for pkg in ckan_org["packages"]:
-            log.debug("Deleting CKAN package: %s", pkg["id"])
-            logic.action.delete.dataset_purge(ctx, {"id": pkg["id"]})
+# ckan.plugins.toolkit.auth_disallow_anonymous_access
 
-        a = logic.action.delete.organization_purge(
-            {"model": logic.model, "user": "ckan_admin"},
-            {"id": organization_id},
-        )
-    except logic.NotFound:
-        pass
+def _write_chunk(ctx: Context, chunk: list, organization_id: str):
+    with suspended_indexing():
+        package_ids = write_packages(ctx, chunk, organization_id)
+    enqueue_indexing(package_ids)
 
 
-def initialize_organization(ctx: Context, organization_id: str, broker: Client):
-    converter = NgsildCkanConverter(broker)
+def initialize_organization(ctx: Context, organization_id: str, broker: Client, resume: bool = False, profile: str = None):
+    converter = get_converter(broker, profile)
 
-    # TODO: Check to use yield/generators
-    organization, packages = converter.make_ckan_organization(organization_id)
+    try:
+        catalog = converter._get_ngsild_entity(organization_id)
+    except Exception as e:
+        log.error("Error retrieving catalogue %s from broker: %s", organization_id, e)
+        return
 
+    organization = converter.organization_from_catalog(catalog)
     if organization:
         organization = logic.action.patch.organization_patch(ctx, organization)
 
-    for package in packages:
-        # Add to CKAN only if package has resources
-        if converter.package_has_resources(package):
-            package["owner_org"] = organization_id
-            id = package.pop("id") # only sysadmin can set package_id
-            # On CKAN boot up, the database can be already populated
-            # and packages and organizations might already exist
-            # try:
-            #     package = logic.action.patch.package_patch(ctx, package)
-            # except logic.NotFound:
-            #     package = logic.action.create.package_create(ctx, package)
-            package = logic.action.create.package_create(ctx, package)
-        # update_dict = {"id": package["id"], "organization_id": organization_id}
-        # logic.action.update.package_owner_org_update(ctx, update_dict)
-
-
-def check_resubscription(ctx: Context, organization_id: str, broker: Client, package_titles: list):
+    # Packages are written as they are converted, instead of crawling the whole catalogue first
+    dataset_ids = converter.get_dataset_ids(catalog)
+
+    # When resuming, the datasets already recorded in the entity index are not processed again
+    processed = NgsildEntity.existing_ids(dataset_ids, organization_id) if resume else set()
+    pending = [d for d in dataset_ids if d not in processed]
+    log.info(
+        "Initializing organization %s with %d datasets (%d already processed)",
+        organization_id, len(dataset_ids), len(processed),
+    )
+
+    bootstrap = NgsildBootstrap.start(organization_id, len(dataset_ids), len(processed))
+    bulk_size = toolkit.asint(toolkit.config.get(BULK_SIZE_CONFIG_OPTION, DEFAULT_BULK_SIZE))
+    i = len(processed)
+    chunk = []
+    try:
+        # Packages are committed in chunks without being indexed, and each chunk
+        # is indexed in a single batch by a background job, outside of the
+        # subscription request
+        with metrics.stage("bootstrap", broker=metrics.broker_label(broker.url), organization=organization_id):
+            for i, package in enumerate(converter.iter_ckan_packages(pending), len(processed) + 1):
+                # Add to CKAN only if package has resources
+                if converter.package_has_resources(package):
+                    package["owner_org"] = organization_id
+                    chunk.append(package)
+
+                if len(chunk) >= bulk_size:
+                    # On CKAN boot up, the database can be already populated
+                    # and packages and organizations might already exist
+                    _write_chunk(ctx, chunk, organization_id)
+                    chunk = []
+                    bootstrap.checkpoint(i)
+
+                if i % PROGRESS_LOG_INTERVAL == 0:
+                    log.info("Organization %s: %d/%d packages converted", organization_id, i, len(dataset_ids))
+
+            _write_chunk(ctx, chunk, organization_id)
+    except Exception as e:
+        logic.model.Session.rollback()
+        bootstrap.checkpoint(i - len(chunk))
+        bootstrap.finish(str(e))
+        log.error("Organization %s initialization stopped after %d packages: %s", organization_id, i - len(chunk), e)
+        raise
+    finally:
+        metrics.flush()
+
+    bootstrap.checkpoint(i)
+    bootstrap.finish()
+    log.info("Organization %s initialized", organization_id)
+
+
+def get_package_titles(ctx: Context, organization_id: str) -> set:
+    # Titles of all the packages of the organization, paging through the search index
+    titles = set()
+    start = 0
+    while True:
+        result = logic.action.get.package_search(
+            dict(ctx),
+            {
+                "fq": f'owner_org:"{organization_id}"',
+                "fl": ["title"],
+                "rows": SEARCH_PAGE_SIZE,
+                "start": start,
+                "include_private": True,
+            },
+        )
+        titles.update(p["title"] for p in result["results"])
+        start += SEARCH_PAGE_SIZE
+        if start >= result["count"]:
+            return titles
+
+
+def check_resubscription(ctx: Context, organization_id: str, broker: Client, profile: str = None):
     #TODO: this method does not check if an already existing package has undergone some changes (for example: new author, keywords, etc)
     #      so these changes will be lost/missing until a notification arrives from this dataset
-    converter = NgsildCkanConverter(broker)
+    converter = get_converter(broker, profile)
     catalog = converter._get_ngsild_entity(organization_id)
-    catalog = catalog.to_ngsi_dict()
-    
-
-    datasets = (
-        catalog[str(SDMDCAT["dataset"])].value
-        if isinstance(catalog[str(SDMDCAT["dataset"])].value, list)
-        else [catalog[str(SDMDCAT["dataset"])].value]
-    )
+    datasets = converter.get_dataset_ids(catalog)
 
     # check if new datasets have been injected into the Context Broker while unsubscribed.
-    for d in datasets:
-        if ":".join(d.split(":")[-2:]) not in package_titles:
-            p, _ = converter.make_ckan_package(d)
-            p["owner_org"] = organization_id
-            p.pop("id")
-            package = logic.action.create.package_create(ctx, p)
-    
+    # Datasets in the entity index for this organization already have a package
+    new_datasets = set(datasets) - NgsildEntity.existing_ids(datasets, organization_id)
+    if new_datasets:
+        # Packages created before the entity index existed are matched by title
+        package_titles = get_package_titles(ctx, organization_id)
+        new_datasets = {d for d in new_datasets if ":".join(d.split(":")[-2:]) not in package_titles}
+
+    log.debug("Organization %s: %d new datasets", organization_id, len(new_datasets))
+    for p in converter.make_ckan_packages([d for d in datasets if d in new_datasets]):
+        p["owner_org"] = organization_id
+        # Packages already written with the same content are skipped
+        sync_package(ctx, p, organization_id)
 
 
 @logic.auth_disallow_anonymous_access
@@ -266,6 +322,11 @@ def ngsild_subscribe_action():
     friendly_name: str = body.get("friendlyName", None)
     organization: str = body.get("organization", None)
     token: str = body.get("ckan_token", None)
+    # "resume" (default) continues an interrupted organization initialization,
+    # "fresh" runs the whole initialization again
+    bootstrap_mode: str = body.get("bootstrap", BOOTSTRAP_RESUME)
+    # Mapping profile of the data model of the broker (the configured default one if missing)
+    profile: str = body.get("profile", None)
     # TODO: non-expiring auth token so it can go appended to the subscription/notifications
     # auth_token: str = body.get("auth_token", None)
     # if not auth_token:
@@ -277,8 +338,16 @@ def ngsild_subscribe_action():
             "Missing parameters. Expected: hostname, port, friendly_name, ckan_token",
         )
 
+    if bootstrap_mode not in (BOOTSTRAP_RESUME, BOOTSTRAP_FRESH):
+        abort(400, "Unexpected bootstrap parameter, expecting 'resume' or 'fresh'")
+
+    try:
+        mapping_profile = get_profile(profile)
+    except MappingProfileError:
+        abort(400, "Unknown mapping profile, expecting one of: " + ", ".join(profile_names()))
+
     # Create Context Broker client
-    broker = Client(hostname = hostname, port = port, secure = True) #, custom_auth = auth_token)
+    broker = get_client(hostname, port, secure = True) #, custom_auth = auth_token)
 
     # Create organization if it does not exist and assign it to the current user
     # If the organization exists, the current user will be added to it as editor
@@ -328,12 +397,13 @@ def ngsild_subscribe_action():
                 context, data_dict
             )
         
-        # Resubscription --> organization already exists and a package has been injected into the Broker while unsubscribed
-        # package_titles = [p.get("title") for p in ckan_org['packages']] # organization_show returns only the first 10 datasets
-        package_list = logic.action.get.current_package_list_with_resources(context, {"limit": 100})
-        package_titles = [p['title'] for p in package_list if p['organization']['name'] == org_name]
-        
-        check_resubscription(context, org_id, broker, package_titles)
+        # Interrupted initialization --> resume it, unless a fresh one is requested
+        bootstrap = NgsildBootstrap.get(org_id)
+        if bootstrap_mode == BOOTSTRAP_FRESH or (bootstrap is not None and bootstrap.is_unfinished):
+            initialize_organization(context, org_id, broker, resume=bootstrap_mode != BOOTSTRAP_FRESH, profile=mapping_profile.name)
+        else:
+            # Resubscription --> organization already exists and a package has been injected into the Broker while unsubscribed
+            check_resubscription(context, org_id, broker, profile=mapping_profile.name)
     
     except logic.NotFound as e:
         data_dict = {
@@ -347,7 +417,7 @@ def ngsild_subscribe_action():
         org = logic.action.create.organization_create(context, data_dict)
         log.debug("CKAN organization %s created", org)
         
-        initialize_organization(context, data_dict["id"], broker)
+        initialize_organization(context, data_dict["id"], broker, profile=mapping_profile.name)
 
 
     # TODO: 2+ organizations for the same Context Broker 
@@ -371,6 +441,7 @@ def ngsild_subscribe_action():
                     "X-CKAN-Organization": organization,
                     "X-NGSILD-Broker-Host": hostname,
                     "X-NGSILD-Broker-Port": port,
+                    "X-CKAN-Mapping-Profile": mapping_profile.name,
                     # TODO: non-expiring auth token so it can go appended to the subscription/notifications
                     # "X-NGSILD-Broker-Auth-Token": auth_token     
                 },
@@ -383,18 +454,25 @@ def ngsild_subscribe_action():
             # TODO: add idPattern for select_entities?
             # .select_entities("Catalogue")
             .select_entities(
-                str(SDMDCAT["Dataset"])
+                mapping_profile.type_of("dataset")
+            )
+            # Catalogue notifications keep the cached catalogue up to date
+            .select_entities(
+                mapping_profile.type_of("catalogue")
             )
             # .select_entities("Distribution")
             # .context(DEFAULT_NGSILD_CONTEXT)
             .build()
         )
+        # The builder has no notificationTrigger, it is set on the payload
+        payload = subscr.to_dict()
+        payload["notificationTrigger"] = NOTIFICATION_TRIGGERS
 
-        log.debug(subscr.to_dict())
+        log.debug(payload)
 
         
         # TODO: Check if subscription already exists and check for exception/status code
-        id = broker.subscriptions.create(subscr)
+        id = broker.subscriptions.create(payload)
 
         resp = make_response("", 204)
         resp.headers["Location"] = (
@@ -461,7 +539,7 @@ def ngsild_unsubscribe_action():
             "Missing parameters. Expected: hostname, port, friendly_name, token",
         )
 
-    broker = Client(hostname = hostname, port = port, secure = True) #, custom_auth = auth_token)
+    broker = get_client(hostname, port, secure = True) #, custom_auth = auth_token)
     status_code = broker.subscriptions.delete(
         SUBSCRIPTION_ID_PATTERN + to_ckan_valid_name(organization) + ":" + to_ckan_valid_name(friendly_name)
     )
@@ -470,9 +548,25 @@ def ngsild_unsubscribe_action():
     return resp
 
 
+def ngsild_metrics_action():
+    """Expose the ingestion metrics in the Prometheus text exposition format"""
+    if not authz.is_sysadmin(current_user.name):
+        abort(403, "Only sysadmins can read the metrics")
+
+    try:
+        extra = lane_gauges()
+    except Exception as e:
+        log.warning("Error reading lane statistics: %s", e)
+        extra = {}
+
+    return Response(metrics.render(extra), mimetype="text/plain; version=0.0.4")
+
+
 class HarvestNgsildPlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IConfigurer)
+    plugins.implements(plugins.IConfigurable)
     plugins.implements(plugins.IBlueprint)
+    plugins.implements(plugins.IClick)
 
     # IConfigurer
 
@@ -481,6 +575,15 @@ class HarvestNgsildPlugin(plugins.SingletonPlugin):
         toolkit.add_public_directory(config_, "public")
         toolkit.add_resource("fanstatic", "harvest_ngsild")
 
+    # IConfigurable
+
+    def configure(self, config_):
+        # Mapping profiles are parsed, validated and compiled once, a broken profile stops the startup
+        load_profiles(
+            toolkit.aslist(config_.get(MAPPING_PROFILES_CONFIG_OPTION, "")),
+            config_.get(DEFAULT_MAPPING_PROFILE_CONFIG_OPTION, DEFAULT_PROFILE),
+        )
+
     # IBlueprint
 
     # Use IBlueprint instead of the former IController
@@ -514,4 +617,16 @@ class HarvestNgsildPlugin(plugins.SingletonPlugin):
             methods=["POST"],
         )
 
+        blueprint.add_url_rule(
+            "/ngsi-ld/metrics",
+            BLUEPRINT_NGSILD_METRICS_ACTION_NAME,
+            ngsild_metrics_action,
+            methods=["GET"],
+        )
+
         return blueprint
+
+    # IClick
+
+    def get_commands(self):
+        return cli.get_commands()
@@ -0,0 +1,172 @@
+from ckan.types import Context
+
+from . import metrics
+from .constants import SDMDCAT
+from .deletions import delete_datasets
+from .indexing import deferred_indexing
+from .model import NgsildEntity
+from .ngsild_ckan_converter import NgsildCkanConverter
+from .packages import write_packages
+
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import logging
+
+log = logging.getLogger(__name__)
+
+DEFAULT_RECONCILE_BATCH_SIZE = 500
+
+ADDED = "added"
+UPDATED = "updated"
+UNCHANGED = "unchanged"
+DELETED = "deleted"
+FAILED = "failed"
+
+
+def merge_ids(
+    broker_ids: Iterator[str],
+    indexed: Iterator[Tuple[str, Optional[str], Optional[str]]],
+) -> Iterator[Tuple[str, Optional[Tuple[str, Optional[str], Optional[str]]], bool]]:
+    """Merge join of the sorted broker dataset ids and the sorted entity index rows.
+
+    Yields (id, index row or None, in broker). A single pass over both sides
+    is enough, neither of them is loaded into memory.
+    """
+    broker_id = next(broker_ids, None)
+    row = next(indexed, None)
+    while broker_id is not None or row is not None:
+        if row is None or (broker_id is not None and broker_id < row[0]):
+            yield broker_id, None, True
+            broker_id = next(broker_ids, None)
+        elif broker_id is None or row[0] < broker_id:
+            yield row[0], row, False
+            row = next(indexed, None)
+        else:
+            yield broker_id, row, True
+            broker_id = next(broker_ids, None)
+            row = next(indexed, None)
+
+
+class Reconciliation:
+    """Full synchronization of an organization with its Catalogue in the broker.
+
+    Datasets only in the broker are added, datasets modified since they were
+    written are updated and packages of datasets no longer in the catalogue
+    are deleted (as configured by the deletion mode). Changes are applied in
+    batches as the merge goes on.
+    """
+
+    def __init__(
+        self,
+        context: Context,
+        converter: NgsildCkanConverter,
+        organization_id: str,
+        batch_size: int = DEFAULT_RECONCILE_BATCH_SIZE,
+        delete: bool = True,
+        dry_run: bool = False,
+    ):
+        self.context = context
+        self.converter = converter
+        self.organization_id = organization_id
+        self.batch_size = batch_size
+        self.delete = delete
+        self.dry_run = dry_run
+        self.counts = {k: 0 for k in (ADDED, UPDATED, UNCHANGED, DELETED, FAILED)}
+        # Datasets in the broker, with their modifiedAt in the entity index (None if not indexed)
+        self.pending: List[Tuple[str, Optional[str], bool]] = []
+        # Datasets removed from the catalogue
+        self.removed: List[str] = []
+
+    def run(self) -> Dict[str, int]:
+        try:
+            catalog = self.converter._get_ngsild_entity(self.organization_id)
+        except Exception as e:
+            log.error("Error retrieving catalogue %s from broker: %s", self.organization_id, e)
+            raise
+
+        # The dataset ids are already listed in the catalogue, only the ids are
+        # sorted in memory, the datasets are retrieved batch by batch
+        broker_ids = iter(sorted(set(self.converter.get_dataset_ids(catalog))))
+        indexed = NgsildEntity.iter_organization(self.organization_id, str(SDMDCAT["Dataset"]))
+
+        with metrics.stage("reconcile", broker=metrics.broker_label(self.converter.broker.url), organization=self.organization_id):
+            for id, row, in_broker in merge_ids(broker_ids, indexed):
+                if in_broker:
+                    self.pending.append((id, row[1] if row else None, row is not None))
+                    if len(self.pending) >= self.batch_size:
+                        self._apply_pending()
+                elif self.delete:
+                    self.removed.append(id)
+                    if len(self.removed) >= self.batch_size:
+                        self._apply_removed()
+            self._apply_pending()
+            self._apply_removed()
+
+        log.info("Organization %s reconciled: %s", self.organization_id, self.counts)
+        return self.counts
+
+    def _apply_pending(self):
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+
+        # modifiedAt is a system attribute, it has to be requested explicitly
+        datasets = self.converter._get_ngsild_entities(
+            [id for id, _, _ in pending],
+            type=self.converter.profile.type_of("dataset"),
+            sys_attrs=True,
+        )
+
+        changed = []
+        modified_at = {}
+        for id, indexed_modified_at, is_indexed in pending:
+            dataset = datasets.get(id)
+            if dataset is None:
+                self.counts[FAILED] += 1
+                continue
+            # Without modifiedAt, the content hash of the package tells whether it changed
+            if is_indexed and dataset.modified_at and dataset.modified_at == indexed_modified_at:
+                self.counts[UNCHANGED] += 1
+                continue
+            self.counts[UPDATED if is_indexed else ADDED] += 1
+            changed.append(dataset)
+            if dataset.modified_at:
+                modified_at[id] = dataset.modified_at
+
+        if self.dry_run or not changed:
+            return
+
+        packages = []
+        for package in self.converter.packages_from_datasets(changed):
+            # Add to CKAN only if package has resources
+            if self.converter.package_has_resources(package):
+                package["owner_org"] = self.organization_id
+                packages.append(package)
+
+        # Packages of the batch are committed together and indexed in a single Solr commit
+        with deferred_indexing() as package_ids:
+            package_ids.update(write_packages(self.context, packages, self.organization_id, modified_at))
+
+    def _apply_removed(self):
+        removed, self.removed = self.removed, []
+        if not removed:
+            return
+
+        if self.dry_run:
+            self.counts[DELETED] += len(removed)
+            return
+
+        deleted = delete_datasets(self.context, self.organization_id, removed)
+        self.counts[DELETED] += len(deleted)
+
+
+def reconcile_organization(
+    context: Context,
+    converter: NgsildCkanConverter,
+    organization_id: str,
+    batch_size: int = DEFAULT_RECONCILE_BATCH_SIZE,
+    delete: bool = True,
+    dry_run: bool = False,
+) -> Dict[str, int]:
+    """Reconcile an organization with its Catalogue. Returns the number of datasets of each result."""
+    return Reconciliation(context, converter, organization_id, batch_size, delete, dry_run).run()
@@ -0,0 +1,41 @@
+"""
+Fixtures of the benchmark suite.
+
+The size of the synthetic catalogue and the latency of the fake broker are
+set with environment variables:
+
+    NGSILD_BENCHMARK_DATASETS       number of datasets (default 100)
+    NGSILD_BENCHMARK_DISTRIBUTIONS  distributions per dataset (default 3)
+    NGSILD_BENCHMARK_LATENCY        seconds added to every broker response (default 0)
+"""
+import os
+
+import pytest
+
+from ngsildclient import Client
+
+from ckanext.harvest_ngsild.mapping import get_profile
+from ckanext.harvest_ngsild.ngsild_ckan_converter import NgsildCkanConverter
+
+from .fake_broker import FakeBroker
+
+
+@pytest.fixture(scope="session")
+def fake_broker():
+    broker = FakeBroker(
+        datasets=int(os.environ.get("NGSILD_BENCHMARK_DATASETS", 100)),
+        distributions=int(os.environ.get("NGSILD_BENCHMARK_DISTRIBUTIONS", 3)),
+        latency=float(os.environ.get("NGSILD_BENCHMARK_LATENCY", 0)),
+    ).start()
+    yield broker
+    broker.stop()
+
+
+@pytest.fixture(scope="session")
+def broker_client(fake_broker):
+    return Client(hostname=fake_broker.hostname, port=fake_broker.port, secure=False)
+
+
+@pytest.fixture
+def converter(broker_client):
+    return NgsildCkanConverter(broker_client, profile=get_profile())
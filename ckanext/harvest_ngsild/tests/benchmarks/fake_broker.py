@@ -0,0 +1,192 @@
+"""
+In-process fake NGSI-LD broker serving a synthetic DCAT-AP catalogue.
+
+It answers the requests the extension sends to a Context Broker (entity
+retrieval, id list and type queries with pagination) with a configurable
+number of datasets and distributions, and an optional latency injected
+before every response to emulate a remote broker.
+"""
+import json
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+from ckanext.harvest_ngsild.constants import NGSILD_ENTITIES_ENDPOINT
+
+SDM = "https://smartdatamodels.org/"
+SDMDCAT = "https://smartdatamodels.org/dataModel.DCAT-AP/"
+
+
+def _property(value) -> dict:
+    return {"type": "Property", "value": value}
+
+
+def _relationship(object) -> dict:
+    return {"type": "Relationship", "object": object}
+
+
+def catalogue_id(name: str) -> str:
+    return f"urn:ngsi-ld:Catalogue:{name}"
+
+
+def dataset_id(name: str, i: int) -> str:
+    return f"urn:ngsi-ld:Dataset:{name}:{i}"
+
+
+def distribution_id(name: str, i: int, j: int) -> str:
+    return f"urn:ngsi-ld:Distribution:{name}:{i}:{j}"
+
+
+def make_catalogue(name: str, datasets: int) -> dict:
+    return {
+        "id": catalogue_id(name),
+        "type": SDMDCAT + "Catalogue",
+        "title": _property(name),
+        "description": _property(f"Synthetic catalogue {name}"),
+        SDMDCAT + "homepage": _property(f"https://{name}.example.org"),
+        SDMDCAT + "dataset": _property([dataset_id(name, i) for i in range(datasets)]),
+    }
+
+
+def make_dataset(name: str, i: int, distributions: int) -> dict:
+    return {
+        "id": dataset_id(name, i),
+        "type": SDMDCAT + "Dataset",
+        "title": _property(f"{name}:{i}"),
+        "description": _property([f"Synthetic dataset {i}", f"of catalogue {name}"]),
+        SDMDCAT + "creator": _property("benchmark"),
+        SDMDCAT + "publisher": _property(name),
+        SDMDCAT + "license": _property("CC-BY-4.0"),
+        SDMDCAT + "keyword": _property(["synthetic", "benchmark", f"dataset-{i}"]),
+        SDMDCAT + "theme": _property(["environment", "transport"]),
+        SDMDCAT + "language": _property(["en", "es"]),
+        SDM + "dateCreated": _property("2023-01-01T00:00:00Z"),
+        SDM + "dateModified": _property("2023-06-01T00:00:00Z"),
+        SDMDCAT + "distribution": _property([distribution_id(name, i, j) for j in range(distributions)]),
+    }
+
+
+def make_distribution(name: str, i: int, j: int) -> dict:
+    return {
+        "id": distribution_id(name, i, j),
+        "type": SDMDCAT + "Distribution",
+        "title": _property(f"Distribution {j} of dataset {i}"),
+        "description": _property(f"Synthetic distribution {j}"),
+        "format": _property("CSV"),
+        SDMDCAT + "accessUrl": _property(f"https://{name}.example.org/{i}/{j}.csv"),
+        SDMDCAT + "downloadURL": _property(f"https://{name}.example.org/{i}/{j}.csv"),
+        SDMDCAT + "mediaType": _property("text/csv"),
+        SDMDCAT + "byteSize": _property(1024 * (j + 1)),
+        SDM + "dateCreated": _property("2023-01-01T00:00:00Z"),
+    }
+
+
+class FakeBroker:
+    """Synthetic catalogue served over HTTP from a background thread"""
+
+    def __init__(self, name: str = "benchmark", datasets: int = 100, distributions: int = 3, latency: float = 0):
+        self.name = name
+        self.latency = latency
+        self.entities = {}
+        self.requests = 0
+        # Status code answered to id list queries, as brokers not supporting them do (None to serve them)
+        self.id_query_status = None
+
+        self.add(make_catalogue(name, datasets))
+        for i in range(datasets):
+            self.add(make_dataset(name, i, distributions))
+            for j in range(distributions):
+                self.add(make_distribution(name, i, j))
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def hostname(self) -> str:
+        return self.server.server_address[0]
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    @property
+    def catalogue_id(self) -> str:
+        return catalogue_id(self.name)
+
+    def dataset_ids(self) -> list:
+        return [id for id, e in self.entities.items() if e["type"] == SDMDCAT + "Dataset"]
+
+    def add(self, entity: dict):
+        self.entities[entity["id"]] = entity
+
+    def start(self) -> "FakeBroker":
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def query(self, params: dict) -> list:
+        ids = params.get("id", [""])[0]
+        types = params.get("type", [""])[0]
+        entities = (
+            [self.entities[id] for id in ids.split(",") if id in self.entities]
+            if ids
+            else list(self.entities.values())
+        )
+        if types:
+            entities = [e for e in entities if e["type"] in types.split(",")]
+        return entities
+
+    def _handler(self):
+        broker = self
+        prefix = "/" + NGSILD_ENTITIES_ENDPOINT
+
+        class Handler(BaseHTTPRequestHandler):
+            def _send(self, status: int, body=None, headers=None):
+                if broker.latency:
+                    time.sleep(broker.latency)
+                data = json.dumps(body).encode("utf-8") if body is not None else b""
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                broker.requests += 1
+                url = urlparse(self.path)
+                params = parse_qs(url.query)
+
+                if url.path.startswith(prefix + "/"):
+                    entity = broker.entities.get(unquote(url.path[len(prefix) + 1:]))
+                    if entity is None:
+                        return self._send(404, {"type": "https://uri.etsi.org/ngsi-ld/errors/ResourceNotFound"})
+                    return self._send(200, entity)
+
+                if url.path == prefix:
+                    if params.get("id") and broker.id_query_status:
+                        return self._send(broker.id_query_status, {"type": "https://uri.etsi.org/ngsi-ld/errors/BadRequestData"})
+                    entities = broker.query(params)
+                    offset = int(params.get("offset", ["0"])[0])
+                    limit = int(params.get("limit", [str(len(entities))])[0])
+                    headers = {"NGSILD-Results-Count": str(len(entities))} if params.get("count") else None
+                    return self._send(200, entities[offset:offset + limit], headers)
+
+                # Anything else the client may ask for (types, subscriptions, ...)
+                return self._send(200, [])
+
+            def do_POST(self):
+                broker.requests += 1
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self._send(201)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
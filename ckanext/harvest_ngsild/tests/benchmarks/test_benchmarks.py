@@ -0,0 +1,100 @@
+"""
+Benchmarks of the NGSI-LD to CKAN conversion and ingestion pipeline.
+
+They run against the in-process fake broker of fake_broker.py and need the
+pytest-benchmark plugin (dev-requirements.txt):
+
+    pytest --ckan-ini=test.ini --benchmark-only ckanext/harvest_ngsild/tests/benchmarks
+"""
+import itertools
+
+import pytest
+
+from ngsildclient import Entity
+
+from ckan.plugins import toolkit
+from ckan.tests import factories, helpers
+
+import ckanext.harvest_ngsild.notifications as notifications
+
+from ckanext.harvest_ngsild.ngsild_ckan_converter import EntityView, NgsildCkanConverter
+
+from .fake_broker import make_dataset, make_distribution
+
+
+def test_ngsild_to_ckan(benchmark, converter, fake_broker):
+    entities = [Entity(fake_broker.entities[id]) for id in fake_broker.dataset_ids()]
+
+    def convert():
+        for entity in entities:
+            NgsildCkanConverter.ngsild_to_ckan(EntityView(entity, converter.ctx), converter.profile.package)
+
+    benchmark(convert)
+    benchmark.extra_info["entities"] = len(entities)
+
+
+def test_make_ckan_package(benchmark, converter, fake_broker):
+    dataset_id = fake_broker.dataset_ids()[0]
+
+    package, resources = benchmark(converter.make_ckan_package, dataset_id)
+
+    assert package["title"]
+    assert len(resources) == len(fake_broker.entities[dataset_id]["https://smartdatamodels.org/dataModel.DCAT-AP/distribution"]["value"])
+
+
+def test_make_ckan_organization(benchmark, converter, fake_broker):
+    before = fake_broker.requests
+
+    organization, packages = benchmark.pedantic(
+        converter.make_ckan_organization, args=(fake_broker.catalogue_id,), rounds=3, iterations=1
+    )
+
+    assert organization["id"] == fake_broker.catalogue_id
+    assert len(packages) == len(fake_broker.dataset_ids())
+    benchmark.extra_info["datasets"] = len(packages)
+    benchmark.extra_info["broker_requests_per_round"] = (fake_broker.requests - before) // 3
+
+
+@pytest.fixture
+def ingestion(migrate_db_for, clean_db, with_plugins, broker_client, fake_broker, monkeypatch):
+    migrate_db_for("harvest_ngsild")
+
+    sysadmin = factories.Sysadmin()
+    token = factories.APIToken(user=sysadmin["name"])["token"]
+    helpers.call_action(
+        "organization_create",
+        context={"user": sysadmin["name"]},
+        id=fake_broker.catalogue_id,
+        name=fake_broker.name,
+    )
+    # The fake broker is plain HTTP, notifications would connect with TLS
+    monkeypatch.setattr(notifications, "get_client", lambda *args, **kwargs: broker_client)
+    return token
+
+
+@pytest.mark.ckan_config("ckanext.harvest_ngsild.notifications_mode", "sync")
+def test_notification_latency(benchmark, app, ingestion, fake_broker):
+    url = toolkit.url_for("harvest_ngsild.ngsi-ld-notifications")
+    headers = {
+        "Authorization": ingestion,
+        "X-CKAN-Organization": fake_broker.name,
+        "X-NGSILD-Broker-Host": fake_broker.hostname,
+        "X-NGSILD-Broker-Port": str(fake_broker.port),
+    }
+    # A new dataset per round, so every notification creates a package
+    counter = itertools.count(len(fake_broker.dataset_ids()))
+
+    def setup():
+        i = next(counter)
+        for j in range(2):
+            fake_broker.add(make_distribution(fake_broker.name, i, j))
+        dataset = make_dataset(fake_broker.name, i, 2)
+        fake_broker.add(dataset)
+        return (), {"json": {"data": [dataset]}}
+
+    def notify(json):
+        return app.post(url, json=json, headers=headers)
+
+    response = benchmark.pedantic(notify, setup=setup, rounds=20, iterations=1)
+
+    assert response.status_code == 201
@@ -0,0 +1,21 @@
+"""Fixtures shared by the tests of the extension."""
+import pytest
+
+from ckan.lib.redis import connect_to_redis
+
+REDIS_KEY_PATTERN = "ckanext-harvest_ngsild:*"
+
+
+def _delete_keys(redis):
+    keys = list(redis.scan_iter(REDIS_KEY_PATTERN))
+    if keys:
+        redis.delete(*keys)
+
+
+@pytest.fixture
+def redis():
+    """Redis of the CKAN instance, without any key of the extension"""
+    redis = connect_to_redis()
+    _delete_keys(redis)
+    yield redis
+    _delete_keys(redis)
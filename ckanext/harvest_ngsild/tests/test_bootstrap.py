@@ -0,0 +1,106 @@
+"""Tests for the initialization (bootstrap) of an organization in plugin.py."""
+from unittest import mock
+
+import pytest
+
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.harvest_ngsild import indexing, plugin
+from ckanext.harvest_ngsild.ngsild_ckan_converter import NgsildCkanConverter
+
+ORGANIZATION_ID = "urn:ngsi-ld:Catalogue:org"
+DATASET_IDS = [f"urn:ngsi-ld:Dataset:{i}" for i in range(1, 6)]
+
+
+class FakeCkan:
+    """Packages written into CKAN (and recorded in the entity index) by write_packages"""
+
+    def __init__(self, fail_on_call=None):
+        self.written = []
+        self.calls = 0
+        self.fail_on_call = fail_on_call
+        self.indexed_on_commit = False
+
+    def write_packages(self, ctx, packages, organization_id):
+        self.calls += 1
+        if not indexing.model.Session.info.get(indexing.SUSPENDED_INDEXING_KEY):
+            self.indexed_on_commit = True
+        if self.calls == self.fail_on_call:
+            raise RuntimeError("Database is down")
+        self.written += [p["id"] for p in packages]
+        return [p["name"] for p in packages]
+
+    def existing_ids(self, ids, organization_id):
+        return {id for id in ids if id in self.written}
+
+
+def _converter():
+    converter = mock.Mock()
+    converter.organization_from_catalog.return_value = {}
+    converter.get_dataset_ids.return_value = DATASET_IDS
+    converter.iter_ckan_packages.side_effect = lambda ids: (
+        {"id": id, "name": id.lower().replace(":", "_"), "resources": [{"url": "https://example.org"}]}
+        for id in ids
+    )
+    converter.package_has_resources.side_effect = NgsildCkanConverter.package_has_resources
+    return converter
+
+
+@pytest.fixture
+def session():
+    with mock.patch.object(indexing.model, "Session", mock.Mock(info={})) as session:
+        yield session
+
+
+@pytest.fixture
+def bootstrap(session):
+    with mock.patch.object(plugin, "NgsildBootstrap") as bootstrap_model:
+        yield bootstrap_model.start.return_value
+
+
+@mock.patch.object(plugin, "enqueue_indexing")
+@mock.patch.dict(toolkit.config, {plugin.BULK_SIZE_CONFIG_OPTION: "2"})
+def test_interrupted_bootstrap_resumes_from_checkpoint(enqueue_indexing, bootstrap):
+    ckan = FakeCkan(fail_on_call=2)
+    converter = _converter()
+
+    with mock.patch.object(plugin, "get_converter", return_value=converter), \
+            mock.patch.object(plugin, "write_packages", side_effect=ckan.write_packages), \
+            mock.patch.object(plugin.NgsildEntity, "existing_ids", side_effect=ckan.existing_ids), \
+            mock.patch.object(plugin.logic.model, "Session", indexing.model.Session):
+        with pytest.raises(RuntimeError):
+            plugin.initialize_organization({}, ORGANIZATION_ID, mock.Mock(url="https://broker:9090"))
+
+        # The first chunk was written, the second one failed
+        assert ckan.written == DATASET_IDS[:2]
+        bootstrap.checkpoint.assert_called_with(2)
+        assert bootstrap.finish.call_args[0] == ("Database is down",)
+
+        ckan.fail_on_call = None
+        plugin.initialize_organization({}, ORGANIZATION_ID, mock.Mock(url="https://broker:9090"), resume=True)
+
+    # Only the datasets after the checkpoint are converted and written again
+    assert converter.iter_ckan_packages.call_args[0][0] == DATASET_IDS[2:]
+    assert plugin.NgsildBootstrap.start.call_args[0] == (ORGANIZATION_ID, 5, 2)
+    assert ckan.written == DATASET_IDS
+    bootstrap.checkpoint.assert_called_with(5)
+    assert bootstrap.finish.call_args == mock.call()
+    # Chunks are not indexed as they are committed, but by a background job
+    assert not ckan.indexed_on_commit
+    assert enqueue_indexing.call_count == 3
+
+
+@mock.patch.object(plugin, "enqueue_indexing")
+@mock.patch.dict(toolkit.config, {plugin.BULK_SIZE_CONFIG_OPTION: "2"})
+def test_fresh_bootstrap_writes_every_dataset(enqueue_indexing, bootstrap):
+    ckan = FakeCkan()
+    ckan.written = DATASET_IDS[:2]
+    converter = _converter()
+
+    with mock.patch.object(plugin, "get_converter", return_value=converter), \
+            mock.patch.object(plugin, "write_packages", side_effect=ckan.write_packages), \
+            mock.patch.object(plugin.NgsildEntity, "existing_ids", side_effect=ckan.existing_ids):
+        plugin.initialize_organization({}, ORGANIZATION_ID, mock.Mock(url="https://broker:9090"))
+
+    assert converter.iter_ckan_packages.call_args[0][0] == DATASET_IDS
+    bootstrap.checkpoint.assert_called_with(5)
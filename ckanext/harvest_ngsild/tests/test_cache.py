@@ -0,0 +1,60 @@
+"""Tests for cache.py: entries expire after their TTL and the least recently used ones are evicted."""
+from unittest import mock
+
+from ckanext.harvest_ngsild import cache
+from ckanext.harvest_ngsild.cache import TTLCache
+
+
+@mock.patch.object(cache.time, "monotonic", return_value=1000)
+def test_entries_expire_after_ttl(monotonic):
+    entries = TTLCache(maxsize=10, ttl=60)
+    entries.set("a", 1)
+
+    monotonic.return_value = 1060
+    assert entries.get("a") == 1
+
+    monotonic.return_value = 1061
+    assert entries.get("a") is None
+    assert entries.get("a", "default") == "default"
+    assert len(entries) == 0
+
+
+@mock.patch.object(cache.time, "monotonic", return_value=1000)
+def test_set_renews_ttl(monotonic):
+    entries = TTLCache(maxsize=10, ttl=60)
+    entries.set("a", 1)
+
+    monotonic.return_value = 1050
+    entries.set("a", 2)
+
+    monotonic.return_value = 1100
+    assert entries.get("a") == 2
+
+
+def test_least_recently_used_entry_is_evicted():
+    entries = TTLCache(maxsize=2, ttl=60)
+    entries.set("a", 1)
+    entries.set("b", 2)
+    # Reading "a" makes "b" the least recently used entry
+    assert entries.get("a") == 1
+
+    entries.set("c", 3)
+
+    assert len(entries) == 2
+    assert entries.get("b") is None
+    assert entries.get("a") == 1
+    assert entries.get("c") == 3
+
+
+def test_invalidate_and_clear():
+    entries = TTLCache()
+    entries.set("a", 1)
+    entries.set("b", 2)
+
+    entries.invalidate("a")
+    entries.invalidate("missing")
+    assert entries.get("a") is None
+    assert entries.get("b") == 2
+
+    entries.clear()
+    assert len(entries) == 0
@@ -0,0 +1,113 @@
+"""Tests for catalogues.py: organizations are only patched when their catalogue changed, datasets are found in the catalogue index."""
+from unittest import mock
+
+import pytest
+
+import ckan.logic as logic
+
+from ngsildclient import Client
+
+from ckanext.harvest_ngsild import catalogues
+from ckanext.harvest_ngsild.mapping import get_profile, parse_profile
+from ckanext.harvest_ngsild.ngsild_ckan_converter import NgsildCkanConverter
+
+from .benchmarks.fake_broker import FakeBroker
+
+DCAT = "http://www.w3.org/ns/dcat#"
+
+ORGANIZATION = {"id": "urn:ngsi-ld:Catalog:city", "name": "city", "title": "City", "state": "active"}
+
+
+@pytest.fixture
+def profile():
+    return parse_profile({
+        "name": "dcat-catalog",
+        "context": {"dcat": DCAT},
+        "types": {"catalogue": "dcat:Catalog", "dataset": "dcat:Dataset", "distribution": "dcat:Distribution"},
+        "attributes": {"dataset": "dcat:dataset", "distribution": "dcat:distribution", "publisher": "publisher", "keyword": "dcat:keyword"},
+        "organization": {"title": "title"},
+        "package": {"title": "title"},
+        "resource": {"url": "dcat:accessURL"},
+    })
+
+
+@mock.patch.object(catalogues.NgsildEntity, "upsert")
+@mock.patch.object(catalogues.NgsildEntity, "get", return_value=None)
+@mock.patch.object(logic.action.patch, "organization_patch")
+def test_organization_is_indexed_with_the_catalogue_type_of_the_profile(organization_patch, get, upsert, profile):
+    assert catalogues.patch_organization({}, dict(ORGANIZATION), profile)
+
+    organization_patch.assert_called_once()
+    id, type = upsert.call_args[0]
+    assert id == ORGANIZATION["id"]
+    assert type == DCAT + "Catalog"
+
+
+@mock.patch.object(catalogues.NgsildEntity, "upsert")
+@mock.patch.object(logic.action.patch, "organization_patch")
+def test_unchanged_organization_is_not_patched(organization_patch, upsert, profile):
+    index = mock.Mock(content_hash=catalogues.content_hash(ORGANIZATION))
+    with mock.patch.object(catalogues.NgsildEntity, "get", return_value=index):
+        assert not catalogues.patch_organization({}, dict(ORGANIZATION), profile)
+
+    organization_patch.assert_not_called()
+    upsert.assert_not_called()
+
+
+@pytest.fixture
+def broker():
+    broker = FakeBroker(name="city", datasets=3, distributions=1)
+    broker.start()
+    yield broker
+    broker.stop()
+
+
+@pytest.fixture
+def client(broker):
+    client = Client(hostname=broker.hostname, port=broker.port, secure=False)
+    # Client creation may already have sent requests
+    broker.requests = 0
+    return client
+
+
+@pytest.mark.usefixtures("redis")
+def test_catalogue_index_is_shared_by_the_converters_of_a_broker(broker, client):
+    first, second = (NgsildCkanConverter(client, profile=get_profile()) for _ in range(2))
+    catalogues.get_catalog_index(first)
+    catalogues.get_catalog_index(second)
+
+    assert first.catalog_index.get(broker.dataset_ids()[0]) == broker.catalogue_id
+    assert broker.requests == 1
+
+    # Built by the first converter, without any query of the second one
+    assert second.catalog_index.get(broker.dataset_ids()[1]) == broker.catalogue_id
+    assert second.catalog_index.get("urn:ngsi-ld:Dataset:unknown") is None
+    assert broker.requests == 1
+
+
+@pytest.mark.usefixtures("redis")
+def test_catalogue_index_is_updated_from_catalogue_notifications(broker, client):
+    index = catalogues.get_catalog_index(NgsildCkanConverter(client, profile=get_profile()))
+    removed, *kept = broker.dataset_ids()
+    added = "urn:ngsi-ld:Dataset:city:new"
+    index.get(removed)
+
+    index.update(broker.catalogue_id, kept + [added])
+
+    assert index.get(removed) is None
+    assert index.get(added) == broker.catalogue_id
+    assert all(index.get(id) == broker.catalogue_id for id in kept)
+    assert broker.requests == 1
+
+
+@pytest.mark.usefixtures("redis")
+def test_catalogue_index_is_not_updated_before_it_is_built(broker, client):
+    index = catalogues.get_catalog_index(NgsildCkanConverter(client, profile=get_profile()))
+
+    index.update(broker.catalogue_id, ["urn:ngsi-ld:Dataset:city:new"])
+    assert broker.requests == 0
+
+    # Built from the broker on first use, which does not know the dataset yet
+    assert index.get("urn:ngsi-ld:Dataset:city:new") is None
+    assert index.get(broker.dataset_ids()[0]) == broker.catalogue_id
+    assert broker.requests == 1
@@ -0,0 +1,38 @@
+"""Tests for cli.py: the commands run end to end against CKAN and a fake broker."""
+import pytest
+
+import ckan.plugins.toolkit as toolkit
+
+from ckan.cli.cli import ckan
+from ckan.tests import factories
+
+from .benchmarks.fake_broker import FakeBroker
+
+
+@pytest.fixture
+def broker():
+    broker = FakeBroker(name="city", datasets=2, distributions=1)
+    broker.start()
+    yield broker
+    broker.stop()
+
+
+@pytest.mark.ckan_config("ckan.plugins", "harvest_ngsild")
+@pytest.mark.usefixtures("clean_db", "clean_index", "with_plugins", "redis")
+def test_reconcile_adds_missing_packages(cli, migrate_db_for, broker):
+    migrate_db_for("harvest_ngsild")
+    factories.Organization(id=broker.catalogue_id, name="city")
+
+    args = ["harvest-ngsild", "reconcile", "city", "--hostname", broker.hostname, "--port", str(broker.port), "--insecure"]
+    result = cli.invoke(ckan, args)
+
+    assert not result.exit_code, result.output
+    assert "city: 2 added, 0 updated, 0 unchanged, 0 deleted, 0 failed" in result.output
+    for i in range(2):
+        package = toolkit.get_action("package_show")({"ignore_auth": True}, {"id": f"city_{i}"})
+        assert package["owner_org"] == broker.catalogue_id
+        assert len(package["resources"]) == 1
+
+    # Nothing left to do in the next run
+    result = cli.invoke(ckan, args)
+    assert "city: 0 added, 0 updated, 2 unchanged, 0 deleted, 0 failed" in result.output
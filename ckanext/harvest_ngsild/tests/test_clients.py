@@ -0,0 +1,105 @@
+"""Tests for clients.py: broker clients are pooled per broker and closed once unused."""
+from unittest import mock
+
+import pytest
+import requests
+
+import ckan.plugins.toolkit as toolkit
+
+from requests.adapters import HTTPAdapter
+
+from ckanext.harvest_ngsild import clients
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    clock = Clock()
+    with mock.patch.object(clients.time, "monotonic", clock):
+        yield clock
+
+
+@pytest.fixture
+def registry(clock):
+    # Clients with a real session, so that their requests go through the pooled adapter
+    def client(hostname, port, secure, **kwargs):
+        return mock.Mock(url=f"http://{hostname}:{port}", session=requests.Session())
+
+    with mock.patch.object(clients, "Client", side_effect=client), \
+            mock.patch.dict(toolkit.config, {
+                clients.CLIENT_IDLE_TIMEOUT_CONFIG_OPTION: "300",
+                clients.MAX_CLIENTS_CONFIG_OPTION: "2",
+            }):
+        yield clients.ClientRegistry()
+
+
+def _request(client):
+    # Sent through the pooled adapter of the client (the connection itself is mocked)
+    client.session.get_adapter(client.url).send(requests.Request("GET", client.url).prepare())
+
+
+def test_clients_are_reused_per_broker(registry):
+    client = registry.get("broker", 9090)
+
+    assert registry.get("broker", "9090") is client
+    assert registry.get("broker", 9091) is not client
+    assert registry.get("broker", 9090, secure=False) is not client
+    assert clients.Client.call_count == 3
+
+
+def test_idle_clients_are_closed(registry, clock):
+    client = registry.get("broker", 9090)
+
+    clock.now = 301
+    registry.get("other", 9090)
+
+    assert ("broker", "9090", True, None) not in registry.clients
+    assert registry.get("broker", 9090) is not client
+
+
+@mock.patch.object(HTTPAdapter, "send")
+def test_requests_keep_the_client_in_use(send, registry, clock):
+    client = registry.get("broker", 9090)
+
+    # The client is still used by the notification that got it
+    clock.now = 200
+    _request(client)
+
+    clock.now = 400
+    registry.get("other", 9090)
+    assert registry.get("broker", 9090) is client
+
+
+@mock.patch.object(HTTPAdapter, "send")
+def test_clients_are_not_closed_while_a_request_is_in_flight(send, registry, clock):
+    client = registry.get("broker", 9090)
+
+    def slow_response(*args, **kwargs):
+        clock.now = 1000
+        # Another request needs a client meanwhile
+        registry.get("other", 9090)
+        registry.get("another", 9090)
+        assert registry.clients[("broker", "9090", True, None)] is client
+        return mock.Mock()
+
+    send.side_effect = slow_response
+    _request(client)
+
+
+def test_least_recently_used_client_is_closed_beyond_the_maximum(registry, clock):
+    first = registry.get("broker", 9090)
+    second = registry.get("broker", 9091)
+    registry.get("broker", 9090)
+
+    registry.get("broker", 9092)
+
+    assert list(registry.clients) == [("broker", "9090", True, None), ("broker", "9092", True, None)]
+    assert registry.get("broker", 9090) is first
+    assert registry.get("broker", 9091) is not second
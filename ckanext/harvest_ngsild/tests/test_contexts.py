@@ -0,0 +1,50 @@
+"""Tests for contexts.py: expansion of attribute names and entity types with the shipped JSON-LD contexts."""
+from unittest import mock
+
+from ckanext.harvest_ngsild.constants import DEFAULT_NGSILD_CONTEXT, SDM_DCAT_AP_CONTEXT
+from ckanext.harvest_ngsild.contexts import expand, missing_contexts
+
+SDMDCAT = "https://smartdatamodels.org/dataModel.DCAT-AP/"
+DEFAULT_VOCAB = "https://uri.etsi.org/ngsi-ld/default-context/"
+REMOTE_CONTEXT = "https://example.org/context.jsonld"
+
+
+def test_terms_of_the_shipped_contexts():
+    assert expand("Dataset", SDM_DCAT_AP_CONTEXT) == SDMDCAT + "Dataset"
+    assert expand("releaseDate", SDM_DCAT_AP_CONTEXT) == SDMDCAT + "releaseDate"
+    assert expand("createdAt") == "https://uri.etsi.org/ngsi-ld/createdAt"
+
+
+def test_iris_and_keywords_are_kept():
+    assert expand(SDMDCAT + "Dataset") == SDMDCAT + "Dataset"
+    assert expand("urn:ngsi-ld:Dataset:1") == "urn:ngsi-ld:Dataset:1"
+    assert expand("@id") == "@id"
+
+
+def test_inline_context():
+    ctx = [{"dcat": "http://www.w3.org/ns/dcat#", "distribution": "dcat:distribution"}, DEFAULT_NGSILD_CONTEXT]
+
+    assert expand("distribution", ctx) == "http://www.w3.org/ns/dcat#distribution"
+    # Compact IRIs with a prefix of the context
+    assert expand("dcat:keyword", ctx) == "http://www.w3.org/ns/dcat#keyword"
+
+
+def test_core_terms_cannot_be_overridden():
+    assert expand("createdAt", {"createdAt": "https://example.org/createdAt"}) == "https://uri.etsi.org/ngsi-ld/createdAt"
+
+
+def test_undefined_terms_use_the_default_vocabulary():
+    assert expand("unknownAttribute", SDM_DCAT_AP_CONTEXT) == DEFAULT_VOCAB + "unknownAttribute"
+
+
+@mock.patch("requests.get")
+def test_remote_contexts_are_never_fetched(get):
+    assert expand("rights", [REMOTE_CONTEXT, {"dct": "http://purl.org/dc/terms/"}]) == DEFAULT_VOCAB + "rights"
+    assert expand("dct:title", [REMOTE_CONTEXT, {"dct": "http://purl.org/dc/terms/"}]) == "http://purl.org/dc/terms/title"
+    get.assert_not_called()
+
+
+def test_missing_contexts():
+    assert missing_contexts(REMOTE_CONTEXT) == [REMOTE_CONTEXT]
+    # The published contexts are replaced by the shipped subsets
+    assert missing_contexts([SDM_DCAT_AP_CONTEXT, DEFAULT_NGSILD_CONTEXT]) == []
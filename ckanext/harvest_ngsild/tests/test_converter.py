@@ -0,0 +1,115 @@
+"""Tests for ngsild_ckan_converter.py: entities are retrieved from the broker in batched id list queries."""
+from unittest import mock
+
+import pytest
+
+from ngsildclient import Client
+from requests.exceptions import HTTPError
+
+from ckanext.harvest_ngsild.mapping import get_profile
+from ckanext.harvest_ngsild.ngsild_ckan_converter import NgsildCkanConverter
+from ckanext.harvest_ngsild.throttling import RateLimiter
+
+from .benchmarks.fake_broker import FakeBroker, make_catalogue
+
+DATASETS = 5
+DISTRIBUTIONS = 2
+
+
+@pytest.fixture
+def broker():
+    broker = FakeBroker(name="city", datasets=DATASETS, distributions=DISTRIBUTIONS)
+    broker.start()
+    yield broker
+    broker.stop()
+
+
+@pytest.fixture
+def converter(broker):
+    client = Client(hostname=broker.hostname, port=broker.port, secure=False)
+    # Client creation may already have sent requests
+    broker.requests = 0
+    return NgsildCkanConverter(client, profile=get_profile())
+
+
+def _assert_packages(packages, broker):
+    assert sorted(p["id"] for p in packages) == sorted(broker.dataset_ids())
+    assert all(len(p["resources"]) == DISTRIBUTIONS for p in packages)
+
+
+def test_entities_are_retrieved_in_a_query_per_batch(broker, converter):
+    packages = converter.make_ckan_packages(broker.dataset_ids())
+
+    _assert_packages(packages, broker)
+    # A query for the datasets and another one for their distributions
+    assert broker.requests == 2
+
+
+def test_batches_are_limited_to_the_batch_size(broker, converter):
+    converter.batch_size = 2
+
+    entities = converter._get_ngsild_entities(broker.dataset_ids(), type=converter.profile.type_of("dataset"))
+
+    assert sorted(entities) == sorted(broker.dataset_ids())
+    assert broker.requests == 3
+
+
+@pytest.mark.parametrize("status", [400, 501])
+def test_rejected_id_queries_fall_back_to_one_get_per_entity(broker, converter, status):
+    broker.id_query_status = status
+
+    packages = converter.make_ckan_packages(broker.dataset_ids())
+
+    _assert_packages(packages, broker)
+    # Each rejected query, then every entity of its batch
+    assert broker.requests == 1 + DATASETS + 1 + DATASETS * DISTRIBUTIONS
+
+
+def test_failing_broker_is_not_queried_entity_by_entity(broker, converter):
+    broker.id_query_status = 500
+
+    with pytest.raises(HTTPError):
+        converter.make_ckan_packages(broker.dataset_ids())
+
+    assert broker.requests == 1
+
+
+def test_concurrent_batches_share_the_rate_limiter(broker, converter):
+    converter.batch_size = 2
+    converter.max_workers = 3
+    converter.rate_limiter = mock.Mock(wraps=RateLimiter(1000))
+
+    packages = converter.make_ckan_packages(broker.dataset_ids())
+
+    _assert_packages(packages, broker)
+    # Every request of the worker threads waits for the limiter of the broker
+    assert converter.rate_limiter.acquire.call_count == broker.requests
+
+
+def test_catalog_index_pages_through_the_catalogues(broker, converter):
+    for name in ("a", "b", "c", "d"):
+        broker.add(make_catalogue(name, 2))
+    converter.batch_size = 2
+
+    index = converter.build_catalog_index()
+
+    assert {id: index[id] for id in broker.dataset_ids()} == dict.fromkeys(broker.dataset_ids(), broker.catalogue_id)
+    assert index["urn:ngsi-ld:Dataset:d:1"] == "urn:ngsi-ld:Catalogue:d"
+    # 5 catalogues in pages of 2
+    assert broker.requests == 3
+
+
+def test_catalog_from_dataset_is_looked_up_in_the_index(broker, converter):
+    first, second = broker.dataset_ids()[:2]
+
+    with mock.patch.object(converter, "_get_ngsild_entity", wraps=converter._get_ngsild_entity) as get_entity:
+        assert converter.get_catalog_from_dataset(first)
+        assert broker.requests == 2
+
+        # The index is built once, then only the catalogue is retrieved
+        assert converter.get_catalog_from_dataset(second)
+        assert broker.requests == 3
+        assert converter.get_catalog_from_dataset("urn:ngsi-ld:Dataset:unknown") == {}
+        assert broker.requests == 3
+
+    assert get_entity.call_args_list == [mock.call(broker.catalogue_id)] * 2
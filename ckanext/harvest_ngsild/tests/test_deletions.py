@@ -0,0 +1,110 @@
+"""Tests for deletions.py: datasets removed from the dataset list of a notified catalogue, deleted as a batch, and organizations purged in bulk."""
+from unittest import mock
+
+import pytest
+
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+
+from ckan.lib.search.index import PackageSearchIndex
+from ckan.tests import factories
+
+from ckanext.harvest_ngsild import deletions
+from ckanext.harvest_ngsild.constants import SDMDCAT
+from ckanext.harvest_ngsild.model import NgsildBootstrap, NgsildEntity
+
+ORGANIZATION_ID = "urn:ngsi-ld:Catalogue:org"
+WRITTEN = [f"urn:ngsi-ld:Dataset:{i}" for i in range(1, 4)]
+
+
+@pytest.fixture
+def written():
+    rows = [(id, id.lower(), None) for id in WRITTEN]
+    with mock.patch.object(deletions.NgsildEntity, "iter_organization", return_value=rows) as iter_organization:
+        yield iter_organization
+
+
+@pytest.mark.usefixtures("written")
+def test_removed_datasets():
+    assert deletions.removed_datasets(ORGANIZATION_ID, WRITTEN[1:] + ["urn:ngsi-ld:Dataset:new"]) == WRITTEN[:1]
+    assert deletions.removed_datasets(ORGANIZATION_ID, WRITTEN) == []
+
+
+@pytest.mark.usefixtures("written")
+@pytest.mark.parametrize("dataset_ids", [[], ["urn:ngsi-ld:Dataset:other"]])
+def test_whole_catalogue_is_never_removed(dataset_ids):
+    assert deletions.removed_datasets(ORGANIZATION_ID, dataset_ids) == []
+
+
+@pytest.mark.ckan_config("ckan.plugins", "harvest_ngsild")
+@pytest.mark.usefixtures("clean_db", "clean_index", "with_plugins", "redis")
+def test_packages_are_soft_deleted_in_a_single_commit(migrate_db_for):
+    migrate_db_for("harvest_ngsild")
+    organization = factories.Organization()
+    group = factories.Group()
+    packages = [factories.Dataset(owner_org=organization["id"]) for _ in WRITTEN]
+    for id, package in zip(WRITTEN, packages):
+        model.Session.add(model.Member(table_name="package", table_id=package["id"], group_id=group["id"], capacity="public"))
+        NgsildEntity.upsert(id, str(SDMDCAT["Dataset"]), organization_id=organization["id"], package_name=package["name"])
+
+    with mock.patch.object(model.repo, "commit", wraps=model.repo.commit) as commit, \
+            mock.patch.object(PackageSearchIndex, "remove_dict") as remove_dict, \
+            mock.patch.object(deletions, "unindex_packages") as unindex_packages:
+        deleted = deletions.delete_datasets({}, organization["id"], WRITTEN[:2], mode=deletions.DELETION_MODE_DELETE)
+
+    assert sorted(deleted) == WRITTEN[:2]
+    commit.assert_called_once()
+    # No package is unindexed by CKAN one by one, the batch leaves the index at once
+    remove_dict.assert_not_called()
+    unindex_packages.assert_called_once()
+    assert sorted(unindex_packages.call_args[0][0]) == sorted(p["id"] for p in packages[:2])
+
+    model.Session.expire_all()
+    assert [model.Package.get(p["id"]).state for p in packages] == ["deleted", "deleted", "active"]
+    members = model.Session.query(model.Member).filter(model.Member.group_id == group["id"])
+    assert {m.table_id: m.state for m in members} == {
+        packages[0]["id"]: "deleted", packages[1]["id"]: "deleted", packages[2]["id"]: "active",
+    }
+    assert set(NgsildEntity.get_many(WRITTEN)) == {WRITTEN[2]}
+
+
+def _search_count(organization_id: str) -> int:
+    return toolkit.get_action("package_search")(
+        {"ignore_auth": True}, {"fq": f'owner_org:"{organization_id}"', "include_private": True}
+    )["count"]
+
+
+@pytest.mark.ckan_config("ckan.plugins", "harvest_ngsild")
+@pytest.mark.usefixtures("clean_db", "clean_index", "with_plugins", "redis")
+def test_organization_is_purged_in_chunks(migrate_db_for):
+    migrate_db_for("harvest_ngsild")
+    organization = factories.Organization()
+    other = factories.Organization()
+    group = factories.Group()
+    packages = [factories.Dataset(owner_org=organization["id"], groups=[{"id": group["id"]}]) for _ in range(5)]
+    factories.Resource(package_id=packages[0]["id"])
+    kept = factories.Dataset(owner_org=other["id"])
+    for i, package in enumerate(packages):
+        NgsildEntity.upsert(f"urn:ngsi-ld:Dataset:{i}", str(SDMDCAT["Dataset"]), organization_id=organization["id"], package_name=package["name"])
+    NgsildBootstrap.start(organization["id"], total=len(packages))
+    assert _search_count(organization["id"]) == len(packages)
+
+    with mock.patch.object(deletions, "purge_packages", wraps=deletions.purge_packages) as purge_packages, \
+            mock.patch.object(PackageSearchIndex, "remove_dict") as remove_dict:
+        assert deletions.purge_organization(organization["id"], chunk_size=2) == len(packages)
+
+    # A transaction per chunk of packages, then the whole organization leaves the index at once
+    assert [len(c.args[0]) for c in purge_packages.call_args_list] == [2, 2, 1]
+    remove_dict.assert_not_called()
+    assert _search_count(organization["id"]) == 0
+
+    assert model.Group.get(organization["id"]) is None
+    assert model.Session.query(model.Package).filter(model.Package.id.in_([p["id"] for p in packages])).count() == 0
+    assert model.Session.query(model.Resource).filter(model.Resource.package_id == packages[0]["id"]).count() == 0
+    assert model.Session.query(model.Member).filter(model.Member.table_id.in_([p["id"] for p in packages])).count() == 0
+    assert NgsildEntity.existing_ids([f"urn:ngsi-ld:Dataset:{i}" for i in range(5)], organization["id"]) == set()
+    assert NgsildBootstrap.get(organization["id"]) is None
+
+    # Other organizations are left alone
+    assert model.Package.get(kept["id"]).state == "active"
+    assert _search_count(other["id"]) == 1
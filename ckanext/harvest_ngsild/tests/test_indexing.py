@@ -0,0 +1,39 @@
+"""Tests for indexing.py: packages written while indexing is suspended are not indexed on commit."""
+from unittest import mock
+
+import pytest
+
+import ckan.model as model
+
+from ckan.lib.search.index import PackageSearchIndex
+from ckan.tests import factories
+
+from ckanext.harvest_ngsild.indexing import SUSPENDED_INDEXING_KEY, index_packages, suspended_indexing
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index")
+def test_packages_are_not_indexed_while_indexing_is_suspended():
+    with mock.patch.object(PackageSearchIndex, "index_package") as index_package:
+        with suspended_indexing():
+            dataset = factories.Dataset()
+            model.Session.commit()
+        index_package.assert_not_called()
+        assert not model.Session.info[SUSPENDED_INDEXING_KEY]
+
+        # Indexing is back once the block is finished
+        factories.Dataset()
+        index_package.assert_called_once()
+
+        index_packages([dataset["id"]])
+        assert index_package.call_args_list[-1][0][0]["id"] == dataset["id"]
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index")
+def test_nested_suspension():
+    with mock.patch.object(PackageSearchIndex, "index_package") as index_package:
+        with suspended_indexing():
+            with suspended_indexing():
+                factories.Dataset()
+            # The outer block is still suspended
+            factories.Dataset()
+        index_package.assert_not_called()
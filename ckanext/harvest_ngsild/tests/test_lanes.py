@@ -0,0 +1,149 @@
+"""Tests for lanes.py: the circuit breaker of a broker lane opens, half-opens and closes."""
+from unittest import mock
+
+import pytest
+import requests
+
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.harvest_ngsild import catalogues, lanes, metrics, notifications
+from ckanext.harvest_ngsild.cache import TTLCache
+from ckanext.harvest_ngsild.constants import DEFAULT_NGSILD_CONTEXT
+from ckanext.harvest_ngsild.lanes import CircuitOpen, Lane
+from ckanext.harvest_ngsild.ngsild_ckan_converter import NgsildCkanConverter
+
+
+@pytest.fixture
+def lane(redis):
+    with mock.patch.object(lanes.time, "time", return_value=1000), \
+            mock.patch.dict(toolkit.config, {
+                lanes.LANE_CONCURRENCY_CONFIG_OPTION: "0",
+                lanes.CIRCUIT_BREAKER_THRESHOLD_CONFIG_OPTION: "2",
+                lanes.CIRCUIT_BREAKER_RESET_CONFIG_OPTION: "60",
+            }):
+        yield Lane("broker", 9090)
+
+
+def _fail(lane, error):
+    with pytest.raises(type(error)):
+        with lane.guard():
+            raise error
+
+
+def test_broker_failures_open_the_circuit(lane):
+    _fail(lane, requests.ConnectionError("unreachable"))
+    assert not lane.is_open()
+
+    _fail(lane, requests.Timeout("timeout"))
+    assert lane.is_open()
+    assert lane.retry_after() == 60
+
+    with pytest.raises(CircuitOpen):
+        with lane.guard():
+            pass
+
+
+def test_client_errors_do_not_open_the_circuit(lane):
+    not_found = requests.HTTPError(response=mock.Mock(status_code=404))
+    for _ in range(3):
+        _fail(lane, not_found)
+        _fail(lane, ValueError("invalid entity"))
+
+    assert not lane.is_open()
+
+
+def test_success_resets_the_failures(lane):
+    _fail(lane, requests.HTTPError(response=mock.Mock(status_code=503)))
+    with lane.guard():
+        pass
+    _fail(lane, requests.HTTPError(response=mock.Mock(status_code=503)))
+
+    assert not lane.is_open()
+
+
+def test_half_open_circuit_lets_a_single_trial_through(lane):
+    for _ in range(2):
+        _fail(lane, requests.ConnectionError("unreachable"))
+
+    lanes.time.time.return_value = 1061
+    assert lane.allow()
+    # Other notifications wait for the trial
+    assert not lane.allow()
+
+
+def test_failed_trial_opens_the_circuit_again(lane):
+    for _ in range(2):
+        _fail(lane, requests.ConnectionError("unreachable"))
+
+    lanes.time.time.return_value = 1061
+    _fail(lane, requests.ConnectionError("unreachable"))
+
+    assert lane.is_open()
+    assert lane.retry_after() == 60
+
+
+def test_successful_trial_closes_the_circuit(lane):
+    for _ in range(2):
+        _fail(lane, requests.ConnectionError("unreachable"))
+
+    lanes.time.time.return_value = 1061
+    with lane.guard():
+        pass
+
+    assert not lane.is_open()
+    assert lane.allow()
+    assert lane.allow()
+
+
+@pytest.fixture
+def unreachable_broker():
+    broker = mock.Mock(url="https://broker:9090")
+    broker.get.side_effect = requests.ConnectionError("unreachable")
+    # Brokers without id list queries are queried entity by entity
+    broker.session.get.return_value.raise_for_status.side_effect = requests.HTTPError(response=mock.Mock(status_code=501))
+    with mock.patch.object(metrics, "_registry", metrics.MetricsRegistry()):
+        yield NgsildCkanConverter(broker, max_workers=1, profile=mock.Mock(context=DEFAULT_NGSILD_CONTEXT))
+
+
+@mock.patch.object(catalogues, "_get_shared", return_value=None)
+@mock.patch.object(catalogues, "_get_cache", return_value=TTLCache())
+def test_unreachable_broker_opens_the_circuit(_get_cache, _get_shared, lane, unreachable_broker):
+    for _ in range(2):
+        with pytest.raises(requests.ConnectionError):
+            with lane.guard():
+                catalogues.get_catalogue(unreachable_broker, "urn:ngsi-ld:Catalogue:org")
+
+    assert lane.is_open()
+
+
+def test_unreachable_broker_in_entity_fallback_opens_the_circuit(lane, unreachable_broker):
+    for _ in range(2):
+        with pytest.raises(requests.ConnectionError):
+            with lane.guard():
+                unreachable_broker._get_ngsild_entities(["urn:ngsi-ld:Dataset:1", "urn:ngsi-ld:Dataset:2"])
+
+    assert lane.is_open()
+
+
+@mock.patch.object(notifications, "process_notification")
+@mock.patch.object(toolkit, "enqueue_job")
+def test_notification_is_processed_once_the_circuit_closes(enqueue_job, process_notification, lane):
+    for _ in range(2):
+        _fail(lane, requests.ConnectionError("unreachable"))
+
+    notifications.enqueue_notification("user", "org", "broker", 9090, [{"id": "urn:ngsi-ld:Dataset:1", "type": "Dataset"}])
+    func, args = enqueue_job.call_args[0]
+    enqueue_job.reset_mock()
+    func(*args)
+
+    # Rejected by the open circuit, the notification waits until the circuit half-opens
+    process_notification.assert_not_called()
+    assert notifications.enqueue_due_jobs() == 0
+
+    lanes.time.time.return_value = 1060
+    assert notifications.enqueue_due_jobs() == 1
+    func, args = enqueue_job.call_args[0]
+    func(*args)
+
+    process_notification.assert_called_once()
+    assert not lane.is_open()
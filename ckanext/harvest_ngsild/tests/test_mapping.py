@@ -0,0 +1,154 @@
+"""Tests for mapping.py: profiles are validated and the shipped ones convert DCAT-AP entities into CKAN."""
+import copy
+import os
+from unittest import mock
+
+import pytest
+
+from ngsildclient import Entity
+
+from ckanext.harvest_ngsild.mapping import PROFILES_DIR, MappingProfileError, load_profile, parse_profile
+from ckanext.harvest_ngsild.ngsild_ckan_converter import EntityView, NgsildCkanConverter
+
+SDM = "https://smartdatamodels.org/"
+SDMDCAT = "https://smartdatamodels.org/dataModel.DCAT-AP/"
+DCTERMS = "http://purl.org/dc/terms/"
+
+# Entities with expanded attribute names, as returned by a broker for any context
+DATASET = {
+    "id": "urn:ngsi-ld:Dataset:air-quality",
+    "type": SDMDCAT + "Dataset",
+    DCTERMS + "title": {"type": "Property", "value": "Air quality"},
+    DCTERMS + "description": {"type": "Property", "value": "Hourly air quality"},
+    SDMDCAT + "creator": {"type": "Property", "value": "City council"},
+    SDM + "dataProvider": {"type": "Property", "value": "Environment office"},
+    SDMDCAT + "landingPage": {"type": "Property", "value": "https://example.org/air-quality"},
+    SDMDCAT + "versionInfo": {"type": "Property", "value": "1.2"},
+    SDMDCAT + "publisher": {"type": "Property", "value": "urn:ngsi-ld:Catalogue:city"},
+    SDMDCAT + "keyword": {"type": "Property", "value": ["air", "quality"]},
+    SDMDCAT + "distribution": {"type": "Property", "value": ["urn:ngsi-ld:Distribution:air-quality-csv"]},
+}
+
+DISTRIBUTION = {
+    "id": "urn:ngsi-ld:Distribution:air-quality-csv",
+    "type": SDMDCAT + "Distribution",
+    DCTERMS + "title": {"type": "Property", "value": "Air quality CSV"},
+    SDMDCAT + "accessUrl": {"type": "Property", "value": "https://example.org/air-quality.csv"},
+    SDM + "dateCreated": {"type": "Property", "value": "2024-01-01T00:00:00Z"},
+}
+
+CATALOGUE = {
+    "id": "urn:ngsi-ld:Catalogue:city",
+    "type": SDMDCAT + "Catalogue",
+    DCTERMS + "title": {"type": "Property", "value": "City"},
+}
+
+PROFILES = sorted(f for f in os.listdir(PROFILES_DIR) if f.endswith(".json"))
+
+PROFILE = {
+    "name": "test",
+    "context": [
+        {"dcterms": DCTERMS},
+        "https://raw.githubusercontent.com/smart-data-models/dataModel.DCAT-AP/master/context.jsonld",
+    ],
+    "types": {"catalogue": "Catalogue", "dataset": ["Dataset"], "distribution": "Distribution"},
+    "attributes": {"dataset": "dataset", "distribution": "distribution", "publisher": "publisher", "keyword": "keyword"},
+    "organization": {"title": "title"},
+    "package": {"title": "title", "extras:issued": ["releaseDate", "dcterms:issued"]},
+    "resource": {"url": "accessUrl"},
+}
+
+
+@pytest.mark.parametrize("filename", PROFILES)
+def test_shipped_profile_converts_dcat_ap_entities(filename):
+    profile = load_profile(os.path.join(PROFILES_DIR, filename))
+    converter = NgsildCkanConverter(mock.Mock(url="https://broker:9090"), profile=profile)
+    dataset = EntityView(Entity(DATASET), profile.context)
+    distribution = EntityView(Entity(DISTRIBUTION), profile.context)
+
+    assert profile.is_type("dataset", dataset.type)
+    assert profile.is_type("distribution", distribution.type)
+
+    package, resources = converter.package_from_entities(dataset, {distribution.id: distribution})
+
+    assert package["title"] == "Air quality"
+    assert package["notes"] == "Hourly air quality"
+    assert package["author"] == "City council"
+    assert package["maintainer"] == "Environment office"
+    assert package["url"] == "https://example.org/air-quality"
+    assert package["version"] == "1.2"
+    assert package["owner_org"] == "urn:ngsi-ld:Catalogue:city"
+    assert sorted(t["name"] for t in package["tags"]) == ["air", "quality"]
+
+    assert len(resources) == 1
+    resource = resources[0]
+    assert resource["id"] == "urn_ngsi-ld_distribution_air-quality-csv"
+    assert resource["name"] == "air_quality_csv"
+    assert resource["url"] == "https://example.org/air-quality.csv"
+    assert resource["access_url"] == "https://example.org/air-quality.csv"
+    assert resource["cache_url"] == "https://example.org/air-quality.csv"
+    assert resource["download_url"] == "https://example.org/air-quality.csv"
+    # In UTC, as accepted by the isodate validator of CKAN
+    assert resource["created"] == "2024-01-01T00:00:00"
+    # Attributes missing in the entity are converted too, so they can be cleared
+    assert resource["size"] is None
+
+
+@pytest.mark.parametrize("filename", PROFILES)
+def test_missing_catalogue_attributes_are_left_out_of_the_organization(filename):
+    profile = load_profile(os.path.join(PROFILES_DIR, filename))
+    converter = NgsildCkanConverter(mock.Mock(url="https://broker:9090"), profile=profile)
+
+    organization = converter.organization_from_catalog(EntityView(Entity(CATALOGUE), profile.context))
+
+    assert organization["id"] == "urn:ngsi-ld:Catalogue:city"
+    assert organization["title"] == "City"
+    assert None not in organization.values()
+
+
+def _profile(**changes):
+    data = copy.deepcopy(PROFILE)
+    for key, value in changes.items():
+        if value is None:
+            del data[key]
+        else:
+            data[key] = value
+    return data
+
+
+def test_parse_profile():
+    profile = parse_profile(_profile())
+
+    assert profile.types["catalogue"] == (SDMDCAT + "Catalogue",)
+    assert profile.attributes["keyword"] == SDMDCAT + "keyword"
+    assert profile.package.groups == ("extras",)
+    assert profile.package.entries == (
+        (None, "title", (DCTERMS + "title",), ","),
+        ("extras", "issued", (SDMDCAT + "releaseDate", DCTERMS + "issued"), ","),
+    )
+
+
+@pytest.mark.parametrize("data, error", [
+    ([], "must be a JSON object"),
+    (_profile(name=None), "has no name"),
+    (_profile(types={"catalogue": "Catalogue", "dataset": "Dataset"}), "missing entity types for distribution"),
+    (_profile(attributes={"dataset": "dataset", "distribution": ["distribution"]}),
+     "missing attributes distribution, publisher, keyword"),
+    (_profile(package=None), "'package' must be an object"),
+    (_profile(package={"extras:issued:at": "issued"}), "invalid target 'extras:issued:at' in 'package'"),
+    (_profile(resource={"": "accessUrl"}), "invalid target '' in 'resource'"),
+    (_profile(resource={"url": ["accessUrl", 1]}), "sources of 'resource.url' must be strings"),
+    (_profile(organization={"title": {"@id": "title"}}), "source of 'organization.title' must be a string or a list"),
+    (_profile(context="https://example.org/context.jsonld"), "not shipped with the extension"),
+])
+def test_invalid_profile(data, error):
+    with pytest.raises(MappingProfileError, match=error):
+        parse_profile(data)
+
+
+def test_unreadable_profile(tmp_path):
+    path = tmp_path / "profile.json"
+    path.write_text("{", encoding="utf-8")
+
+    with pytest.raises(MappingProfileError, match="Error reading mapping profile"):
+        load_profile(str(path))
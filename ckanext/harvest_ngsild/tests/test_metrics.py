@@ -0,0 +1,76 @@
+"""Tests for metrics.py: samples are rendered in the Prometheus text exposition format."""
+from unittest import mock
+
+import pytest
+
+from ckanext.harvest_ngsild import metrics
+
+
+@pytest.fixture(autouse=True)
+def registry(redis):
+    with mock.patch.object(metrics, "_registry", metrics.MetricsRegistry()) as registry:
+        yield registry
+
+
+def test_render_counters():
+    metrics.inc("entities_total", 2, result="created")
+    metrics.inc("entities_total", result="created")
+    metrics.inc("entities_total", result="unchanged")
+
+    assert metrics.render() == (
+        "# HELP ckanext_harvest_ngsild_entities_total "
+        + metrics.METRICS["entities_total"][1] + "\n"
+        "# TYPE ckanext_harvest_ngsild_entities_total counter\n"
+        'ckanext_harvest_ngsild_entities_total{result="created"} 3\n'
+        'ckanext_harvest_ngsild_entities_total{result="unchanged"} 1\n'
+    )
+
+
+def test_render_histogram():
+    metrics.observe("notification_duration_seconds", 0.2)
+    metrics.observe("notification_duration_seconds", 3)
+
+    lines = metrics.render().splitlines()
+
+    assert lines[1] == "# TYPE ckanext_harvest_ngsild_notification_duration_seconds histogram"
+    samples = dict(line.rsplit(" ", 1) for line in lines[2:])
+    # Cumulative buckets in increasing order, then the sum and the count
+    names = list(samples)
+    assert names[0] == 'ckanext_harvest_ngsild_notification_duration_seconds_bucket{le="0.005"}'
+    assert names[-3:] == [
+        'ckanext_harvest_ngsild_notification_duration_seconds_bucket{le="+Inf"}',
+        "ckanext_harvest_ngsild_notification_duration_seconds_sum",
+        "ckanext_harvest_ngsild_notification_duration_seconds_count",
+    ]
+    assert samples['ckanext_harvest_ngsild_notification_duration_seconds_bucket{le="0.1"}'] == "0"
+    assert samples['ckanext_harvest_ngsild_notification_duration_seconds_bucket{le="0.25"}'] == "1"
+    assert samples['ckanext_harvest_ngsild_notification_duration_seconds_bucket{le="5"}'] == "2"
+    assert samples["ckanext_harvest_ngsild_notification_duration_seconds_sum"] == "3.2"
+    assert samples["ckanext_harvest_ngsild_notification_duration_seconds_count"] == "2"
+
+
+def test_render_escapes_label_values():
+    metrics.inc("notifications_received_total", broker='broker:1026', organization='say "hi"\\\n')
+
+    assert metrics.render().splitlines()[-1] == (
+        'ckanext_harvest_ngsild_notifications_received_total'
+        '{broker="broker:1026",organization="say \\"hi\\"\\\\\\n"} 1'
+    )
+
+
+def test_render_extra_gauges():
+    extra = {
+        metrics.sample("lane_in_flight", broker="b:1026"): 2,
+        metrics.sample("lane_in_flight", broker="a:1026"): 0.5,
+    }
+
+    assert metrics.render(extra) == (
+        "# TYPE ckanext_harvest_ngsild_lane_in_flight gauge\n"
+        'ckanext_harvest_ngsild_lane_in_flight{broker="a:1026"} 0.5\n'
+        'ckanext_harvest_ngsild_lane_in_flight{broker="b:1026"} 2\n'
+    )
+
+
+def test_broker_label():
+    assert metrics.broker_label("https://broker:9090") == "broker:9090"
+    assert metrics.broker_label("broker:9090") == "broker:9090"
@@ -0,0 +1,161 @@
+"""Tests for notifications.py: queued notifications are deduplicated, debounced and delayed without busy workers."""
+from unittest import mock
+
+import pytest
+
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.harvest_ngsild import metrics, notifications
+from ckanext.harvest_ngsild.lanes import Lane, LaneBusy
+
+HOSTNAME = "broker"
+PORT = 9090
+ORGANIZATION = "org"
+
+
+def _entity(version, id="urn:ngsi-ld:Dataset:1"):
+    return {"id": id, "type": "Dataset", "modifiedAt": version, "title": {"type": "Property", "value": version}}
+
+
+def _enqueue(*entities):
+    return notifications.enqueue_notification("user", ORGANIZATION, HOSTNAME, PORT, list(entities))
+
+
+@pytest.fixture
+def enqueue_job():
+    with mock.patch.object(toolkit, "enqueue_job") as enqueue_job:
+        yield enqueue_job
+
+
+@pytest.fixture
+def now():
+    with mock.patch.object(notifications.time, "time", return_value=1000) as time:
+        yield time
+
+
+@pytest.fixture
+def process_notification():
+    with mock.patch.object(notifications, "process_notification") as process_notification:
+        yield process_notification
+
+
+def _run(job_call):
+    func, args = job_call[0]
+    func(*args)
+
+
+@pytest.mark.usefixtures("redis")
+def test_duplicated_notification_is_discarded_while_its_job_is_pending(enqueue_job, process_notification):
+    assert _enqueue(_entity("v1"), _entity("v1", id="urn:ngsi-ld:Dataset:2")) == ["urn:ngsi-ld:Dataset:1", "urn:ngsi-ld:Dataset:2"]
+    # Broker retry of the same notification, and a new state of the first entity
+    assert _enqueue(_entity("v1")) == []
+    assert _enqueue(_entity("v2")) == ["urn:ngsi-ld:Dataset:1"]
+    assert enqueue_job.call_count == 2
+
+    _run(enqueue_job.call_args_list[0])
+    process_notification.assert_called_once()
+
+    # Once processed, the same state is processed again (i.e. the entity went back to it)
+    assert _enqueue(_entity("v1")) == ["urn:ngsi-ld:Dataset:1"]
+
+
+@pytest.mark.usefixtures("redis")
+@mock.patch.dict(toolkit.config, {notifications.NOTIFICATIONS_QUEUE_CONFIG_OPTION: "ngsild"})
+def test_notification_is_enqueued_with_its_entities(enqueue_job, process_notification):
+    entities = [_entity("v1"), _entity("v1", id="urn:ngsi-ld:Dataset:2")]
+    notifications.enqueue_notification("user", ORGANIZATION, HOSTNAME, PORT, entities, "dcat")
+
+    enqueue_job.assert_called_once()
+    (func, args), kwargs = enqueue_job.call_args
+    assert func is notifications.notification_job
+    assert kwargs["queue"] == "ngsild"
+    assert args[:5] == ["user", ORGANIZATION, HOSTNAME, PORT, entities]
+
+    _run(enqueue_job.call_args)
+    user, organization, hostname, port, processed = process_notification.call_args[0]
+    assert (user, organization, processed) == ("user", ORGANIZATION, entities)
+    assert process_notification.call_args[1]["profile"] == "dcat"
+
+
+@pytest.mark.usefixtures("redis")
+def test_entities_without_modified_at_are_deduplicated_by_content(enqueue_job):
+    entity = {"id": "urn:ngsi-ld:Dataset:1", "type": "Dataset", "title": {"type": "Property", "value": "v1"}}
+
+    assert _enqueue(entity) == ["urn:ngsi-ld:Dataset:1"]
+    assert _enqueue(dict(entity)) == []
+    assert _enqueue(dict(entity, title={"type": "Property", "value": "v2"})) == ["urn:ngsi-ld:Dataset:1"]
+
+
+@pytest.mark.usefixtures("redis")
+def test_failed_notification_is_processed_again_on_retry(enqueue_job, process_notification):
+    _enqueue(_entity("v1"))
+    process_notification.side_effect = ValueError("invalid package")
+
+    with pytest.raises(ValueError):
+        _run(enqueue_job.call_args)
+
+    # The broker retry of the notification is not discarded as a duplicate
+    assert _enqueue(_entity("v1")) == ["urn:ngsi-ld:Dataset:1"]
+
+
+@pytest.mark.usefixtures("redis")
+@mock.patch.dict(toolkit.config, {notifications.NOTIFICATIONS_DEBOUNCE_WINDOW_CONFIG_OPTION: "5"})
+def test_notifications_of_an_entity_are_collapsed_in_its_window(enqueue_job, now, process_notification):
+    for version in ("v1", "v2", "v3"):
+        _enqueue(_entity(version))
+
+    # Nothing is enqueued while the window is open
+    now.return_value = 1004
+    assert notifications.enqueue_due_jobs() == 0
+    enqueue_job.assert_not_called()
+    assert 'ckanext_harvest_ngsild_notifications_collapsed_total{broker="broker:9090",organization="org"} 2' in (
+        metrics.render().splitlines()
+    )
+
+    now.return_value = 1005
+    assert notifications.enqueue_due_jobs() == 1
+    assert enqueue_job.call_args[0][0] is notifications.debounced_notification_job
+
+    _run(enqueue_job.call_args)
+
+    # Only the latest state is processed
+    assert process_notification.call_args[0][4] == [_entity("v3")]
+    # The collapsed states are no longer duplicates
+    assert _enqueue(_entity("v1")) == ["urn:ngsi-ld:Dataset:1"]
+
+
+@pytest.mark.usefixtures("redis")
+@mock.patch.dict(toolkit.config, {notifications.NOTIFICATIONS_DEBOUNCE_WINDOW_CONFIG_OPTION: "5"})
+def test_new_window_after_the_job_runs(enqueue_job, now, process_notification):
+    _enqueue(_entity("v1"))
+    now.return_value = 1005
+    notifications.enqueue_due_jobs()
+    _run(enqueue_job.call_args)
+
+    _enqueue(_entity("v2"))
+    assert notifications.enqueue_due_jobs() == 0
+
+    now.return_value = 1010
+    assert notifications.enqueue_due_jobs() == 1
+    _run(enqueue_job.call_args)
+    assert process_notification.call_args[0][4] == [_entity("v2")]
+
+
+@pytest.mark.usefixtures("redis")
+def test_job_of_a_busy_lane_is_delayed(enqueue_job, now, process_notification):
+    _enqueue(_entity("v1"))
+    job = enqueue_job.call_args
+    enqueue_job.reset_mock()
+
+    with mock.patch.object(Lane, "slot", side_effect=LaneBusy("busy")):
+        _run(job)
+
+    # The job is not sent back to its queue right away, it waits in Redis
+    enqueue_job.assert_not_called()
+    # and keeps its deduplication keys
+    assert _enqueue(_entity("v1")) == []
+
+    now.return_value = 1000 + notifications.BUSY_RETRY_DELAY
+    assert notifications.enqueue_due_jobs() == 1
+    _run(enqueue_job.call_args)
+    process_notification.assert_called_once()
@@ -0,0 +1,177 @@
+"""Tests for packages.py: only the changes of a package are written into CKAN."""
+from unittest import mock
+
+import pytest
+
+import ckan.logic as logic
+import ckan.model as model
+
+from ckan.tests import factories
+
+from ckanext.harvest_ngsild import packages
+from ckanext.harvest_ngsild.model import NgsildEntity
+
+
+def _stored():
+    return {
+        "id": "4f1c0e6a-5b8e-4f43-9a57-2b1d7c0f8e11",
+        "name": "urn_ngsi-ld_dataset_1",
+        "title": "Dataset 1",
+        "notes": "Description",
+        "url": "https://example.org/dataset/1",
+        "private": False,
+        "state": "active",
+        "owner_org": "org-id",
+        "metadata_modified": "2024-01-01T00:00:00",
+        "tags": [{"name": "air", "id": "t1"}],
+        "extras": [],
+        "resources": [
+            {
+                "id": "urn_ngsi-ld_distribution_1",
+                "package_id": "4f1c0e6a-5b8e-4f43-9a57-2b1d7c0f8e11",
+                "name": "Distribution 1",
+                "url": "https://example.org/distribution/1",
+                "format": "CSV",
+                "created": "2024-01-01T00:00:00",
+            }
+        ],
+    }
+
+
+def _converted(**changes):
+    package = {
+        "name": "urn_ngsi-ld_dataset_1",
+        "title": "Dataset 1",
+        "notes": "Description",
+        "url": "https://example.org/dataset/1",
+        "private": False,
+        "state": "active",
+        "owner_org": "org",
+        "tags": [{"name": "air"}],
+        "extras": [],
+        "resources": [
+            {
+                "id": "urn_ngsi-ld_distribution_1",
+                "name": "Distribution 1",
+                "url": "https://example.org/distribution/1",
+                "format": "CSV",
+            }
+        ],
+    }
+    package.update(changes)
+    return package
+
+
+@mock.patch.object(logic.action.patch, "resource_patch")
+@mock.patch.object(logic.action.patch, "package_patch")
+def test_unchanged_package_is_not_written(package_patch, resource_patch):
+    assert packages.update_package({}, _converted(), _stored()) == packages.UNCHANGED
+    package_patch.assert_not_called()
+    resource_patch.assert_not_called()
+
+
+@mock.patch.object(logic.action.patch, "package_patch")
+def test_values_normalized_by_ckan_are_unchanged(package_patch):
+    stored = _stored()
+    stored["resources"][0]["size"] = 1024
+    package = _converted()
+    # Stored by CKAN as a naive datetime, a unified format and an integer
+    package["resources"][0].update(created="2024-01-01T00:00:00Z", format="csv", size="1024")
+
+    assert packages.update_package({}, package, stored) == packages.UNCHANGED
+    package_patch.assert_not_called()
+
+    package["resources"][0]["created"] = "2024-01-02T00:00:00Z"
+    assert packages.update_package({}, package, stored) == packages.UPDATED
+    package_patch.assert_called_once()
+
+
+@mock.patch.object(logic.action.patch, "resource_patch")
+@mock.patch.object(logic.action.patch, "package_patch")
+def test_changed_field_is_a_single_patch(package_patch, resource_patch):
+    package = _converted(title="Dataset one")
+    package["resources"][0]["format"] = "JSON"
+
+    assert packages.update_package({}, package, _stored()) == packages.UPDATED
+
+    package_patch.assert_called_once()
+    resource_patch.assert_not_called()
+    _, changes = package_patch.call_args[0]
+    assert changes["id"] == "4f1c0e6a-5b8e-4f43-9a57-2b1d7c0f8e11"
+    assert changes["title"] == "Dataset one"
+    assert "notes" not in changes
+    # The resources are sent in the same patch, keeping the fields set by CKAN
+    assert changes["resources"] == [
+        {
+            "id": "urn_ngsi-ld_distribution_1",
+            "package_id": "4f1c0e6a-5b8e-4f43-9a57-2b1d7c0f8e11",
+            "name": "Distribution 1",
+            "url": "https://example.org/distribution/1",
+            "format": "JSON",
+            "created": "2024-01-01T00:00:00",
+        }
+    ]
+
+
+@mock.patch.object(logic.action.patch, "package_patch")
+def test_removed_attributes_are_cleared(package_patch):
+    package = _converted(url=None, tags=[])
+
+    packages.update_package({}, package, _stored())
+
+    _, changes = package_patch.call_args[0]
+    assert changes["url"] == ""
+    assert changes["tags"] == []
+    assert "resources" not in changes
+
+
+@mock.patch.object(logic.action.patch, "package_patch")
+def test_removed_distribution_is_dropped(package_patch):
+    package = _converted(resources=[])
+
+    packages.update_package({}, package, _stored())
+
+    _, changes = package_patch.call_args[0]
+    assert changes["resources"] == []
+
+
+@mock.patch.object(packages, "upsert_package")
+@mock.patch.object(packages.NgsildEntity, "upsert")
+@mock.patch.object(packages.NgsildEntity, "get")
+def test_sync_package_skips_unchanged_content(get, upsert, upsert_package):
+    package = _converted(id="urn:ngsi-ld:Dataset:1")
+    get.return_value = mock.Mock(content_hash=packages.package_content_hash(package), modified_at=None)
+
+    assert packages.sync_package({}, package, "org-id") == (None, packages.UNCHANGED)
+    upsert_package.assert_not_called()
+    upsert.assert_not_called()
+
+
+@pytest.fixture
+def context():
+    sysadmin = factories.Sysadmin()
+    return {"model": model, "session": model.Session, "user": sysadmin["name"]}
+
+
+@pytest.mark.ckan_config("ckan.plugins", "harvest_ngsild")
+@pytest.mark.usefixtures("clean_db", "clean_index", "with_plugins")
+def test_unchanged_package_is_skipped_before_any_ckan_action(migrate_db_for, context):
+    migrate_db_for("harvest_ngsild")
+    organization = factories.Organization(id="urn:ngsi-ld:Catalogue:city", name="city")
+
+    def package(**changes):
+        return _converted(id="urn:ngsi-ld:Dataset:1", owner_org=organization["name"], **changes)
+
+    created, result = packages.sync_package(context, package(), organization["id"], "2024-01-01T00:00:00Z")
+    assert result == packages.CREATED
+    assert NgsildEntity.get("urn:ngsi-ld:Dataset:1").package_name == created["name"]
+
+    with mock.patch.object(logic.action.get, "package_show") as package_show:
+        # Same content with a new modifiedAt (i.e. an attribute set to its current value)
+        assert packages.sync_package(context, package(), organization["id"], "2024-01-02T00:00:00Z") == (None, packages.UNCHANGED)
+    package_show.assert_not_called()
+    assert NgsildEntity.is_unchanged("urn:ngsi-ld:Dataset:1", "2024-01-02T00:00:00Z")
+
+    _, result = packages.sync_package(context, package(title="Dataset one"), organization["id"], "2024-01-03T00:00:00Z")
+    assert result == packages.UPDATED
+    assert logic.get_action("package_show")({"ignore_auth": True}, {"id": created["id"]})["title"] == "Dataset one"
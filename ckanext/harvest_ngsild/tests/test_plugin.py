@@ -47,7 +47,89 @@ To temporary patch the CKAN configuration for the duration of a test you can use
     def test_some_action():
         pass
 """
+from unittest import mock
+
+import pytest
+
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+
+from ckan.tests import factories
+from ngsildclient import Client
+
 import ckanext.harvest_ngsild.plugin as plugin
 
+from ckanext.harvest_ngsild.model import NgsildEntity
+from ckanext.harvest_ngsild.ngsild_ckan_converter import NgsildCkanConverter
+
+from .benchmarks.fake_broker import SDMDCAT, FakeBroker, make_dataset, make_distribution
+
+DATASETS = 3
+
+
 def test_plugin():
     pass
+
+
+@pytest.fixture
+def broker():
+    broker = FakeBroker(name="city", datasets=DATASETS, distributions=1)
+    broker.start()
+    yield broker
+    broker.stop()
+
+
+@pytest.fixture
+def context():
+    sysadmin = factories.Sysadmin()
+    return {"model": model, "session": model.Session, "user": sysadmin["name"]}
+
+
+@pytest.fixture
+def converted():
+    """Dataset ids converted into packages, by call"""
+    with mock.patch.object(
+        NgsildCkanConverter, "make_ckan_packages", autospec=True, side_effect=NgsildCkanConverter.make_ckan_packages
+    ) as make_ckan_packages:
+        yield lambda: [sorted(c.args[1]) for c in make_ckan_packages.call_args_list]
+
+
+def _add_dataset(broker, i):
+    broker.add(make_dataset(broker.name, i, 1))
+    broker.add(make_distribution(broker.name, i, 0))
+    broker.entities[broker.catalogue_id][SDMDCAT + "dataset"]["value"].append(f"urn:ngsi-ld:Dataset:{broker.name}:{i}")
+
+
+@pytest.mark.ckan_config("ckan.plugins", "harvest_ngsild")
+@pytest.mark.usefixtures("clean_db", "clean_index", "with_plugins", "redis")
+def test_resubscription_only_converts_datasets_without_a_package(migrate_db_for, broker, context, converted):
+    migrate_db_for("harvest_ngsild")
+    factories.Organization(id=broker.catalogue_id, name="city")
+    client = Client(hostname=broker.hostname, port=broker.port, secure=False)
+
+    plugin.check_resubscription(context, broker.catalogue_id, client)
+    assert NgsildEntity.existing_ids(broker.dataset_ids(), broker.catalogue_id) == set(broker.dataset_ids())
+
+    # Injected into the broker while unsubscribed
+    _add_dataset(broker, DATASETS)
+    plugin.check_resubscription(context, broker.catalogue_id, client)
+
+    assert converted() == [sorted(broker.dataset_ids()[:DATASETS]), [f"urn:ngsi-ld:Dataset:city:{DATASETS}"]]
+    package = toolkit.get_action("package_show")({"ignore_auth": True}, {"id": f"city_{DATASETS}"})
+    assert package["owner_org"] == broker.catalogue_id
+
+
+@pytest.mark.ckan_config("ckan.plugins", "harvest_ngsild")
+@pytest.mark.usefixtures("clean_db", "clean_index", "with_plugins", "redis")
+def test_resubscription_matches_packages_missing_in_the_entity_index(migrate_db_for, broker, context, converted):
+    migrate_db_for("harvest_ngsild")
+    factories.Organization(id=broker.catalogue_id, name="city")
+    client = Client(hostname=broker.hostname, port=broker.port, secure=False)
+    plugin.check_resubscription(context, broker.catalogue_id, client)
+
+    # Packages written before the entity index existed, found in every page of the search index
+    NgsildEntity.delete_many(broker.dataset_ids())
+    with mock.patch.object(plugin, "SEARCH_PAGE_SIZE", 1):
+        plugin.check_resubscription(context, broker.catalogue_id, client)
+
+    assert converted() == [sorted(broker.dataset_ids()), []]
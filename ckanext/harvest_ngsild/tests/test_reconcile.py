@@ -0,0 +1,41 @@
+"""Tests for reconcile.py: merge join of the broker datasets and the entity index."""
+import pytest
+
+from ckanext.harvest_ngsild.reconcile import merge_ids
+
+
+def _row(id):
+    return (id, f"package-{id}", "2024-01-01T00:00:00Z")
+
+
+def _merge(broker_ids, indexed_ids):
+    return [
+        (id, row[0] if row else None, in_broker)
+        for id, row, in_broker in merge_ids(iter(broker_ids), iter(_row(id) for id in indexed_ids))
+    ]
+
+
+@pytest.mark.parametrize("broker_ids, indexed_ids, expected", [
+    ([], [], []),
+    (["a", "b"], [], [("a", None, True), ("b", None, True)]),
+    ([], ["a", "b"], [("a", "a", False), ("b", "b", False)]),
+    (["a", "b"], ["a", "b"], [("a", "a", True), ("b", "b", True)]),
+    # Interleaved ids, and one side running out before the other
+    (
+        ["a", "c", "e", "f"],
+        ["b", "c", "d"],
+        [("a", None, True), ("b", "b", False), ("c", "c", True), ("d", "d", False), ("e", None, True), ("f", None, True)],
+    ),
+    (["b"], ["a", "c", "d"], [("a", "a", False), ("b", None, True), ("c", "c", False), ("d", "d", False)]),
+])
+def test_merge_ids(broker_ids, indexed_ids, expected):
+    assert _merge(broker_ids, indexed_ids) == expected
+
+
+def test_merge_ids_reads_each_side_once():
+    broker_ids = iter(["a", "b"])
+    indexed = iter([_row("b")])
+
+    assert [id for id, _, _ in merge_ids(broker_ids, indexed)] == ["a", "b"]
+    assert next(broker_ids, None) is None
+    assert next(indexed, None) is None
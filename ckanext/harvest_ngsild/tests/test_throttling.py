@@ -0,0 +1,95 @@
+"""Tests for throttling.py: the token bucket caps the requests per second sent to a broker."""
+import math
+import threading
+
+from unittest import mock
+
+import pytest
+
+from ckanext.harvest_ngsild import throttling
+from ckanext.harvest_ngsild.throttling import RateLimiter, get_rate_limiter
+
+
+class Clock:
+    """Monotonic clock advanced by the sleeps of the limiter, with a microsecond resolution"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += math.ceil(seconds * 1e6) / 1e6
+
+
+@pytest.fixture
+def clock():
+    clock = Clock()
+    with mock.patch.object(throttling.time, "monotonic", clock.monotonic), \
+            mock.patch.object(throttling.time, "sleep", clock.sleep):
+        yield clock
+
+
+def test_burst_up_to_the_rate_then_wait(clock):
+    limiter = RateLimiter(10)
+
+    for _ in range(10):
+        limiter.acquire()
+    assert clock.sleeps == []
+
+    limiter.acquire()
+    assert clock.sleeps == [pytest.approx(0.1)]
+
+
+def test_sustained_rate(clock):
+    limiter = RateLimiter(5)
+
+    for _ in range(25):
+        limiter.acquire()
+
+    # The first 5 requests use the initial bucket, the next 20 are spread over 4 seconds
+    assert clock.now == pytest.approx(4, abs=1e-3)
+
+
+def test_rate_below_one_request_per_second(clock):
+    limiter = RateLimiter(0.5)
+
+    limiter.acquire()
+    limiter.acquire()
+
+    assert clock.now == pytest.approx(2, abs=1e-3)
+
+
+def test_no_rate_is_unlimited(clock):
+    limiter = RateLimiter(0)
+
+    for _ in range(100):
+        limiter.acquire()
+
+    assert clock.sleeps == []
+
+
+def test_threads_share_the_rate(clock):
+    limiter = RateLimiter(2)
+    threads = [threading.Thread(target=limiter.acquire) for _ in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # The 4 requests beyond the bucket wait their turn, whatever thread sent them
+    # (the sleeps of the fake clock add up instead of overlapping, so it can be later)
+    assert clock.now >= 2
+
+
+def test_one_limiter_per_broker():
+    with mock.patch.dict(throttling._rate_limiters, clear=True):
+        limiter = get_rate_limiter("http://broker:9090", 10)
+
+        assert get_rate_limiter("http://broker:9090", 10) is limiter
+        assert get_rate_limiter("http://other:9090", 10) is not limiter
+        # A new rate replaces the limiter of the broker
+        assert get_rate_limiter("http://broker:9090", 5).rate == 5
@@ -0,0 +1,53 @@
+import threading
+import time
+
+from typing import Dict
+
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Token bucket limiting the number of requests per second sent to a broker.
+
+    It is shared by all the threads retrieving entities from the same broker,
+    so the rate cap holds regardless of the number of workers.
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        # Bucket capacity: a request needs a whole token, even below one request per second
+        self.capacity = max(rate, 1)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+_rate_limiters: Dict[str, RateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(broker_url: str, rate: float) -> RateLimiter:
+    # One limiter per broker and process, so that concurrent requests
+    # to the same broker share the same rate cap
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(broker_url)
+        if limiter is None or limiter.rate != rate:
+            limiter = _rate_limiters[broker_url] = RateLimiter(rate)
+        return limiter